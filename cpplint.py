@@ -43,9 +43,14 @@ same line, but it is far from perfect (in either direction).
 """
 
 import codecs
+import collections
 import copy
 import getopt
+import hashlib
+import io
+import json
 import math  # for log
+import multiprocessing
 import os
 import re
 import string
@@ -56,7 +61,7 @@ import unicodedata
 _USAGE = r"""
 Syntax: cpplint.py [--verbose=#] [--output=vs7] [--filter=-x,+y,...]
                    [--counting=total|toplevel|detailed] [--root=subdir]
-                   [--linelength=digits]
+                   [--linelength=digits] [--parse_cache_dir=dir]
         <file> [file] ...
 
   The style guidelines this tries to follow are those in
@@ -134,6 +139,13 @@ Syntax: cpplint.py [--verbose=#] [--output=vs7] [--filter=-x,+y,...]
       Examples:
         --extensions=hpp,cpp
 
+    parse_cache_dir=dir
+      Directory where the preprocessed contents of the files are cached, so
+      that linting unchanged files again is faster.
+
+      Examples:
+        --parse_cache_dir=out/cpplint_cache
+
     cpplint.py supports per-directory configurations specified in CPPLINT.cfg
     files. CPPLINT.cfg file can contain a number of key=value pairs.
     Currently the following options are supported:
@@ -813,6 +825,10 @@ _valid_extensions = set(['cc', 'h', 'cpp', 'cu', 'cuh'])
 # category should be suppressed for every line.
 _global_error_suppressions = {}
 
+# Directory where parsed files are cached across runs, see _GetCleansedLines.
+# This is set by --parse_cache_dir flag.
+_parse_cache_dir = None
+
 
 def ParseNolintSuppressions(filename, raw_line, linenum, error):
     """Updates the global list of line error-suppressions.
@@ -1246,6 +1262,12 @@ def _AddFilters(filters):
     _cpplint_state.AddFilters(filters)
 
 
+def _SetParseCacheDir(path):
+    """Sets the directory where parsed files are cached, or None."""
+    global _parse_cache_dir
+    _parse_cache_dir = path
+
+
 def _BackupFilters():
     """Saves the current filter list to backup storage."""
     _cpplint_state.BackupFilters()
@@ -1666,6 +1688,9 @@ class CleansedLines(object):
     4) lines_without_raw_strings member is same as raw_lines, but with C++11 raw
         strings removed.
     All these members are of <type 'list'>, and of the same length.
+
+    The results of CloseExpression and ReverseCloseExpression are memoized in
+    close_expressions and reverse_close_expressions.
     """
     def __init__(self, lines):
         self.elided = []
@@ -1679,6 +1704,8 @@ class CleansedLines(object):
             elided = self._CollapseStrings(
                 self.lines_without_raw_strings[linenum])
             self.elided.append(CleanseComments(elided))
+        self.close_expressions = {}
+        self.reverse_close_expressions = {}
 
     def NumLines(self):
         """Returns the number of lines represented."""
@@ -1839,10 +1866,8 @@ def CloseExpression(clean_lines, linenum, pos):
     If lines[linenum][pos] points to a '(' or '{' or '[' or '<', finds the
     linenum/pos that correspond to the closing of the expression.
 
-    TODO(unknown): cpplint spends a fair bit of time matching parentheses.
-    Ideally we would want to index all opening and closing parentheses once
-    and have CloseExpression be just a simple lookup, but due to preprocessor
-    tricks, this is not so easy.
+    cpplint spends a fair bit of time matching parentheses, and many checks
+    match the same ones, so results are memoized in clean_lines.
 
     Args:
         clean_lines: A CleansedLines instance containing the file.
@@ -1855,7 +1880,15 @@ def CloseExpression(clean_lines, linenum, pos):
         strings and comments when matching; and the line we return is the
         'cleansed' line at linenum.
     """
+    key = (linenum, pos)
+    result = clean_lines.close_expressions.get(key)
+    if result is None:
+        result = _CloseExpression(clean_lines, linenum, pos)
+        clean_lines.close_expressions[key] = result
+    return result
 
+
+def _CloseExpression(clean_lines, linenum, pos):
     line = clean_lines.elided[linenum]
     if (line[pos] not in '({[<') or Match(r'<[<=]', line[pos:]):
         return (line, clean_lines.NumLines(), -1)
@@ -1970,6 +2003,15 @@ def ReverseCloseExpression(clean_lines, linenum, pos):
         we ignore strings and comments when matching; and the line we
         return is the 'cleansed' line at linenum.
     """
+    key = (linenum, pos)
+    result = clean_lines.reverse_close_expressions.get(key)
+    if result is None:
+        result = _ReverseCloseExpression(clean_lines, linenum, pos)
+        clean_lines.reverse_close_expressions[key] = result
+    return result
+
+
+def _ReverseCloseExpression(clean_lines, linenum, pos):
     line = clean_lines.elided[linenum]
     if line[pos] not in ')}]>':
         return (line, 0, -1)
@@ -6288,7 +6330,7 @@ def ProcessFileData(filename,
     CheckForCopyright(filename, lines, error)
     ProcessGlobalSuppresions(lines)
     RemoveMultiLineComments(filename, lines, error)
-    clean_lines = CleansedLines(lines)
+    clean_lines = _GetCleansedLines(lines)
 
     if file_extension == 'h':
         CheckForHeaderGuard(filename, clean_lines, error)
@@ -6311,6 +6353,153 @@ def ProcessFileData(filename,
 
     CheckForNewlineAtEOF(filename, lines, error)
 
+    _SaveCleansedLines(clean_lines)
+
+
+# Number of parsed files kept in memory by _GetCleansedLines.
+_PARSE_CACHE_SIZE = 64
+# Number of parsed files, and their total size, kept in _parse_cache_dir.
+_PARSE_CACHE_DIR_SIZE = 10000
+_PARSE_CACHE_DIR_MAX_BYTES = 256 * 1024 * 1024
+
+# Parsed files by content hash, most recently used last.
+_parse_cache = collections.OrderedDict()
+_parse_cache_salt = None
+
+
+def _ParseCacheKey(lines):
+    """Returns the key of the parse cache entry for |lines|."""
+    global _parse_cache_salt
+    if _parse_cache_salt is None:
+        # Invalidates entries when the way files are parsed changes.
+        with open(__file__, 'rb') as f:
+            _parse_cache_salt = hashlib.sha256(f.read()).hexdigest()
+    h = hashlib.sha256(_parse_cache_salt.encode('utf-8'))
+    for line in lines:
+        h.update(line.encode('utf-8', 'surrogatepass'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+def _ParseCachePath(key):
+    return os.path.join(_parse_cache_dir, key + '.json')
+
+
+def _GetCleansedLines(lines):
+    """Returns a CleansedLines for |lines|, reusing a previous parse if any.
+
+    Parsed files are cached by content in memory and, if _parse_cache_dir is
+    set, on disk.
+    """
+    key = _ParseCacheKey(lines)
+    cached = _parse_cache.pop(key, None)
+    if cached is None and _parse_cache_dir:
+        cached = _LoadCleansedLines(key, lines)
+    if cached is None:
+        cached = CleansedLines(lines)
+        cached.parse_cache_key = key
+        cached.saved_expressions = None
+    _parse_cache[key] = cached
+    while len(_parse_cache) > _PARSE_CACHE_SIZE:
+        _parse_cache.popitem(last=False)
+
+    # Share the preprocessed lines and the memoized expressions, but not the
+    # raw lines, which belong to the caller.
+    clean_lines = copy.copy(cached)
+    clean_lines.raw_lines = lines
+    return clean_lines
+
+
+def _LoadCleansedLines(key, lines):
+    path = _ParseCachePath(key)
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        # Keeps recently used entries from being pruned.
+        os.utime(path)
+    except (IOError, OSError, ValueError):
+        return None
+    clean_lines = CleansedLines.__new__(CleansedLines)
+    clean_lines.raw_lines = lines
+    clean_lines.num_lines = len(lines)
+    clean_lines.lines_without_raw_strings = data['lines_without_raw_strings']
+    clean_lines.lines = data['lines']
+    clean_lines.elided = data['elided']
+    for attr in ('close_expressions', 'reverse_close_expressions'):
+        expressions = {}
+        for linenum, pos, end_linenum, end_pos, line in data[attr]:
+            if line is None:
+                line = clean_lines.elided[end_linenum]
+            expressions[(linenum, pos)] = (line, end_linenum, end_pos)
+        setattr(clean_lines, attr, expressions)
+    clean_lines.parse_cache_key = key
+    clean_lines.saved_expressions = (len(clean_lines.close_expressions) +
+                                     len(clean_lines.reverse_close_expressions))
+    return clean_lines
+
+
+def _SaveCleansedLines(clean_lines):
+    """Writes |clean_lines| to _parse_cache_dir if it has anything new."""
+    num_expressions = (len(clean_lines.close_expressions) +
+                       len(clean_lines.reverse_close_expressions))
+    if (not _parse_cache_dir
+            or clean_lines.saved_expressions == num_expressions):
+        return
+    data = {
+        'lines_without_raw_strings': clean_lines.lines_without_raw_strings,
+        'lines': clean_lines.lines,
+        'elided': clean_lines.elided,
+    }
+    for attr in ('close_expressions', 'reverse_close_expressions'):
+        expressions = []
+        for (linenum, pos), (line, end_linenum,
+                             end_pos) in getattr(clean_lines, attr).items():
+            # The line is usually the elided line at end_linenum; don't store
+            # it twice.
+            if (end_linenum < clean_lines.NumLines()
+                    and line == clean_lines.elided[end_linenum]):
+                line = None
+            expressions.append((linenum, pos, end_linenum, end_pos, line))
+        data[attr] = expressions
+    path = _ParseCachePath(clean_lines.parse_cache_key)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(_parse_cache_dir):
+            os.makedirs(_parse_cache_dir)
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        return
+    clean_lines.saved_expressions = num_expressions
+    cached = _parse_cache.get(clean_lines.parse_cache_key)
+    if cached is not None:
+        cached.saved_expressions = num_expressions
+
+
+def _PruneParseCacheDir():
+    """Removes the least recently used files from _parse_cache_dir, until it
+    fits in _PARSE_CACHE_DIR_SIZE files and _PARSE_CACHE_DIR_MAX_BYTES."""
+    try:
+        entries = []
+        for name in os.listdir(_parse_cache_dir):
+            if name.endswith('.json'):
+                path = os.path.join(_parse_cache_dir, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        count = len(entries)
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if (count <= _PARSE_CACHE_DIR_SIZE
+                    and total <= _PARSE_CACHE_DIR_MAX_BYTES):
+                break
+            os.remove(path)
+            count -= 1
+            total -= size
+    except (IOError, OSError):
+        pass
+
 
 def ProcessConfigOverrides(filename):
     """Loads the configuration files and processes the config overrides.
@@ -6479,6 +6668,127 @@ def ProcessFile(filename, vlevel, extra_check_functions=[]):
     _RestoreFilters()
 
 
+# Extra check functions used by the worker processes of ProcessFiles.
+_worker_extra_check_functions = []
+
+
+def _GetLintSettings():
+    """Returns the global settings that ProcessFile depends on."""
+    return {
+        'filters': _cpplint_state.filters[:],
+        'output_format': _cpplint_state.output_format,
+        'counting': _cpplint_state.counting,
+        'root': _root,
+        'root_debug': _root_debug,
+        'project_root': _project_root,
+        'line_length': _line_length,
+        'valid_extensions': set(_valid_extensions),
+        'parse_cache_dir': _parse_cache_dir,
+    }
+
+
+def _InitLintWorker(settings, extra_check_functions):
+    """Initializes a worker process of ProcessFiles with the parent's state."""
+    global _root, _root_debug, _project_root, _line_length, _valid_extensions
+    global _worker_extra_check_functions
+    _cpplint_state.filters = settings['filters']
+    _cpplint_state.output_format = settings['output_format']
+    _cpplint_state.counting = settings['counting']
+    _root = settings['root']
+    _root_debug = settings['root_debug']
+    _project_root = settings['project_root']
+    _line_length = settings['line_length']
+    _valid_extensions = settings['valid_extensions']
+    _SetParseCacheDir(settings['parse_cache_dir'])
+    _worker_extra_check_functions = extra_check_functions
+
+
+def _LintFileInWorker(args):
+    """Lints a single file in a worker process of ProcessFiles.
+
+    Returns:
+        The output of the linter, the number of errors and the number of errors
+        by category.
+    """
+    global _line_length
+    filename, vlevel = args
+    line_length = _line_length
+    _cpplint_state.ResetErrorCounts()
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        ProcessFile(filename, vlevel, _worker_extra_check_functions)
+        output = sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
+        _line_length = line_length
+    return (output, _cpplint_state.error_count,
+            _cpplint_state.errors_by_category)
+
+
+def ProcessFiles(filenames, vlevel, extra_check_functions=[], jobs=None):
+    """Does google-lint on several files, using up to |jobs| processes.
+
+    The output and the error counts are the same as calling ProcessFile on each
+    file in order, regardless of the number of jobs. Unlike ProcessFile, a
+    "linelength" set by a CPPLINT.cfg only applies to the file being processed.
+
+    Args:
+        filenames: The names of the files to parse.
+
+        vlevel: The level of errors to report.  Every error of confidence
+        >= verbose_level will be reported.  0 is a good default.
+
+        extra_check_functions: An array of additional check functions that will be
+            run on each source line. They must be picklable when jobs > 1. Each
+            function takes 4 arguments: filename, clean_lines, line, error
+
+        jobs: The number of processes to use. Defaults to the number of CPUs.
+    """
+    global _line_length
+    jobs = min(jobs or multiprocessing.cpu_count(), len(filenames))
+    if sys.platform == 'win32':
+        # TODO(crbug.com/1190269) - we can't use more than 56 child
+        # processes on Windows or Python3 may hang.
+        jobs = min(jobs, 56)
+
+    if jobs <= 1:
+        for filename in filenames:
+            line_length = _line_length
+            ProcessFile(filename, vlevel, extra_check_functions)
+            _line_length = line_length
+    else:
+        _ProcessFilesInPool(filenames, vlevel, extra_check_functions, jobs)
+
+    if _parse_cache_dir:
+        _PruneParseCacheDir()
+
+
+def _ProcessFilesInPool(filenames, vlevel, extra_check_functions, jobs):
+    pool = multiprocessing.Pool(jobs,
+                                initializer=_InitLintWorker,
+                                initargs=(_GetLintSettings(),
+                                          extra_check_functions))
+    try:
+        # imap() yields results in the order of |filenames|, so the output
+        # is the same as the one of a serial run.
+        results = pool.imap(_LintFileInWorker,
+                            [(filename, vlevel) for filename in filenames],
+                            chunksize=max(1,
+                                          len(filenames) // (jobs * 4)))
+        for output, error_count, errors_by_category in results:
+            sys.stderr.write(output)
+            _cpplint_state.error_count += error_count
+            for category, count in errors_by_category.items():
+                _cpplint_state.errors_by_category[category] = (
+                    _cpplint_state.errors_by_category.get(category, 0) + count)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    _SetVerboseLevel(vlevel)
+
+
 def PrintUsage(message):
     """Prints a brief usage string and exits, optionally with an error message.
 
@@ -6527,7 +6837,8 @@ def ParseArguments(args):
                 'linelength=',
                 'extensions=',
                 'project_root=',
-                'repository='
+                'repository=',
+                'parse_cache_dir=',
             ])
     except getopt.GetoptError as e:
         PrintUsage('Invalid arguments: {}'.format(e))
@@ -6577,6 +6888,8 @@ def ParseArguments(args):
                 _valid_extensions = set(val.split(','))
             except ValueError:
                 PrintUsage('Extensions must be comma separated list.')
+        elif opt == '--parse_cache_dir':
+            _SetParseCacheDir(val)
 
     if not filenames:
         PrintUsage('No files were specified.')
@@ -6601,8 +6914,7 @@ def main():
         codecs.getwriter('utf8'), 'replace')
 
     _cpplint_state.ResetErrorCounts()
-    for filename in filenames:
-        ProcessFile(filename, _cpplint_state.verbose_level)
+    ProcessFiles(filenames, _cpplint_state.verbose_level, jobs=1)
     _cpplint_state.PrintErrorCounts()
 
     sys.exit(_cpplint_state.error_count > 0)
@@ -5,6 +5,7 @@
 """Download files from Google Storage based on SHA1 sums."""
 
 import hashlib
+import http.client
 import optparse
 import os
 import queue
@@ -14,9 +15,14 @@ import shutil
 import stat
 import sys
 import tarfile
+import tempfile
 import threading
 import time
 
+import gcs_archive
+import gcs_http
+import gcs_store
+import stamp_index
 import subprocess2
 
 # Env vars that tempdir can be gotten from; minimally, this
@@ -51,8 +57,9 @@ def construct_migration_file_name(gcs_object_name):
     return f'.{gcs_file_name}{MIGRATION_TOGGLE_FILE_SUFFIX}'
 
 
-def set_executable_bit(output_filename, file_url, gsutil):
-    # Set executable bit.
+def set_executable_bit(output_filename, file_url, gsutil, executable=None):
+    # Set executable bit. |executable| is the object's x-goog-meta-executable
+    # flag if it is already known.
     code, err = 0, ''
     if sys.platform == 'cygwin':
         # Under cygwin, mark all files as executable. The executable flag in
@@ -64,8 +71,10 @@ def set_executable_bit(output_filename, file_url, gsutil):
     elif sys.platform != 'win32':
         # On non-Windows platforms, key off of the custom header
         # "x-goog-meta-executable".
-        code, out, err = gsutil.check_call('stat', file_url)
-        if re.search(r'executable:\s*1', out):
+        if executable is None:
+            code, out, err = gsutil.check_call('stat', file_url)
+            executable = bool(re.search(r'executable:\s*1', out))
+        if executable:
             st = os.stat(output_filename)
             os.chmod(output_filename, st.st_mode | stat.S_IEXEC)
     return code, err
@@ -188,6 +197,14 @@ def get_sha1(filename):
     return sha1.hexdigest()
 
 
+def get_verified_sha1(filename, stamps=None):
+    """Like get_sha1, but trusts the sha1 recorded in |stamps| if |filename|
+    is unchanged since it was hashed."""
+    if stamps:
+        return stamps.digest(filename, 'sha1', get_sha1)
+    return get_sha1(filename)
+
+
 # Download-specific code starts here
 
 
@@ -253,24 +270,50 @@ def enumerate_input(input_filename, directory, recursive, ignore_errors, output,
                           file=sys.stderr)
 
 
-def _validate_tar_file(tar, prefix):
-    def _validate(tarinfo):
-        """Returns false if the tarinfo is something we explicitly forbid."""
-        if tarinfo.issym() or tarinfo.islnk():
-            # For links, check if the destination is valid.
-            if os.path.isabs(tarinfo.linkname):
-                return False
-            link_target = os.path.normpath(
-                os.path.join(os.path.dirname(tarinfo.name), tarinfo.linkname))
-            if not link_target.startswith(prefix):
-                return False
-
-        if ('../' in tarinfo.name or '..\\' in tarinfo.name
-                or not tarinfo.name.startswith(prefix)):
+def _validate_tar_member(tarinfo, prefix):
+    """Returns false if the tarinfo is something we explicitly forbid."""
+    if tarinfo.issym() or tarinfo.islnk():
+        # For links, check if the destination is valid.
+        if os.path.isabs(tarinfo.linkname):
             return False
-        return True
+        link_target = os.path.normpath(
+            os.path.join(os.path.dirname(tarinfo.name), tarinfo.linkname))
+        if not link_target.startswith(prefix):
+            return False
+
+    if ('../' in tarinfo.name or '..\\' in tarinfo.name
+            or not tarinfo.name.startswith(prefix)):
+        return False
+    return True
+
 
-    return all(map(_validate, tar.getmembers()))
+def _validate_tar_file(tar, prefix):
+    return all(
+        _validate_tar_member(tarinfo, prefix) for tarinfo in tar.getmembers())
+
+
+def _extract_to_staging(output_filename, extract_dir, hashes):
+    """Extracts the tarball |output_filename| into a new staging directory next
+    to |extract_dir| while computing |hashes| of it.
+
+    Returns the staging directory and the gcs_archive.Result.
+    """
+    dirname = os.path.dirname(os.path.abspath(output_filename))
+    # If there are long paths inside the tarball we can get extraction errors
+    # on windows due to the 260 path length limit (this includes pwd). Use the
+    # extended path syntax.
+    if sys.platform == 'win32':
+        dirname = '\\\\?\\%s' % dirname
+    prefix = os.path.basename(extract_dir)
+    staging_dir = tempfile.mkdtemp(prefix='.%s.' % prefix, dir=dirname)
+    try:
+        result = gcs_archive.extract(
+            output_filename, staging_dir,
+            lambda tarinfo: _validate_tar_member(tarinfo, prefix), hashes)
+    except BaseException:
+        shutil.rmtree(staging_dir)
+        raise
+    return staging_dir, result
 
 
 def _downloader_worker_thread(thread_num,
@@ -282,7 +325,10 @@ def _downloader_worker_thread(thread_num,
                               ret_codes,
                               verbose,
                               extract,
-                              delete=True):
+                              delete=True,
+                              downloader=None,
+                              store=None,
+                              stamps=None):
     while True:
         input_sha1_sum, output_filename = q.get()
         if input_sha1_sum is None:
@@ -303,7 +349,7 @@ def _downloader_worker_thread(thread_num,
                 continue
             extract_dir = output_filename[:-len('.tar.gz')]
         if os.path.exists(output_filename) and not force:
-            skip = get_sha1(output_filename) == input_sha1_sum
+            skip = get_verified_sha1(output_filename, stamps) == input_sha1_sum
             if extract:
                 # Additional condition for extract:
                 # 1) extract_dir must exist
@@ -346,7 +392,31 @@ def _downloader_worker_thread(thread_num,
         if verbose:
             out_q.put('%d> Downloading %s@%s...' %
                       (thread_num, output_filename, input_sha1_sum))
-        code, _, err = gsutil.check_call('cp', file_url, output_filename)
+        remote_sha1 = executable = None
+        from_store = bool(
+            store
+            and store.materialize('sha1', input_sha1_sum, output_filename))
+        if from_store:
+            # materialize() checked that the object matches its digest.
+            remote_sha1 = input_sha1_sum
+            executable = os.access(output_filename, os.X_OK)
+        if downloader and not from_store:
+            try:
+                result = downloader.download(file_url, output_filename,
+                                             ('sha1', ))
+                remote_sha1 = result.digests['sha1']
+                executable = result.executable
+            except (gcs_http.HttpError, http.client.HTTPException,
+                    OSError) as e:
+                if verbose:
+                    out_q.put('%d> Falling back to gsutil for %s: %s' %
+                              (thread_num, file_url, e))
+        if remote_sha1 is None:
+            code, _, err = gsutil.check_call('cp', file_url, output_filename)
+            if code == 0 and downloader:
+                downloader.discard_partial(output_filename)
+        else:
+            code = 0
         if code != 0:
             if code == 404:
                 out_q.put('%d> File %s for %s does not exist, skipping.' %
@@ -372,57 +442,71 @@ def _downloader_worker_thread(thread_num,
                      (file_url, output_filename, err)))
             continue
 
-        remote_sha1 = get_sha1(output_filename)
+        # The archive is hashed while it is extracted to a staging directory,
+        # which only replaces extract_dir once the sha1 was checked.
+        staging_dir = extract_error = None
+        if extract:
+            try:
+                staging_dir, extracted = _extract_to_staging(
+                    output_filename, extract_dir, () if remote_sha1 else
+                    ('sha1', ))
+                remote_sha1 = remote_sha1 or extracted.digests['sha1']
+            except gcs_archive.InvalidMemberError:
+                extract_error = ('%d> Error: %s contains files outside %s.' %
+                                 (thread_num, output_filename, extract_dir),
+                                 '%s contains invalid entries.' %
+                                 (output_filename))
+            except tarfile.TarError:
+                extract_error = ('%d> Error: %s is not a tar.gz archive.' %
+                                 (thread_num, output_filename),
+                                 '%s is not a tar.gz archive.' %
+                                 (output_filename))
+
+        if remote_sha1 is None:
+            remote_sha1 = get_sha1(output_filename)
         if remote_sha1 != input_sha1_sum:
             msg = (
                 '%d> ERROR remote sha1 (%s) does not match expected sha1 (%s).'
                 % (thread_num, remote_sha1, input_sha1_sum))
             out_q.put(msg)
             ret_codes.put((20, msg))
+            if staging_dir:
+                shutil.rmtree(staging_dir)
+            continue
+        if extract_error:
+            out_q.put(extract_error[0])
+            ret_codes.put((1, extract_error[1]))
             continue
 
         if extract:
-            if not tarfile.is_tarfile(output_filename):
-                out_q.put('%d> Error: %s is not a tar.gz archive.' %
-                          (thread_num, output_filename))
-                ret_codes.put(
-                    (1, '%s is not a tar.gz archive.' % (output_filename)))
-                continue
-            with tarfile.open(output_filename, 'r:gz') as tar:
-                dirname = os.path.dirname(os.path.abspath(output_filename))
-                # If there are long paths inside the tarball we can get
-                # extraction errors on windows due to the 260 path length limit
-                # (this includes pwd). Use the extended path syntax.
-                if sys.platform == 'win32':
-                    dirname = '\\\\?\\%s' % dirname
-                if not _validate_tar_file(tar, os.path.basename(extract_dir)):
-                    out_q.put('%d> Error: %s contains files outside %s.' %
-                              (thread_num, output_filename, extract_dir))
-                    ret_codes.put(
-                        (1, '%s contains invalid entries.' % (output_filename)))
+            if os.path.exists(extract_dir):
+                try:
+                    shutil.rmtree(extract_dir)
+                    out_q.put('%d> Removed %s...' % (thread_num, extract_dir))
+                except OSError:
+                    out_q.put('%d> Warning: Can\'t delete: %s' %
+                              (thread_num, extract_dir))
+                    ret_codes.put((1, 'Can\'t delete %s.' % (extract_dir)))
+                    shutil.rmtree(staging_dir)
                     continue
-                if os.path.exists(extract_dir):
-                    try:
-                        shutil.rmtree(extract_dir)
-                        out_q.put('%d> Removed %s...' %
-                                  (thread_num, extract_dir))
-                    except OSError:
-                        out_q.put('%d> Warning: Can\'t delete: %s' %
-                                  (thread_num, extract_dir))
-                        ret_codes.put((1, 'Can\'t delete %s.' % (extract_dir)))
-                        continue
-                out_q.put('%d> Extracting %d entries from %s to %s' %
-                          (thread_num, len(
-                              tar.getmembers()), output_filename, extract_dir))
-                with open(extract_dir + '.tmp', 'a'):
-                    tar.extractall(path=dirname)
-                os.remove(extract_dir + '.tmp')
+            out_q.put('%d> Extracting %d entries from %s to %s' %
+                      (thread_num, len(
+                          extracted.members), output_filename, extract_dir))
+            with open(extract_dir + '.tmp', 'a'):
+                gcs_archive.publish(staging_dir, os.path.dirname(staging_dir))
+            os.remove(extract_dir + '.tmp')
         if os.path.exists(migration_file_name):
             os.remove(migration_file_name)
-        code, err = set_executable_bit(output_filename, file_url, gsutil)
+        code, err = set_executable_bit(output_filename, file_url, gsutil,
+                                       executable)
         if code != 0:
             out_q.put('%d> %s' % (thread_num, err))
             ret_codes.put((code, err))
+            continue
+        if store and not from_store:
+            store.add('sha1', input_sha1_sum, output_filename)
+        if stamps:
+            stamps.record(output_filename, 'sha1', input_sha1_sum)
 
 
 class PrinterThread(threading.Thread):
@@ -441,7 +525,7 @@ class PrinterThread(threading.Thread):
             print(line)
 
 
-def _data_exists(input_sha1_sum, output_filename, extract):
+def _data_exists(input_sha1_sum, output_filename, extract, stamps=None):
     """Returns True if the data exists locally and matches the sha1.
 
     This conservatively returns False for error cases.
@@ -455,6 +539,8 @@ def _data_exists(input_sha1_sum, output_filename, extract):
             the file is to be extracted, this only compares the sha1 of the
             target archive if the target directory already exists. The content
             of the target directory is not checked.
+        stamps: An optional StampIndex, to only hash the output file if it
+            changed since it was last verified.
     """
     extract_dir = None
     if extract:
@@ -465,15 +551,27 @@ def _data_exists(input_sha1_sum, output_filename, extract):
         extract_dir = output_filename[:-len('.tar.gz')]
     if os.path.exists(output_filename):
         if not extract or os.path.exists(extract_dir):
-            if get_sha1(output_filename) == input_sha1_sum:
+            if get_verified_sha1(output_filename, stamps) == input_sha1_sum:
                 return True
     return False
 
 
-def download_from_google_storage(input_filename, base_url, gsutil, num_threads,
-                                 directory, recursive, force, output,
-                                 ignore_errors, sha1_file, verbose,
-                                 auto_platform, extract):
+def download_from_google_storage(input_filename,
+                                 base_url,
+                                 gsutil,
+                                 num_threads,
+                                 directory,
+                                 recursive,
+                                 force,
+                                 output,
+                                 ignore_errors,
+                                 sha1_file,
+                                 verbose,
+                                 auto_platform,
+                                 extract,
+                                 downloader=None,
+                                 store=None,
+                                 stamps=None):
 
     # Tuples of sha1s and paths.
     input_data = list(
@@ -506,7 +604,8 @@ def download_from_google_storage(input_filename, base_url, gsutil, num_threads,
             is_first_class_gcs = True
 
     if not force and not is_first_class_gcs and all(
-            _data_exists(sha1, path, extract) for sha1, path in input_data):
+            _data_exists(sha1, path, extract, stamps)
+            for sha1, path in input_data):
         return 0
 
     # Call this once to ensure gsutil's update routine is called only once. Only
@@ -528,7 +627,7 @@ def download_from_google_storage(input_filename, base_url, gsutil, num_threads,
                              args=[
                                  thread_num, work_queue, force, base_url,
                                  gsutil, stdout_queue, ret_codes, verbose,
-                                 extract
+                                 extract, True, downloader, store, stamps
                              ])
         t.daemon = True
         t.start()
@@ -647,6 +746,10 @@ def main(args):
                       'If a directory with the same name as the tar.gz '
                       'file already exists, is deleted (to get a '
                       'clean state in case of update.)')
+    parser.add_option('--paranoid',
+                      action='store_true',
+                      help='Hash existing files even if they are unchanged '
+                      'since they were last verified.')
     parser.add_option('-v',
                       '--verbose',
                       action='store_true',
@@ -751,15 +854,22 @@ def main(args):
 
     base_url = 'gs://%s' % options.bucket
 
+    stamps = stamp_index.GetStampIndex()
+    if stamps and options.paranoid:
+        stamps.paranoid = True
     try:
         return download_from_google_storage(
             input_filename, base_url, gsutil, num_threads, options.directory,
             options.recursive, options.force, options.output,
             options.ignore_errors, options.sha1_file, options.verbose,
-            options.auto_platform, options.extract)
+            options.auto_platform, options.extract, gcs_http.GetDownloader(),
+            gcs_store.GetStore(), stamps)
     except FileNotFoundError as e:
         print("Fatal error: {}".format(e))
         return 1
+    finally:
+        if stamps:
+            stamps.save()
 
 
 if __name__ == '__main__':
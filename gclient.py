@@ -15,6 +15,14 @@
 #   .gclient_entries : A cache constructed by 'update' command.  Format is a
 #                   Python script defining 'entries', a list of the names
 #                   of all modules in the client
+#   .gclient_sync_history : JSON statistics of previous 'sync' runs, per
+#                   module, used to order work and pick the default --jobs.
+#   .gclient_hooks_state : JSON digests of the hooks declaring "inputs" that
+#                   last ran successfully, used to skip them when unchanged.
+#   .gclient_deps_cache : JSON cache of the parsed and validated DEPS files,
+#                   keyed by a hash of their content and variables.
+#   .gclient_flatten_state : JSON revisions pinned by the last
+#                   'flatten --reuse-pins' run, reused for unmoved checkouts.
 #   <module>/DEPS : Python script defining var 'deps' as a map from each
 #                   requisite submodule name to a URL where it can be found (via
 #                   one SCM)
@@ -44,6 +52,19 @@
 #                will be extended by the list of matching files.
 #     "name"     An optional string specifying the group to which a hook belongs
 #                for overriding and organizing.
+#     "requires" An optional list of names of hooks listed before this one
+#                that must have run before it. Hooks declaring "requires" or
+#                "resources" don't wait for the other hooks and may run in
+#                parallel (see --jobs). Hooks declaring neither run in order,
+#                after all the hooks listed before them and before all the
+#                hooks listed after them.
+#     "resources" An optional list of strings. Hooks sharing a resource never
+#                run at the same time.
+#     "inputs"   An optional list of paths of files, relative to the hook's
+#                working directory, read by the hook. A hook declaring "inputs"
+#                is skipped when its action, working directory, condition,
+#                variables and the content of its inputs are the same as in its
+#                last successful run, unless --force-hooks is passed.
 #
 #   Example:
 #     hooks = [
@@ -52,6 +73,11 @@
 #       { "pattern": ".",
 #         "name": "gyp",
 #         "action":  ["python", "src/build/gyp_chromium"]},
+#       { "name": "sysroot_x64",
+#         "requires": [],
+#         "resources": ["network"],
+#         "inputs": ["src/build/linux/sysroot_scripts/sysroots.json"],
+#         "action":  ["python", "src/build/install-sysroot.py", "--arch=x64"]},
 #     ]
 #
 # Pre-DEPS Hooks
@@ -81,8 +107,10 @@
 
 __version__ = '0.7'
 
+import collections
 import copy
 import hashlib
+import http.client
 import json
 import logging
 import optparse
@@ -95,6 +123,7 @@ import sys
 import shutil
 import tarfile
 import tempfile
+import threading
 import time
 import urllib.parse
 
@@ -107,11 +136,15 @@ import gclient_eval
 import gclient_paths
 import gclient_scm
 import gclient_utils
+import gcs_archive
+import gcs_http
+import gcs_store
 import git_cache
 import metrics
 import metrics_utils
 import scm as scm_git
 import setup_color
+import stamp_index
 import subcommand
 import subprocess2
 import upload_to_google_storage_first_class
@@ -131,6 +164,10 @@ PREVIOUS_SYNC_COMMITS_FILE = '.gclient_previous_sync_commits'
 
 PREVIOUS_SYNC_COMMITS = 'GCLIENT_PREVIOUS_SYNC_COMMITS'
 
+# Upper bound for the --jobs value derived from the sync history, as a
+# multiple of the number of local CPUs. Syncing is mostly network bound.
+SYNC_HISTORY_MAX_JOBS_PER_CPU = 4
+
 NO_SYNC_EXPERIMENT = 'no-sync'
 
 PRECOMMIT_HOOK_VAR = 'GCLIENT_PRECOMMIT'
@@ -159,6 +196,121 @@ def ToGNString(value):
     raise GNException("Unsupported type when printing to GN.")
 
 
+def _GitPackSize(checkout_path):
+    """Returns the total size of the git packs of a checkout, in bytes."""
+    pack_dir = os.path.join(checkout_path, '.git', 'objects', 'pack')
+    try:
+        return sum(e.stat().st_size for e in os.scandir(pack_dir)
+                   if e.name.endswith('.pack'))
+    except OSError:
+        return 0
+
+
+class SyncHistory(object):
+    """Per-dependency statistics of previous syncs.
+
+    Records how long each dependency took to sync, how many bytes it fetched
+    and how many times it failed, so that the next sync can start the
+    dependencies on the longest chain first and pick a default number of jobs.
+    The history lives in a JSON file next to .gclient_entries.
+    """
+
+    # Weight of the latest run in the smoothed duration.
+    SMOOTHING = 0.5
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if not os.path.exists(path):
+            return
+        try:
+            content = json.loads(gclient_utils.FileRead(path))
+            if isinstance(content, dict):
+                self.entries = content.get('deps', {})
+        except (IOError, ValueError) as e:
+            logging.warning('Ignoring invalid sync history %s: %s', path, e)
+
+    def record(self, dep):
+        # type: (Dependency) -> None
+        """Records the outcome of |dep| in the latest sync."""
+        if not dep.name or not dep.start:
+            return
+        entry = self.entries.setdefault(dep.name, {
+            'duration': None,
+            'bytes_fetched': 0,
+            'failures': 0,
+            'runs': 0,
+        })
+        entry['parent'] = dep.parent.name if dep.parent else None
+        entry['runs'] += 1
+        if not dep.finish:
+            entry['failures'] += 1
+            return
+        duration = (dep.finish - dep.start).total_seconds()
+        if entry['duration'] is None:
+            entry['duration'] = duration
+        else:
+            entry['duration'] = (self.SMOOTHING * duration +
+                                 (1 - self.SMOOTHING) * entry['duration'])
+        entry['bytes_fetched'] = dep.bytes_fetched
+
+    def estimates(self):
+        # type: () -> Mapping[str, float]
+        """Returns the estimated critical path, in seconds, of each dependency.
+
+        The critical path of a dependency is its own duration plus the longest
+        critical path among the dependencies that it brought in last time.
+        """
+        children = {}
+        for name, entry in self.entries.items():
+            children.setdefault(entry.get('parent'), []).append(name)
+        result = {}
+
+        def critical_path(name):
+            if name not in result:
+                # Guard against cycles in a corrupted history.
+                result[name] = 0
+                result[name] = (self.entries[name].get('duration') or 0) + max(
+                    [critical_path(c) for c in children.get(name, [])] or [0])
+            return result[name]
+
+        for name in self.entries:
+            critical_path(name)
+        return result
+
+    def suggest_jobs(self, default):
+        # type: (int) -> int
+        """Returns the number of jobs to use given the recorded durations.
+
+        The average parallelism available is the total work divided by the
+        longest chain. The default is never lowered.
+        """
+        estimates = self.estimates()
+        longest = max(estimates.values() or [0])
+        total = sum(e.get('duration') or 0 for e in self.entries.values())
+        if not longest or not total:
+            return default
+        parallelism = int(total / longest + 0.5)
+        limit = min(
+            len(self.entries),
+            SYNC_HISTORY_MAX_JOBS_PER_CPU * gclient_utils.NumLocalCpus())
+        return max(default, min(parallelism, limit))
+
+    def save(self, names=None):
+        # type: (Optional[Iterable[str]]) -> None
+        """Writes the history. If |names| is given, the entries of the
+        dependencies which are not among them are dropped first."""
+        if names is not None:
+            names = set(names)
+            self.entries = {
+                name: entry
+                for name, entry in self.entries.items() if name in names
+            }
+        gclient_utils.FileWrite(
+            self.path,
+            json.dumps({'deps': self.entries}, indent=2, sort_keys=True))
+
+
 class Hook(object):
     """Descriptor of command ran before/after sync or on demand."""
     def __init__(self,
@@ -169,7 +321,10 @@ class Hook(object):
                  condition=None,
                  variables=None,
                  verbose=False,
-                 cwd_base=None):
+                 cwd_base=None,
+                 requires=None,
+                 resources=None,
+                 inputs=None):
         """Constructor.
 
     Arguments:
@@ -179,6 +334,11 @@ class Hook(object):
       cwd (str): working directory to use
       condition (str): condition when to run the hook
       variables (dict): variables for evaluating the condition
+      requires (list of str): names of the hooks to run before this one; None
+        if the hook must run in order with all the others
+      resources (list of str): hooks sharing a resource don't run concurrently
+      inputs (list of str): files read by the hook, relative to its cwd; None
+        if the hook must run every time
     """
         self._action = gclient_utils.freeze(action)
         self._pattern = pattern
@@ -188,6 +348,9 @@ class Hook(object):
         self._variables = variables
         self._verbose = verbose
         self._cwd_base = cwd_base
+        self._requires = requires
+        self._resources = resources
+        self._inputs = inputs
 
     @staticmethod
     def from_dict(d,
@@ -207,7 +370,10 @@ class Hook(object):
             variables=variables,
             # Always print the header if not printing to a TTY.
             verbose=verbose or not setup_color.IS_TTY,
-            cwd_base=cwd_base)
+            cwd_base=cwd_base,
+            requires=d.get('requires'),
+            resources=d.get('resources'),
+            inputs=d.get('inputs'))
 
     @property
     def action(self):
@@ -225,6 +391,23 @@ class Hook(object):
     def condition(self):
         return self._condition
 
+    @property
+    def requires(self):
+        return self._requires
+
+    @property
+    def resources(self):
+        return self._resources
+
+    @property
+    def ordered(self):
+        """Whether the hook must run in order with all the other hooks."""
+        return self._requires is None and self._resources is None
+
+    @property
+    def inputs(self):
+        return self._inputs
+
     @property
     def effective_cwd(self):
         cwd = self._cwd_base
@@ -239,12 +422,51 @@ class Hook(object):
         pattern = re.compile(self._pattern)
         return bool([f for f in file_list if pattern.search(f)])
 
-    def run(self):
-        """Executes the hook's command (provided the condition is met)."""
+    def digest(self):
+        """Returns a digest of everything the hook declares it depends on."""
+        inputs = {}
+        for path in self._inputs or []:
+            sha = hashlib.sha256()
+            try:
+                with open(os.path.join(self.effective_cwd, path), 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        sha.update(chunk)
+                inputs[path] = sha.hexdigest()
+            except (IOError, OSError):
+                inputs[path] = None
+        variables = {
+            name: str(value)
+            for name, value in (self._variables or {}).items()
+        }
+        return hashlib.sha256(
+            json.dumps([
+                list(self._action), self.effective_cwd, self._condition,
+                variables, inputs
+            ],
+                       sort_keys=True).encode('utf-8')).hexdigest()
+
+    def run(self, out=None, state=None):
+        """Executes the hook's command (provided the condition is met).
+
+        The output of the command is written to |out| if given, or to stdout.
+        If |state| is given, a hook declaring inputs is skipped when they didn't
+        change since its last successful run, and recorded once it succeeds.
+        """
         if (self._condition and not gclient_eval.EvaluateCondition(
                 self._condition, self._variables)):
             return
 
+        digest = None
+        if state and self._inputs is not None:
+            digest = self.digest()
+            if state.is_current(self, digest):
+                if self._verbose:
+                    print("Skipping hook '%s': unchanged since its last run" %
+                          (self._name
+                           or gclient_utils.CommandToStr(self._action)),
+                          file=out)
+                return
+
         cmd = list(self._action)
 
         if cmd[0] == 'vpython3' and _detect_host_os() == 'win':
@@ -253,12 +475,18 @@ class Hook(object):
         exit_code = 2
         try:
             start_time = time.time()
+            filter_fn = None
+            if out:
+                filter_fn = lambda line: print(line.rstrip('\n'), file=out)
             gclient_utils.CheckCallAndFilter(cmd,
                                              cwd=self.effective_cwd,
-                                             print_stdout=True,
+                                             print_stdout=not out,
+                                             filter_fn=filter_fn,
                                              show_header=True,
                                              always_show_header=self._verbose)
             exit_code = 0
+            if digest:
+                state.record(self, digest)
         except (gclient_utils.Error, subprocess2.CalledProcessError) as e:
             # Use a discrete exit status code of 2 to indicate that a hook
             # action failed.  Users of this script may wish to treat hook action
@@ -285,7 +513,87 @@ class Hook(object):
                 })
             if elapsed_time > 10:
                 print("Hook '%s' took %.2f secs" %
-                      (gclient_utils.CommandToStr(cmd), elapsed_time))
+                      (gclient_utils.CommandToStr(cmd), elapsed_time),
+                      file=out)
+
+
+class HooksState(object):
+    """Digests of the hooks declaring inputs at their last successful run.
+
+    The digests live in a JSON file next to .gclient_entries, keyed by the
+    hook's working directory, name and action. Hooks that were not looked up
+    during a run are dropped when saving.
+
+    Methods of this class are thread safe.
+    """
+    def __init__(self, path, force=False):
+        self.path = path
+        # Whether to run all the hooks regardless of their recorded digests.
+        self.force = force
+        self._lock = threading.Lock()
+        self._digests = {}
+        self._seen = {}
+        if not os.path.exists(path):
+            return
+        try:
+            content = json.loads(gclient_utils.FileRead(path))
+            if isinstance(content, dict):
+                self._digests = content.get('hooks', {})
+        except (IOError, ValueError) as e:
+            logging.warning('Ignoring invalid hooks state %s: %s', path, e)
+
+    @staticmethod
+    def _Key(hook):
+        return json.dumps([hook.effective_cwd, hook.name, list(hook.action)])
+
+    def is_current(self, hook, digest):
+        # type: (Hook, str) -> bool
+        """Returns whether |hook| last succeeded with the same |digest|."""
+        key = self._Key(hook)
+        with self._lock:
+            self._seen.setdefault(key, self._digests.get(key))
+            return not self.force and self._digests.get(key) == digest
+
+    def record(self, hook, digest):
+        # type: (Hook, str) -> None
+        """Records that |hook| succeeded with |digest|."""
+        with self._lock:
+            self._seen[self._Key(hook)] = digest
+
+    def save(self):
+        with self._lock:
+            hooks = {k: v for k, v in self._seen.items() if v is not None}
+        gclient_utils.FileWrite(
+            self.path, json.dumps({'hooks': hooks}, indent=2, sort_keys=True))
+
+
+class HookError(gclient_utils.Error):
+    """A hook run by a HookWorkItem failed."""
+    def __init__(self, exit_code):
+        super(HookError,
+              self).__init__('Hook failed with exit code %s' % exit_code)
+        self.exit_code = exit_code
+
+
+class HookWorkItem(gclient_utils.WorkItem):
+    """Runs one Hook in an ExecutionQueue, buffering its output."""
+    def __init__(self, hook, index, state=None):
+        # The index keeps the names unique when several hooks share a name.
+        super(HookWorkItem,
+              self).__init__('%s #%d' % (hook.name or 'hook', index))
+        self.hook = hook
+        self.index = index
+        self.state = state
+        self.requirements = []
+        self.resources = list(hook.resources or [])
+
+    def run(self, work_queue):
+        try:
+            self.hook.run(out=self.outbuf, state=self.state)
+        except SystemExit as e:
+            # sys.exit() would only end the worker thread; let the queue stop
+            # and report the failure instead.
+            raise HookError(e.code)
 
 
 class DependencySettings(object):
@@ -469,6 +777,8 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
         self._got_revision = None
         # Whether this dependency should use relative paths.
         self._use_relative_paths = False
+        # Number of bytes downloaded by the latest sync, when known.
+        self.bytes_fetched = 0
 
         # recursedeps is a mutable value that selectively overrides the default
         # 'no recursion' setting on a dep-by-dep basis.
@@ -905,9 +1215,11 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
         local_scope = {}
         if deps_content:
             try:
-                local_scope = gclient_eval.Parse(deps_content, filepath,
+                local_scope = gclient_eval.Parse(deps_content,
+                                                 filepath,
                                                  self.get_vars(),
-                                                 self.get_builtin_vars())
+                                                 self.get_builtin_vars(),
+                                                 cache=self.root.GetDepsCache())
             except SyntaxError as e:
                 gclient_utils.SyntaxErrorToError(filepath, e)
 
@@ -1246,8 +1558,12 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
                                 path][1]
                         self._used_scm.current_revision = current_revision
 
+                    pack_size = _GitPackSize(self._used_scm.checkout_path)
                     self._got_revision = self._used_scm.RunCommand(
                         command, options, args, file_list)
+                    self.bytes_fetched = max(
+                        0,
+                        _GitPackSize(self._used_scm.checkout_path) - pack_size)
                     latest_commit = self._got_revision
                     sync_status = metrics_utils.SYNC_STATUS_SUCCESS
                 finally:
@@ -1331,12 +1647,17 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
             if command in ('update', 'revert') and not options.noprehooks:
                 self.RunPreDepsHooks()
             # Parse the dependencies of this dependency.
+            scheduler = getattr(self.root, '_cipd_ensure_scheduler', None)
             for s in self.dependencies:
                 if s.should_process:
+                    if scheduler:
+                        scheduler.add(s)
                     work_queue.enqueue(s)
             gcs_root = self.GetGcsRoot()
             if gcs_root and command == 'update':
                 gcs_root.resolve_objects(self.name)
+            if scheduler:
+                scheduler.processed(self, work_queue)
 
         if command == 'recurse':
             # Skip file only checkout.
@@ -1463,14 +1784,66 @@ class Dependency(gclient_utils.WorkItem, DependencySettings):
         assert self.hooks_ran == False
         self._hooks_ran = True
         hooks = self.GetHooks(options)
-        if progress:
-            progress._total = len(hooks)
-        for hook in hooks:
+        state = None
+        if any(hook.inputs is not None for hook in hooks):
+            state = HooksState(os.path.join(self.root.root_dir,
+                                            options.hooks_state_filename),
+                               force=getattr(options, 'force_hooks', False))
+        try:
+            if options.jobs > 1 and not all(hook.ordered for hook in hooks):
+                self._RunHooksInParallel(hooks, options, progress, state)
+                return
             if progress:
-                progress.update(extra=hook.name or '')
-            hook.run()
-        if progress:
-            progress.end()
+                progress._total = len(hooks)
+            for hook in hooks:
+                if progress:
+                    progress.update(extra=hook.name or '')
+                hook.run(state=state)
+            if progress:
+                progress.end()
+        finally:
+            # Keep the hooks that succeeded even if another one failed.
+            if state:
+                state.save()
+
+    def _RunHooksInParallel(self, hooks, options, progress, state=None):
+        """Runs |hooks| on up to options.jobs threads, honoring the order of
+        the ordered hooks and the requires and resources of the others."""
+        work_queue = gclient_utils.ExecutionQueue(options.jobs,
+                                                  progress,
+                                                  ignore_requirements=False,
+                                                  verbose=True)
+        items = []
+        names = collections.defaultdict(list)
+        for index, hook in enumerate(hooks):
+            item = HookWorkItem(hook, index, state)
+            items.append(item)
+            names[hook.name].append(item)
+        # The last ordered hook, and the hooks listed since then.
+        barrier = None
+        unordered = []
+        for item in items:
+            hook = item.hook
+            if hook.ordered:
+                item.requirements.extend(i.name for i in unordered)
+                unordered = []
+            else:
+                for name in hook.requires or []:
+                    # Hooks that are not run, e.g. suppressed by custom_hooks,
+                    # are ignored.
+                    item.requirements.extend(i.name
+                                             for i in names.get(name, [])
+                                             if i.index < item.index)
+                unordered.append(item)
+            if barrier:
+                item.requirements.append(barrier.name)
+            if hook.ordered:
+                barrier = item
+            work_queue.enqueue(item)
+        try:
+            work_queue.flush()
+        except HookError as e:
+            sys.exit(e.exit_code)
 
     def RunPreDepsHooks(self):
         assert self.processed
@@ -1743,6 +2116,100 @@ class GitDependency(Dependency):
                                       print_outbuf=self.print_outbuf)
 
 
+class CipdEnsureWorkItem(gclient_utils.WorkItem):
+    """Runs `cipd ensure` for a CipdRoot as part of an ExecutionQueue."""
+    def __init__(self, cipd_root, requirements):
+        super(CipdEnsureWorkItem, self).__init__('cipd ensure')
+        self.cipd_root = cipd_root
+        self.requirements = requirements
+
+    def run(self, *_args, **_kwargs):
+        self.cipd_root.run('update')
+
+
+class CipdEnsureScheduler(object):
+    """Starts `cipd ensure` while the git dependencies are still syncing.
+
+    All the CIPD packages must be known before running `cipd ensure`, since it
+    removes the packages missing from its ensure file. They are known once
+    every dependency that recurses has parsed its DEPS file, which usually
+    happens well before the last git dependency is synced. At that point, a
+    CipdEnsureWorkItem waiting on every CipdDependency is added to the queue.
+
+    The ensure is left for after the sync, as before, when a CIPD path overlaps
+    a git dependency that the sync removes, or a CIPD package that it removes
+    overlaps a git dependency, because the git directories must be deleted
+    first and CIPD must not touch a directory that git is checking out.
+
+    Methods of this class are thread safe.
+    """
+    def __init__(self, client, previous_entries):
+        # type: (GClient, Mapping[str, str]) -> None
+        self._client = client
+        self._previous_entries = previous_entries
+        self._lock = threading.Lock()
+        # Dependencies that may still add CIPD packages.
+        self._pending = set()
+        self._scheduled = False
+        # The CipdEnsureWorkItem, if the ensure was started during the sync.
+        self.item = None
+
+    def add(self, dep):
+        """Tracks |dep|, about to be enqueued."""
+        if dep.should_process and dep.should_recurse:
+            with self._lock:
+                self._pending.add(dep)
+
+    def processed(self, dep, work_queue):
+        """Called once |dep| ran and enqueued its own dependencies."""
+        with self._lock:
+            self._pending.discard(dep)
+            if self._pending or self._scheduled:
+                return
+            self._scheduled = True
+        cipd_root = self._client._cipd_root
+        if not cipd_root:
+            return
+        subtree = list(self._client.subtree(False))
+        cipd_deps = [
+            d for d in subtree
+            if isinstance(d, CipdDependency) and d.should_process
+        ]
+        if not cipd_deps or self._HasConflicts(subtree):
+            return
+        self.item = CipdEnsureWorkItem(cipd_root, [d.name for d in cipd_deps])
+        work_queue.enqueue(self.item)
+
+    @staticmethod
+    def _Overlaps(paths, others):
+        for path in paths:
+            for other in others:
+                if (path == other or path.startswith(other + '/')
+                        or other.startswith(path + '/')):
+                    return True
+        return False
+
+    def _HasConflicts(self, subtree):
+        names = set(d.name for d in subtree if d.url)
+        git_paths = set(
+            d.name for d in subtree
+            if d.url and not isinstance(d, (CipdDependency, GcsDependency)))
+        cipd_paths = set(
+            d.name.split(':')[0] for d in subtree
+            if isinstance(d, CipdDependency))
+        removed_git_paths = set()
+        removed_cipd_paths = set()
+        for entry, url in self._previous_entries.items():
+            if not url or entry in names:
+                continue
+            if ':' in entry:
+                removed_cipd_paths.add(entry.split(':')[0])
+            else:
+                removed_git_paths.add(entry)
+        return (self._Overlaps(removed_git_paths, cipd_paths)
+                or self._Overlaps(removed_cipd_paths, git_paths))
+
+
 class GClient(GitDependency):
     """Object that represent a gclient checkout. A tree of Dependency(), one per
   solution or DEPS entry."""
@@ -1817,6 +2284,9 @@ solutions = %(solution_list)s
         self._root_dir = root_dir
         self._cipd_root = None
         self._gcs_root = None
+        self._sync_history = None
+        self._deps_cache = None
+        self._cipd_ensure_scheduler = None
         self.config_content = None
 
     def _CheckConfig(self):
@@ -2031,6 +2501,23 @@ it or fix the checkout.
             gclient_utils.SyntaxErrorToError(filename, e)
         return scope.get('entries', {})
 
+    def GetSyncHistory(self):
+        # type: () -> SyncHistory
+        """Returns the history of previous syncs of this client."""
+        if self._sync_history is None:
+            self._sync_history = SyncHistory(
+                os.path.join(self.root_dir,
+                             self._options.sync_history_filename))
+        return self._sync_history
+
+    def GetDepsCache(self):
+        # type: () -> gclient_eval.ParseCache
+        """Returns the cache of the DEPS files parsed in this client."""
+        if self._deps_cache is None:
+            self._deps_cache = gclient_eval.ParseCache(
+                os.path.join(self.root_dir, self._options.deps_cache_filename))
+        return self._deps_cache
+
     def _ExtractFileJsonContents(self, default_filename):
         # type: (str) -> Mapping[str,Any]
         f = os.path.join(self.root_dir, default_filename)
@@ -2423,21 +2910,45 @@ it or fix the checkout.
                 pm = Progress('Syncing projects', 1)
             elif command in ('recurse', 'validate'):
                 pm = Progress(' '.join(args), 1)
+        sync_history = None
+        if command == 'update':
+            sync_history = self.GetSyncHistory()
         work_queue = gclient_utils.ExecutionQueue(
             self._options.jobs,
             pm,
             ignore_requirements=ignore_requirements,
-            verbose=self._options.verbose)
+            verbose=self._options.verbose,
+            estimates=sync_history.estimates() if sync_history else None)
+        self._cipd_ensure_scheduler = None
+        if command == 'update':
+            self._cipd_ensure_scheduler = CipdEnsureScheduler(
+                self, self._ReadEntries())
         for s in self.dependencies:
             if s.should_process:
+                if self._cipd_ensure_scheduler:
+                    self._cipd_ensure_scheduler.add(s)
                 work_queue.enqueue(s)
-        work_queue.flush(revision_overrides,
-                         command,
-                         args,
-                         options=self._options,
-                         patch_refs=patch_refs,
-                         target_branches=target_branches,
-                         skip_sync_revisions=skip_sync_revisions)
+        synced = False
+        try:
+            work_queue.flush(revision_overrides,
+                             command,
+                             args,
+                             options=self._options,
+                             patch_refs=patch_refs,
+                             target_branches=target_branches,
+                             skip_sync_revisions=skip_sync_revisions)
+            synced = True
+        finally:
+            if sync_history:
+                for dep in self.subtree(False):
+                    sync_history.record(dep)
+                # The tree is only complete if the sync went through; keep
+                # the entries of the dependencies that were not reached.
+                sync_history.save(
+                    [dep.name
+                     for dep in self.subtree(True)] if synced else None)
+            if self._deps_cache:
+                self._deps_cache.save()
 
         if revision_overrides:
             print(
@@ -2482,9 +2993,13 @@ it or fix the checkout.
 
         # Sync CIPD dependencies once removed deps are deleted. In case a git
         # dependency was moved to CIPD, we want to remove the old git directory
-        # first and then sync the CIPD dep.
+        # first and then sync the CIPD dep. Otherwise, they may have been synced
+        # already along with the git dependencies.
+        ensured = (self._cipd_ensure_scheduler
+                   and self._cipd_ensure_scheduler.item)
         if self._cipd_root:
-            self._cipd_root.run(command)
+            if not ensured:
+                self._cipd_root.run(command)
             # It's possible that CIPD removed some entries that are now part of
             # git worktree. Try to checkout those directories
             if removed_cipd_entries:
@@ -2747,9 +3262,17 @@ class GcsDependency(Dependency):
 
         if existing_hash != self.sha256sum:
             return True
+
+        # The hash file is trusted unless asked to verify the artifact.
+        if os.environ.get(stamp_index.PARANOID_ENV_VAR) == '1':
+            calculated_sha256sum = (
+                upload_to_google_storage_first_class.get_sha256sum(
+                    self.artifact_output_file))
+            if calculated_sha256sum != self.sha256sum:
+                return True
         return False
 
-    def ValidateTarFile(self, tar, prefixes):
+    def ValidateTarFile(self, members, prefixes):
 
         def _validate(tarinfo):
             """Returns false if the tarinfo is something we explicitly forbid."""
@@ -2776,7 +3299,75 @@ class GcsDependency(Dependency):
                 return False
             return True
 
-        return all(map(_validate, tar.getmembers()))
+        return all(map(_validate, members))
+
+    def _VerifyAndExtract(self, result, staging_dir):
+        """Checks the downloaded artifact and, if |staging_dir| is set,
+        extracts it there and then into output_dir.
+
+        |result| is the gcs_http.Result of the download, if any.
+        """
+        extracted = None
+        if staging_dir:
+            try:
+                extracted = gcs_archive.extract(self.artifact_output_file,
+                                                staging_dir,
+                                                hashes=() if result else
+                                                ('sha256', ))
+            except gcs_archive.InvalidMemberError:
+                raise Exception('tarfile contains invalid entries')
+
+        calculated_sha256sum = ''
+        calculated_size_bytes = None
+        if os.getenv('GCLIENT_TEST') == '1':
+            calculated_sha256sum = 'abcd123'
+            calculated_size_bytes = 10000
+        elif result or extracted:
+            calculated_sha256sum = (result or extracted).digests['sha256']
+            calculated_size_bytes = (result or extracted).size
+        else:
+            calculated_sha256sum = (
+                upload_to_google_storage_first_class.get_sha256sum(
+                    self.artifact_output_file))
+            calculated_size_bytes = os.path.getsize(self.artifact_output_file)
+        self.bytes_fetched = calculated_size_bytes
+
+        if calculated_sha256sum != self.sha256sum:
+            raise Exception('sha256sum does not match calculated hash. '
+                            '{original} vs {calculated}'.format(
+                                original=self.sha256sum,
+                                calculated=calculated_sha256sum,
+                            ))
+
+        if calculated_size_bytes != self.size_bytes:
+            raise Exception('size_bytes does not match calculated size bytes. '
+                            '{original} vs {calculated}'.format(
+                                original=self.size_bytes,
+                                calculated=calculated_size_bytes,
+                            ))
+
+        if extracted:
+            names = [tarinfo.name for tarinfo in extracted.members]
+            formatted_names = []
+            for name in names:
+                if name.startswith('./') and len(name) > 2:
+                    formatted_names.append(name[2:])
+                else:
+                    formatted_names.append(name)
+            possible_top_level_dirs = set(
+                name.split('/')[0] for name in formatted_names)
+            is_valid_tar = self.ValidateTarFile(extracted.members,
+                                                possible_top_level_dirs)
+            if not is_valid_tar:
+                raise Exception('tarfile contains invalid entries')
+
+            tar_content_file = os.path.join(
+                self.output_dir, f'.{self.file_prefix}_content_names')
+            self.WriteToFile(json.dumps(names), tar_content_file)
+
+            gcs_archive.publish(staging_dir, self.output_dir)
+
+        return calculated_sha256sum
 
     def DownloadGoogleStorage(self):
         """Calls GCS."""
@@ -2799,6 +3390,10 @@ class GcsDependency(Dependency):
 
         gsutil = download_from_google_storage.Gsutil(
             download_from_google_storage.GSUTIL_DEFAULT_PATH)
+        # Filled in if the object is fetched by gcs_http or from the store.
+        result = None
+        store = None
+        from_store = False
         if os.getenv('GCLIENT_TEST') == '1':
             if 'no-extract' in self.artifact_output_file:
                 with open(self.artifact_output_file, 'w+') as f:
@@ -2816,66 +3411,61 @@ class GcsDependency(Dependency):
                 with tarfile.open(self.artifact_output_file, "w:gz") as tar:
                     tar.add(copy_dir, arcname=os.path.basename(copy_dir))
         else:
-            code, _, err = gsutil.check_call('cp', self.url,
-                                             self.artifact_output_file)
-            if code and err:
-                raise Exception(f'{code}: {err}')
+            store = gcs_store.GetStore()
+            if store and store.materialize('sha256', self.sha256sum,
+                                           self.artifact_output_file,
+                                           self.size_bytes):
+                # materialize() checked that the object matches its digest.
+                from_store = True
+                result = gcs_http.Result(size=self.size_bytes,
+                                         etag=None,
+                                         executable=os.access(
+                                             self.artifact_output_file,
+                                             os.X_OK),
+                                         digests={'sha256': self.sha256sum})
+            downloader = gcs_http.GetDownloader()
+            if downloader and not result:
+                try:
+                    result = downloader.download(self.url,
+                                                 self.artifact_output_file)
+                except (gcs_http.HttpError, http.client.HTTPException,
+                        OSError) as e:
+                    logging.info('Falling back to gsutil for %s: %s', self.url,
+                                 e)
+            if not result:
+                code, _, err = gsutil.check_call('cp', self.url,
+                                                 self.artifact_output_file)
+                if code and err:
+                    raise Exception(f'{code}: {err}')
+                if downloader:
+                    downloader.discard_partial(self.artifact_output_file)
             # Check that something actually downloaded into the path
             if not os.path.exists(self.artifact_output_file):
                 raise Exception(
                     f'Nothing was downloaded into {self.artifact_output_file}')
 
-        calculated_sha256sum = ''
-        calculated_size_bytes = None
-        if os.getenv('GCLIENT_TEST') == '1':
-            calculated_sha256sum = 'abcd123'
-            calculated_size_bytes = 10000
-        else:
-            calculated_sha256sum = (
-                upload_to_google_storage_first_class.get_sha256sum(
-                    self.artifact_output_file))
-            calculated_size_bytes = os.path.getsize(self.artifact_output_file)
-
-        if calculated_sha256sum != self.sha256sum:
-            raise Exception('sha256sum does not match calculated hash. '
-                            '{original} vs {calculated}'.format(
-                                original=self.sha256sum,
-                                calculated=calculated_sha256sum,
-                            ))
-
-        if calculated_size_bytes != self.size_bytes:
-            raise Exception('size_bytes does not match calculated size bytes. '
-                            '{original} vs {calculated}'.format(
-                                original=self.size_bytes,
-                                calculated=calculated_size_bytes,
-                            ))
-
-        if tarfile.is_tarfile(self.artifact_output_file):
-            with tarfile.open(self.artifact_output_file, 'r:*') as tar:
-                formatted_names = []
-                for name in tar.getnames():
-                    if name.startswith('./') and len(name) > 2:
-                        formatted_names.append(name[2:])
-                    else:
-                        formatted_names.append(name)
-                possible_top_level_dirs = set(
-                    name.split('/')[0] for name in formatted_names)
-                is_valid_tar = self.ValidateTarFile(tar,
-                                                    possible_top_level_dirs)
-                if not is_valid_tar:
-                    raise Exception('tarfile contains invalid entries')
-
-                tar_content_file = os.path.join(
-                    self.output_dir, f'.{self.file_prefix}_content_names')
-                self.WriteToFile(json.dumps(tar.getnames()), tar_content_file)
-
-                tar.extractall(path=self.output_dir)
+        # Archives are hashed while they are extracted to a staging directory,
+        # which is only moved into output_dir once everything was checked.
+        staging_dir = None
+        if gcs_archive.is_archive(self.artifact_output_file):
+            staging_dir = tempfile.mkdtemp(prefix=f'.{self.file_prefix}_',
+                                           dir=self.output_dir)
+        try:
+            calculated_sha256sum = self._VerifyAndExtract(result, staging_dir)
+        finally:
+            if staging_dir and os.path.exists(staging_dir):
+                gclient_utils.rmtree(staging_dir)
+        if from_store:
+            self.bytes_fetched = 0
 
         if os.getenv('GCLIENT_TEST') != '1':
             code, err = download_from_google_storage.set_executable_bit(
-                self.artifact_output_file, self.url, gsutil)
+                self.artifact_output_file, self.url, gsutil,
+                result.executable if result else None)
             if code != 0:
                 raise Exception(f'{code}: {err}')
+        if store and not from_store:
+            store.add('sha256', calculated_sha256sum, self.artifact_output_file)
 
         self.WriteToFile(calculated_sha256sum, self.hash_file)
         self.WriteToFile(str(1), self.migration_toggle_file)
@@ -3097,17 +3687,110 @@ def CMDfetch(parser, args):
         ['--jobs=%d' % options.jobs, '--scm=git', 'git', 'fetch'] + args)
 
 
+def _GitHeadSignature(checkout_path):
+    """Returns the stat signature of the files which HEAD of the git checkout
+    at |checkout_path| resolves through, or None if it can't be computed
+    without running git."""
+    git_dir = os.path.join(checkout_path, '.git')
+    # Worktrees and reftable repositories keep their refs elsewhere.
+    if (not os.path.isdir(git_dir)
+            or os.path.exists(os.path.join(git_dir, 'commondir'))
+            or os.path.exists(os.path.join(git_dir, 'reftable'))):
+        return None
+    try:
+        head = gclient_utils.FileRead(os.path.join(git_dir, 'HEAD')).strip()
+    except (IOError, UnicodeDecodeError):
+        return None
+    paths = ['HEAD', 'packed-refs']
+    if head.startswith('ref: '):
+        paths.append(head[len('ref: '):])
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(os.path.join(git_dir, path))
+            signature.append([path, st.st_size, st.st_mtime_ns, st.st_ino])
+        except FileNotFoundError:
+            signature.append([path, None])
+    return signature
+
+
+class FlattenState(object):
+    """Revisions pinned by the previous 'flatten --reuse-pins' run.
+
+    Pinning a git dependency runs git in its checkout. The pinned URL of each
+    git dependency is recorded along with its URL in DEPS and the signature of
+    its HEAD, and reused as long as neither changed. The dependencies named in
+    |changed|, and the ones below them, are always pinned again.
+    The state lives in a JSON file next to .gclient_entries.
+    """
+    def __init__(self, path, changed=()):
+        self.path = path
+        self.changed = set(changed)
+        self._pinned = {}
+        self._seen = {}
+        if not os.path.exists(path):
+            return
+        try:
+            content = json.loads(gclient_utils.FileRead(path))
+            if isinstance(content, dict):
+                self._pinned = content.get('deps', {})
+        except (IOError, ValueError) as e:
+            logging.warning('Ignoring invalid flatten state %s: %s', path, e)
+
+    def _IsChanged(self, dep):
+        while dep:
+            if dep.name in self.changed:
+                return True
+            dep = dep.parent
+        return False
+
+    def lookup(self, dep):
+        # type: (Dependency) -> Optional[str]
+        """Returns the URL |dep| was pinned to, if it is still current."""
+        if dep.GetScmName() != 'git' or self._IsChanged(dep):
+            return None
+        entry = self._pinned.get(dep.name)
+        if not entry or entry.get('url') != dep.url:
+            return None
+        signature = _GitHeadSignature(os.path.join(dep.root.root_dir, dep.name))
+        if signature is None or entry.get('signature') != signature:
+            return None
+        self._seen[dep.name] = entry
+        return entry['pinned']
+
+    def record(self, dep, url):
+        # type: (Dependency, str) -> None
+        """Records that |dep| with the DEPS |url| was pinned to dep.url."""
+        if dep.GetScmName() != 'git' or not dep.url:
+            return
+        signature = _GitHeadSignature(os.path.join(dep.root.root_dir, dep.name))
+        if signature is not None:
+            self._seen[dep.name] = {
+                'url': url,
+                'signature': signature,
+                'pinned': dep.url,
+            }
+
+    def save(self):
+        gclient_utils.FileWrite(
+            self.path, json.dumps({'deps': self._seen},
+                                  indent=2,
+                                  sort_keys=True))
+
+
 class Flattener(object):
     """Flattens a gclient solution."""
-    def __init__(self, client, pin_all_deps=False):
+    def __init__(self, client, pin_all_deps=False, state=None):
         """Constructor.
 
         Arguments:
             client (GClient): client to flatten
             pin_all_deps (bool): whether to pin all deps, even if they're not pinned
                 in DEPS
+            state (FlattenState): revisions pinned by the previous run, to reuse
         """
         self._client = client
+        self._state = state
 
         self._deps_string = None
         self._deps_graph_lines = None
@@ -3149,8 +3832,18 @@ class Flattener(object):
         # shortened shas might become ambiguous; make sure to always
         # use full one for pinning.
         revision = gclient_utils.SplitUrlRevision(dep.url)[1]
-        if not revision or not gclient_utils.IsFullGitSha(revision):
+        if revision and gclient_utils.IsFullGitSha(revision):
+            return
+        if not self._state:
+            dep.PinToActualRevision()
+            return
+        url = dep.url
+        pinned = self._state.lookup(dep)
+        if pinned:
+            dep.set_url(pinned)
+        else:
             dep.PinToActualRevision()
+            self._state.record(dep, url)
 
     def _flatten(self, pin_all_deps=False):
         """Runs the flattener. Saves resulting DEPS string.
@@ -3371,7 +4064,24 @@ def CMDflatten(parser, args):
               'for checked out deps, NOT deps_os.'))
     parser.add_option('--deps-graph-file',
                       help='Provide a path for the output graph file')
+    parser.add_option(
+        '--reuse-pins',
+        action='store_true',
+        help=('With --pin-all-deps, reuse the revisions pinned by the '
+              'previous --reuse-pins run for the git checkouts which did not '
+              'move, instead of running git in each of them. DEPS files are '
+              'still all parsed.'))
+    parser.add_option(
+        '--changed-dep',
+        action='append',
+        default=[],
+        help=('With --reuse-pins, pin this dependency and the ones below it '
+              'again even if they look unchanged. Can be used multiple '
+              'times.'))
     options, args = parser.parse_args(args)
+    if options.reuse_pins and not options.pin_all_deps:
+        # Nothing would be pinned, and saving would drop the previous pins.
+        parser.error('--reuse-pins requires --pin-all-deps.')
 
     options.nohooks = True
     options.process_all_deps = True
@@ -3386,7 +4096,16 @@ def CMDflatten(parser, args):
     if code != 0:
         return code
 
-    flattener = Flattener(client, pin_all_deps=options.pin_all_deps)
+    state = None
+    if options.reuse_pins:
+        state = FlattenState(
+            os.path.join(client.root_dir, options.flatten_state_filename),
+            options.changed_dep)
+    flattener = Flattener(client,
+                          pin_all_deps=options.pin_all_deps,
+                          state=state)
+    if state:
+        state.save()
 
     if options.output_deps:
         with open(options.output_deps, 'w') as f:
@@ -3496,6 +4215,12 @@ def _HooksToLines(name, hooks):
             s.append('    "pattern": "%s",' % hook.pattern)
         if hook.condition is not None:
             s.append('    "condition": %r,' % hook.condition)
+        if hook.requires is not None:
+            s.append('    "requires": %r,' % list(hook.requires))
+        if hook.resources is not None:
+            s.append('    "resources": %r,' % list(hook.resources))
+        if hook.inputs is not None:
+            s.append('    "inputs": %r,' % list(hook.inputs))
         # Flattened hooks need to be written relative to the root gclient dir
         cwd = os.path.relpath(os.path.normpath(hook.effective_cwd))
         s.extend(['    "cwd": "%s",' % cwd] + ['    "action": ['] +
@@ -3523,6 +4248,12 @@ def _HooksOsToLines(hooks_os):
                 s.append('      "pattern": "%s",' % hook.pattern)
             if hook.condition is not None:
                 s.append('    "condition": %r,' % hook.condition)
+            if hook.requires is not None:
+                s.append('      "requires": %r,' % list(hook.requires))
+            if hook.resources is not None:
+                s.append('      "resources": %r,' % list(hook.resources))
+            if hook.inputs is not None:
+                s.append('      "inputs": %r,' % list(hook.inputs))
             # Flattened hooks need to be written relative to the root gclient
             # dir
             cwd = os.path.relpath(os.path.normpath(hook.effective_cwd))
@@ -3783,6 +4514,15 @@ def CMDsync(parser, args):
                       '--nohooks',
                       action='store_true',
                       help='don\'t run hooks after the update is complete')
+    parser.add_option('--force-hooks',
+                      action='store_true',
+                      help='run the hooks declaring inputs even if they are '
+                      'unchanged since their last successful run')
+    parser.add_option('--paranoid',
+                      action='store_true',
+                      help='hash downloaded files to check they are up to '
+                      'date even if they are unchanged since they were last '
+                      'verified')
     parser.add_option('-p',
                       '--noprehooks',
                       action='store_true',
@@ -3946,6 +4686,10 @@ def CMDsync(parser, args):
         # TODO(maruel): Make it a parser.error if it doesn't break any builder.
         print('Warning: you cannot use both --head and --revision')
 
+    if not options.jobs_explicit and options.jobs > 1:
+        # Keep the network busy during the long tail of big checkouts.
+        options.jobs = client.GetSyncHistory().suggest_jobs(options.jobs)
+
     if options.verbose:
         client.PrintLocationAndContents()
     ret = client.RunOnDeps('update', args)
@@ -4067,6 +4811,15 @@ def CMDrunhooks(parser, args):
                       action='store_true',
                       default=True,
                       help='Deprecated. No effect.')
+    parser.add_option('--force-hooks',
+                      action='store_true',
+                      help='run the hooks declaring inputs even if they are '
+                      'unchanged since their last successful run')
+    parser.add_option('--paranoid',
+                      action='store_true',
+                      help='hash downloaded files to check they are up to '
+                      'date even if they are unchanged since they were last '
+                      'verified')
     (options, args) = parser.parse_args(args)
     client = GClient.LoadCurrentConfig(options)
     if not client:
@@ -4532,8 +5285,19 @@ class OptionParser(optparse.OptionParser):
         if not options.config_filename:
             options.config_filename = self.gclientfile_default
         options.entries_filename = options.config_filename + '_entries'
+        options.sync_history_filename = (options.config_filename +
+                                         '_sync_history')
+        options.hooks_state_filename = options.config_filename + '_hooks_state'
+        options.deps_cache_filename = options.config_filename + '_deps_cache'
+        options.flatten_state_filename = (options.config_filename +
+                                          '_flatten_state')
+        # Whether --jobs was passed, as opposed to the default for this host.
+        options.jobs_explicit = 'jobs' in actual_options.__dict__
         if options.jobs < 1:
             self.error('--jobs must be 1 or higher')
+        if getattr(options, 'paranoid', False):
+            # Also applies to the hooks running download_from_google_storage.
+            os.environ[stamp_index.PARANOID_ENV_VAR] = '1'
 
         # These hacks need to die.
         if not hasattr(options, 'revisions'):
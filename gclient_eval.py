@@ -4,9 +4,15 @@
 
 import ast
 import collections
+import functools
+import hashlib
 from io import StringIO
+import json
 import logging
+import operator
+import os
 import sys
+import threading
 import tokenize
 
 import gclient_utils
@@ -184,6 +190,17 @@ _GCLIENT_HOOKS_SCHEMA = [
         # if the condition evaluates to True.
         schema.Optional('condition'):
         str,
+
+        # Names of the hooks, listed before this one, that must run before it.
+        # Hooks with 'requires' or 'resources' may run in parallel with others.
+        schema.Optional('requires'): [schema.Optional(str)],
+
+        # Hooks sharing one of these strings never run at the same time.
+        schema.Optional('resources'): [schema.Optional(str)],
+
+        # Files read by the hook, relative to its working directory. The hook
+        # is skipped when they and the hook are unchanged since its last run.
+        schema.Optional('inputs'): [schema.Optional(str)],
     })
 ]
 
@@ -535,7 +552,117 @@ def UpdateCondition(info_dict, op, new_condition):
         del info_dict['condition']
 
 
-def Parse(content, filename, vars_override=None, builtin_vars=None):
+def _EncodeParsed(value):
+    """Converts the result of Parse() to JSON-serializable values.
+
+    Every JSON object is a tag, so that tuples, ConstantStrings and dicts
+    round-trip through _DecodeParsed().
+    """
+    if isinstance(value, ConstantString):
+        return {'c': value.value}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [_EncodeParsed(v) for v in value]
+    if isinstance(value, tuple):
+        return {'t': [_EncodeParsed(v) for v in value]}
+    if isinstance(value, collections.abc.Mapping):
+        items = []
+        for k, v in value.items():
+            if not isinstance(k, str):
+                raise TypeError('Unsupported key %r' % (k, ))
+            items.append([k, _EncodeParsed(v)])
+        return {'d': items}
+    raise TypeError('Unsupported value %r' % (value, ))
+
+
+def _DecodeParsed(value):
+    if isinstance(value, list):
+        return [_DecodeParsed(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if 'c' in value:
+        return ConstantString(value['c'])
+    if 't' in value:
+        return tuple(_DecodeParsed(v) for v in value['t'])
+    return {k: _DecodeParsed(v) for k, v in value['d']}
+
+
+class ParseCache(object):
+    """Results of Parse() stored in a JSON file, keyed by a hash of its inputs.
+
+    Unchanged DEPS files are then neither parsed nor validated again. The key
+    includes the source of this module, so that changes to the parsing logic
+    invalidate the cache. Entries which were not used since the cache was
+    loaded are dropped when it is saved.
+
+    Methods of this class are thread safe.
+    """
+    _code_digest = None
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        # The entries used or added since the cache was loaded.
+        self._used = {}
+        self._dirty = False
+        if not os.path.exists(path):
+            return
+        try:
+            content = json.loads(gclient_utils.FileRead(path))
+            if isinstance(content, dict) and isinstance(content.get('entries'),
+                                                        dict):
+                self._entries = content['entries']
+        except (IOError, ValueError) as e:
+            logging.warning('Ignoring invalid DEPS cache %s: %s', path, e)
+
+    @classmethod
+    def Key(cls, content, vars_override=None, builtin_vars=None):
+        if cls._code_digest is None:
+            with open(__file__, 'rb') as f:
+                cls._code_digest = hashlib.sha256(f.read()).hexdigest()
+        key = json.dumps([
+            cls._code_digest, content,
+            _EncodeParsed(vars_override or {}),
+            _EncodeParsed(builtin_vars or {})
+        ])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns a copy of the result stored for |key|, or None."""
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is None:
+                return None
+            self._used[key] = encoded
+        return _DecodeParsed(encoded)
+
+    def put(self, key, result):
+        """Stores |result| for |key|. Returns a copy of it as returned by get(),
+        or |result| itself if it can't be stored."""
+        try:
+            encoded = _EncodeParsed(result)
+        except TypeError as e:
+            logging.info('Not caching the parsed DEPS: %s', e)
+            return result
+        with self._lock:
+            self._entries[key] = encoded
+            self._used[key] = encoded
+            self._dirty = True
+        return _DecodeParsed(encoded)
+
+    def save(self):
+        """Writes the cache if entries were added."""
+        with self._lock:
+            if not self._dirty:
+                return
+            content = json.dumps({'entries': self._used})
+            self._dirty = False
+        gclient_utils.FileWrite(self.path, content)
+
+
+def Parse(content, filename, vars_override=None, builtin_vars=None, cache=None):
     """Parses DEPS strings.
 
     Executes the Python-like string stored in content, resulting in a Python
@@ -550,11 +677,19 @@ def Parse(content, filename, vars_override=None, builtin_vars=None):
             defined by the DEPS file.
         builtin_vars: dict, optional. A dictionary with variables that are provided
             by default.
+        cache: ParseCache, optional. Where to look up and store the result. The
+            result is then made of plain dicts rather than AST-backed ones.
 
     Returns:
         A Python dict with the parsed contents of the DEPS file, as specified by the
         schema above.
     """
+    if cache:
+        key = cache.Key(content, vars_override, builtin_vars)
+        result = cache.get(key)
+        if result is not None:
+            return result
+
     result = Exec(content, filename, vars_override, builtin_vars)
 
     vars_dict = result.get('vars', {})
@@ -576,109 +711,210 @@ def Parse(content, filename, vars_override=None, builtin_vars=None):
             hooks.extend(os_hooks)
         del result['hooks_os']
 
+    if cache:
+        result = cache.put(key, result)
     return result
 
 
-def EvaluateCondition(condition, variables, referenced_variables=None):
-    """Safely evaluates a boolean condition. Returns the result."""
-    if not referenced_variables:
-        referenced_variables = set()
-    _allowed_names = {'None': None, 'True': True, 'False': False}
-    main_node = ast.parse(condition, mode='eval')
-    if isinstance(main_node, ast.Expression):
-        main_node = main_node.body
+_ALLOWED_CONDITION_NAMES = {'None': None, 'True': True, 'False': False}
+
+# Conditions evaluated so far, keyed by the condition and the values of the
+# variables it (transitively) references. Cleared when it grows too large.
+_condition_results = {}
+_condition_results_lock = threading.Lock()
+_MAX_CONDITION_RESULTS = 10000
+
+_CONDITION_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.In: lambda left, right: left in right,
+}
+
+
+class _CompiledCondition(object):
+    """A condition parsed once into a tree of closures.
+
+    Each closure takes the variables and the names of the variables being
+    expanded, and evaluates its node exactly like walking the AST would,
+    raising the same errors.
+    """
+    def __init__(self, condition):
+        self.condition = condition
+        # The names the condition refers to, including True, False and None.
+        self.names = set()
+        main_node = ast.parse(condition, mode='eval')
+        if isinstance(main_node, ast.Expression):
+            main_node = main_node.body
+        self.evaluate = self._Compile(main_node)
+
+    def _Compile(self, node, allow_tuple=False):
+        condition = self.condition
+
+        def _raise(error):
+            def evaluate(variables, referenced_variables):
+                raise error
+
+            return evaluate
 
-    def _convert(node, allow_tuple=False):
         if isinstance(node, ast.Str):
-            return node.s
+            value = node.s
+            return lambda variables, referenced_variables: value
 
         if isinstance(node, ast.Tuple) and allow_tuple:
-            return tuple(map(_convert, node.elts))
+            elts = [self._Compile(elt) for elt in node.elts]
+            return lambda variables, referenced_variables: tuple(
+                elt(variables, referenced_variables) for elt in elts)
 
         if isinstance(node, ast.Name):
-            if node.id in referenced_variables:
-                raise ValueError('invalid cyclic reference to %r (inside %r)' %
-                                 (node.id, condition))
+            name = node.id
+            self.names.add(name)
+
+            def evaluate(variables, referenced_variables):
+                if name in referenced_variables:
+                    raise ValueError(
+                        'invalid cyclic reference to %r (inside %r)' %
+                        (name, condition))
 
-            if node.id in _allowed_names:
-                return _allowed_names[node.id]
+                if name in _ALLOWED_CONDITION_NAMES:
+                    return _ALLOWED_CONDITION_NAMES[name]
 
-            if node.id in variables:
-                value = variables[node.id]
+                if name in variables:
+                    value = variables[name]
 
-                # Allow using "native" types, without wrapping everything in
-                # strings. Note that schema constraints still apply to
-                # variables.
-                if not isinstance(value, str):
-                    return value
+                    # Allow using "native" types, without wrapping everything
+                    # in strings. Note that schema constraints still apply to
+                    # variables.
+                    if not isinstance(value, str):
+                        return value
 
-                # Recursively evaluate the variable reference.
-                return EvaluateCondition(variables[node.id], variables,
-                                         referenced_variables.union([node.id]))
+                    # Recursively evaluate the variable reference.
+                    return EvaluateCondition(value, variables,
+                                             referenced_variables.union([name]))
 
-            # Implicitly convert unrecognized names to strings.
-            # If we want to change this, we'll need to explicitly distinguish
-            # between arguments for GN to be passed verbatim, and ones to
-            # be evaluated.
-            return node.id
+                # Implicitly convert unrecognized names to strings.
+                # If we want to change this, we'll need to explicitly
+                # distinguish between arguments for GN to be passed verbatim,
+                # and ones to be evaluated.
+                return name
+
+            return evaluate
 
         if not sys.version_info[:2] < (3, 4) and isinstance(
                 node, ast.NameConstant):  # Since Python 3.4
-            return node.value
-
-        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.Or):
-            bool_values = []
-            for value in node.values:
-                bool_values.append(_convert(value))
-                if not isinstance(bool_values[-1], bool):
-                    raise ValueError('invalid "or" operand %r (inside %r)' %
-                                     (bool_values[-1], condition))
-            return any(bool_values)
-
-        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
-            bool_values = []
-            for value in node.values:
-                bool_values.append(_convert(value))
-                if not isinstance(bool_values[-1], bool):
-                    raise ValueError('invalid "and" operand %r (inside %r)' %
-                                     (bool_values[-1], condition))
-            return all(bool_values)
+            value = node.value
+            return lambda variables, referenced_variables: value
+
+        if isinstance(node, ast.BoolOp) and isinstance(node.op,
+                                                       (ast.Or, ast.And)):
+            op_name, combine = (('or', any) if isinstance(node.op, ast.Or) else
+                                ('and', all))
+            values = [self._Compile(value) for value in node.values]
+
+            def evaluate(variables, referenced_variables):
+                bool_values = []
+                for value in values:
+                    bool_values.append(value(variables, referenced_variables))
+                    if not isinstance(bool_values[-1], bool):
+                        raise ValueError('invalid "%s" operand %r (inside %r)' %
+                                         (op_name, bool_values[-1], condition))
+                return combine(bool_values)
+
+            return evaluate
 
         if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
-            value = _convert(node.operand)
-            if not isinstance(value, bool):
-                raise ValueError('invalid "not" operand %r (inside %r)' %
-                                 (value, condition))
-            return not value
+            operand = self._Compile(node.operand)
+
+            def evaluate(variables, referenced_variables):
+                value = operand(variables, referenced_variables)
+                if not isinstance(value, bool):
+                    raise ValueError('invalid "not" operand %r (inside %r)' %
+                                     (value, condition))
+                return not value
+
+            return evaluate
 
         if isinstance(node, ast.Compare):
             if len(node.ops) != 1:
-                raise ValueError(
-                    'invalid compare: exactly 1 operator required (inside %r)' %
-                    (condition))
+                return _raise(
+                    ValueError('invalid compare: exactly 1 operator required '
+                               '(inside %r)' % (condition)))
             if len(node.comparators) != 1:
-                raise ValueError(
-                    'invalid compare: exactly 1 comparator required (inside %r)'
-                    % (condition))
-
-            left = _convert(node.left)
-            right = _convert(node.comparators[0],
-                             allow_tuple=isinstance(node.ops[0], ast.In))
-
-            if isinstance(node.ops[0], ast.Eq):
-                return left == right
-            if isinstance(node.ops[0], ast.NotEq):
-                return left != right
-            if isinstance(node.ops[0], ast.In):
-                return left in right
-
-            raise ValueError('unexpected operator: %s %s (inside %r)' %
-                             (node.ops[0], ast.dump(node), condition))
+                return _raise(
+                    ValueError('invalid compare: exactly 1 comparator required '
+                               '(inside %r)' % (condition)))
+
+            op = node.ops[0]
+            left = self._Compile(node.left)
+            right = self._Compile(node.comparators[0],
+                                  allow_tuple=isinstance(op, ast.In))
+            compare = _CONDITION_OPERATORS.get(type(op))
+
+            def evaluate(variables, referenced_variables):
+                l = left(variables, referenced_variables)
+                r = right(variables, referenced_variables)
+                if compare is None:
+                    raise ValueError('unexpected operator: %s %s (inside %r)' %
+                                     (op, ast.dump(node), condition))
+                return compare(l, r)
+
+            return evaluate
+
+        return _raise(
+            ValueError('unexpected AST node: %s %s (inside %r)' %
+                       (node, ast.dump(node), condition)))
+
+
+@functools.lru_cache(maxsize=None)
+def _CompileCondition(condition):
+    return _CompiledCondition(condition)
+
+
+def _ConditionCacheKey(compiled, variables, referenced_variables):
+    """Returns the values of the variables |compiled| depends on, following
+    variables which are conditions themselves, or None if they can't be used
+    as a key."""
+    key = [compiled.condition, frozenset(referenced_variables)]
+    seen = set()
+    pending = [compiled]
+    while pending:
+        for name in sorted(pending.pop().names - seen):
+            seen.add(name)
+            if name in _ALLOWED_CONDITION_NAMES or name not in variables:
+                key.append((name, ))
+                continue
+            value = variables[name]
+            key.append((name, type(value), value))
+            if isinstance(value, str) and name not in referenced_variables:
+                try:
+                    pending.append(_CompileCondition(value))
+                except SyntaxError:
+                    # Evaluating the condition raises this error again.
+                    return None
+    key = tuple(key)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
-        raise ValueError('unexpected AST node: %s %s (inside %r)' %
-                         (node, ast.dump(node), condition))
 
-    return _convert(main_node)
+def EvaluateCondition(condition, variables, referenced_variables=None):
+    """Safely evaluates a boolean condition. Returns the result."""
+    if not referenced_variables:
+        referenced_variables = set()
+    compiled = _CompileCondition(condition)
+    key = _ConditionCacheKey(compiled, variables, referenced_variables)
+    if key is not None:
+        with _condition_results_lock:
+            if key in _condition_results:
+                return _condition_results[key]
+    result = compiled.evaluate(variables, referenced_variables)
+    if key is not None:
+        with _condition_results_lock:
+            if len(_condition_results) >= _MAX_CONDITION_RESULTS:
+                _condition_results.clear()
+            _condition_results[key] = result
+    return result
 
 
 def RenderDEPSFile(gclient_dict):
@@ -783,12 +783,15 @@ class GitWrapper(SCMWrapper):
             if mirror:
                 self._UpdateMirrorIfNotContains(mirror, options, rev_type,
                                                 revision)
-            try:
-                self.current_revision = self._Clone(revision, url, options)
-            except subprocess2.CalledProcessError as e:
-                logging.warning('Clone failed due to: %s', e)
-                self._DeleteOrMove(options.force)
-                self.current_revision = self._Clone(revision, url, options)
+            # Other checkouts can clone from the mirror at the same time, but
+            # it can't be replaced meanwhile.
+            with (mirror.read_lock() if mirror else contextlib.nullcontext()):
+                try:
+                    self.current_revision = self._Clone(revision, url, options)
+                except subprocess2.CalledProcessError as e:
+                    logging.warning('Clone failed due to: %s', e)
+                    self._DeleteOrMove(options.force)
+                    self.current_revision = self._Clone(revision, url, options)
             if file_list is not None:
                 files = self._Capture(
                     ['-c', 'core.quotePath=false', 'ls-files']).splitlines()
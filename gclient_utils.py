@@ -3,17 +3,20 @@
 # found in the LICENSE file.
 """Generic utils."""
 
+import bisect
 import codecs
 import collections
 import contextlib
 import datetime
 import errno
 import functools
+import heapq
 import io
 import logging
 import operator
 import os
 import platform
+import posixpath
 import queue
 import re
 import shlex
@@ -861,21 +864,52 @@ class ExecutionQueue(object):
     This class manages that all the required dependencies are run
     before running each one.
 
+    Items whose requirements are all satisfied are kept in a heap ordered by
+    their estimated remaining critical path, so the items that (directly or
+    through the items waiting on them) take the longest are started first.
+    Items still waiting are indexed by the requirement names they wait on, so
+    the scheduling cost grows with the number of requirements rather than with
+    the square of the number of items.
+
+    Like Dependency.requirements, an item whose name is nested under the name
+    of another item (e.g. 'src/foo' under 'src') waits for it, even when the
+    outer item is enqueued after the nested one.
+
     Methods of this class are thread safe.
     """
-    def __init__(self, jobs, progress, ignore_requirements, verbose=False):
+    def __init__(self,
+                 jobs,
+                 progress,
+                 ignore_requirements,
+                 verbose=False,
+                 estimates=None):
         """jobs specifies the number of concurrent tasks to allow. progress is a
-        Progress instance."""
+        Progress instance. estimates optionally maps a WorkItem name to the
+        estimated number of seconds on the critical path starting at that
+        item, usually derived from previous runs."""
         # Set when a thread is done or a new item is enqueued.
         self.ready_cond = threading.Condition()
         # Maximum number of concurrent tasks.
         self.jobs = jobs
-        # List of WorkItem, for gclient, these are Dependency instances.
-        self.queued = []
+        # Heap of (-priority, sequence, _QueuedItem) ready to be started.
+        self._ready = []
+        # Maps a requirement name to the _QueuedItem waiting on it.
+        self._dependents = collections.defaultdict(list)
+        # Maps a WorkItem name to its _QueuedItem not started yet.
+        self._pending = collections.defaultdict(list)
+        # Sorted names of self._pending, to find nested items.
+        self._pending_names = []
+        self._pending_count = 0
+        # Counter used to keep the heap FIFO for equal priorities.
+        self._sequence = 0
+        self._estimates = estimates or {}
         # List of strings representing each Dependency.name that was run.
         self.ran = []
+        self._ran_set = set()
         # List of items currently running.
         self.running = []
+        # Number of running items holding each resource.
+        self._resources_in_use = collections.Counter()
         # Exceptions thrown if any.
         self.exceptions = queue.Queue()
         # Progress status
@@ -888,6 +922,23 @@ class ExecutionQueue(object):
         self.last_join = None
         self.last_subproc_output = None
 
+    class _QueuedItem(object):
+        """Bookkeeping for one enqueued WorkItem."""
+        def __init__(self, item, priority, sequence):
+            self.item = item
+            self.priority = priority
+            self.sequence = sequence
+            # Names of the requirements that had not run when enqueued.
+            self.requirements = set()
+            # Number of requirements that have not run yet.
+            self.unmet = 0
+
+    @property
+    def queued(self):
+        """List of WorkItem enqueued but not started yet."""
+        entries = [e for pending in self._pending.values() for e in pending]
+        return [e.item for e in sorted(entries, key=lambda e: e.sequence)]
+
     def enqueue(self, d):
         """Enqueue one Dependency to be executed later once its requirements are
         satisfied.
@@ -895,8 +946,23 @@ class ExecutionQueue(object):
         assert isinstance(d, WorkItem)
         self.ready_cond.acquire()
         try:
-            self.queued.append(d)
-            total = len(self.queued) + len(self.ran) + len(self.running)
+            self._sequence += 1
+            entry = self._QueuedItem(d, self._estimates.get(d.name, 0),
+                                     self._sequence)
+            if d.name and d.name not in self._pending:
+                bisect.insort(self._pending_names, d.name)
+            self._pending[d.name].append(entry)
+            self._pending_count += 1
+            if not self.ignore_requirements:
+                entry.requirements = set(d.requirements) - self._ran_set
+                entry.unmet = len(entry.requirements)
+                for requirement in entry.requirements:
+                    self._dependents[requirement].append(entry)
+                    self._raise_priority(requirement, entry.priority)
+                self._add_nested_requirement(d.name)
+            if not entry.unmet:
+                self._push_ready(entry)
+            total = self._pending_count + len(self.ran) + len(self.running)
             if self.jobs == 1:
                 total += 1
             logging.debug('enqueued(%s)' % d.name)
@@ -907,6 +973,88 @@ class ExecutionQueue(object):
         finally:
             self.ready_cond.release()
 
+    def _add_nested_requirement(self, name):
+        """Makes pending items nested under |name| wait for it."""
+        if not name:
+            return
+        prefix = posixpath.join(name, '')
+        index = bisect.bisect_left(self._pending_names, prefix)
+        while (index < len(self._pending_names)
+               and self._pending_names[index].startswith(prefix)):
+            for entry in self._pending[self._pending_names[index]]:
+                if name not in entry.requirements:
+                    entry.requirements.add(name)
+                    entry.unmet += 1
+                    self._dependents[name].append(entry)
+            index += 1
+
+    def _push_ready(self, entry):
+        heapq.heappush(self._ready, (-entry.priority, entry.sequence, entry))
+
+    def _raise_priority(self, name, priority):
+        """Makes the pending items named |name| at least as urgent as an item
+        with |priority| waiting on them, transitively."""
+        stack = [name]
+        while stack:
+            for entry in self._pending.get(stack.pop(), []):
+                if entry.priority >= priority:
+                    continue
+                entry.priority = priority
+                if entry.unmet:
+                    stack.extend(r for r in entry.requirements
+                                 if r not in self._ran_set)
+                else:
+                    # The previous heap entry is now stale and will be
+                    # skipped by _pop_ready.
+                    self._push_ready(entry)
+
+    def _pop_ready(self):
+        """Removes and returns the most urgent runnable _QueuedItem, or None."""
+        conflicting = []
+        found = None
+        while self._ready:
+            heap_entry = heapq.heappop(self._ready)
+            entry = heap_entry[2]
+            if -heap_entry[0] != entry.priority or entry.unmet:
+                # Stale: re-prioritized or waiting on a new requirement.
+                continue
+            if entry not in self._pending.get(entry.item.name, []):
+                # Already started.
+                continue
+            if self._is_conflict(entry.item):
+                conflicting.append(heap_entry)
+                continue
+            found = entry
+            break
+        for heap_entry in conflicting:
+            heapq.heappush(self._ready, heap_entry)
+        if found:
+            pending = self._pending[found.item.name]
+            pending.remove(found)
+            if not pending:
+                del self._pending[found.item.name]
+                if found.item.name:
+                    self._pending_names.remove(found.item.name)
+            self._pending_count -= 1
+        return found
+
+    def _mark_ran(self, name):
+        """Records that |name| ran and releases the items waiting on it."""
+        self.ran.append(name)
+        self._ran_set.add(name)
+        for entry in self._dependents.pop(name, []):
+            entry.unmet -= 1
+            if not entry.unmet:
+                self._push_ready(entry)
+
+    def _clear_queue(self):
+        """Drops every item that has not been started."""
+        self._ready = []
+        self._dependents.clear()
+        self._pending.clear()
+        self._pending_names = []
+        self._pending_count = 0
+
     def out_cb(self, _):
         self.last_subproc_output = datetime.datetime.now()
         return True
@@ -929,11 +1077,10 @@ class ExecutionQueue(object):
 
     def _is_conflict(self, job):
         """Checks to see if a job will conflict with another running job."""
-        for running_job in self.running:
-            for used_resource in running_job.item.resources:
-                logging.debug('Checking resource %s' % used_resource)
-                if used_resource in job.resources:
-                    return True
+        for resource in job.resources:
+            logging.debug('Checking resource %s' % resource)
+            if self._resources_in_use[resource]:
+                return True
         return False
 
     def flush(self, *args, **kwargs):
@@ -948,32 +1095,24 @@ class ExecutionQueue(object):
                     if not self.exceptions.empty():
                         # Systematically flush the queue when an exception
                         # logged.
-                        self.queued = []
+                        self._clear_queue()
                     self._flush_terminated_threads()
-                    if (not self.queued and not self.running
+                    if (not self._pending_count and not self.running
                             or self.jobs == len(self.running)):
                         logging.debug(
                             'No more worker threads or can\'t queue anything.')
                         break
 
-                    # Check for new tasks to start.
-                    for i in range(len(self.queued)):
-                        # Verify its requirements.
-                        if (self.ignore_requirements
-                                or not (set(self.queued[i].requirements) -
-                                        set(self.ran))):
-                            if not self._is_conflict(self.queued[i]):
-                                # Start one work item: all its requirements are
-                                # satisfied.
-                                self._run_one_task(self.queued.pop(i), args,
-                                                   kwargs)
-                                break
-                    else:
+                    # Start the most urgent work item whose requirements are
+                    # satisfied and that doesn't conflict with running ones.
+                    entry = self._pop_ready()
+                    if not entry:
                         # Couldn't find an item that could run. Break out the
                         # outher loop.
                         break
+                    self._run_one_task(entry.item, args, kwargs)
 
-                if not self.queued and not self.running:
+                if not self._pending_count and not self.running:
                     # We're done.
                     break
                 # We need to poll here otherwise Ctrl-C isn't processed.
@@ -999,7 +1138,7 @@ class ExecutionQueue(object):
                     print(
                         ('\nAllowed parallel jobs: %d\n# queued: %d\nRan: %s\n'
                          'Running: %d') %
-                        (self.jobs, len(self.queued), ', '.join(
+                        (self.jobs, self._pending_count, ', '.join(
                             self.ran), len(self.running)),
                         file=sys.stderr)
                     for i in self.queued:
@@ -1036,17 +1175,18 @@ class ExecutionQueue(object):
                 self.running.append(t)
             else:
                 t.join()
+                self._resources_in_use.subtract(t.item.resources)
                 self.last_join = datetime.datetime.now()
                 sys.stdout.flush()
                 if self.verbose:
                     print(self.format_task_output(t.item))
                 if self.progress:
                     self.progress.update(1, t.item.name)
-                if t.item.name in self.ran:
+                if t.item.name in self._ran_set:
                     raise Error('gclient is confused, "%s" is already in "%s"' %
                                 (t.item.name, ', '.join(self.ran)))
-                if not t.item.name in self.ran:
-                    self.ran.append(t.item.name)
+                if not t.item.name in self._ran_set:
+                    self._mark_ran(t.item.name)
 
     def _run_one_task(self, task_item, args, kwargs):
         if self.jobs > 1:
@@ -1054,6 +1194,7 @@ class ExecutionQueue(object):
             index = len(self.ran) + len(self.running) + 1
             new_thread = self._Worker(task_item, index, args, kwargs)
             self.running.append(new_thread)
+            self._resources_in_use.update(task_item.resources)
             new_thread.start()
         else:
             # Run the 'thread' inside the main thread. Don't try to catch any
@@ -1066,7 +1207,7 @@ class ExecutionQueue(object):
                 task_item.finish = datetime.datetime.now()
                 print('[%s] Finished.' % Elapsed(task_item.finish),
                       file=task_item.outbuf)
-                self.ran.append(task_item.name)
+                self._mark_ran(task_item.name)
                 if self.verbose:
                     if self.progress:
                         print('')
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Hashes, validates and extracts downloaded tarballs in a single pass.
+
+The archive is read once: the compressed bytes are hashed as they are read,
+then decompressed and each member is validated before it is written to a
+staging directory. Callers check the digests before moving the staging
+directory into place with publish(), so a corrupt or malicious archive never
+touches the output directory.
+
+Gzip archives are decompressed by pigz and zstd archives by zstd when they are
+installed, in a separate process that runs concurrently with the extraction.
+"""
+
+import collections
+import hashlib
+import os
+import shutil
+import tarfile
+import threading
+
+import subprocess2
+
+# Set to 0 to always decompress gzip archives in-process.
+PARALLEL_ENV_VAR = 'DEPOT_TOOLS_PARALLEL_DECOMPRESS'
+
+# Size of the reads from the archive.
+BLOCK_SIZE = 1024 * 1024
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# The digests of the archive, its size in bytes and the TarInfo of its members.
+Result = collections.namedtuple('Result', 'digests size members')
+
+
+class ArchiveError(tarfile.TarError):
+    pass
+
+
+class InvalidMemberError(ArchiveError):
+    """A member of the archive was rejected."""
+    def __init__(self, name):
+        super(InvalidMemberError,
+              self).__init__('%s is not allowed in the archive' % name)
+        self.name = name
+
+
+class _HashingReader(object):
+    """Wraps a file, hashing and counting the bytes read from it."""
+    def __init__(self, f, hashes):
+        self._f = f
+        self._digests = {name: hashlib.new(name) for name in hashes}
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.size += len(data)
+        for digest in self._digests.values():
+            digest.update(data)
+        return data
+
+    def drain(self):
+        while self.read(BLOCK_SIZE):
+            pass
+
+    def hexdigests(self):
+        return {name: d.hexdigest() for name, d in self._digests.items()}
+
+
+def _DecompressCommand(path):
+    """Returns the command to decompress |path| to stdout, or None if tarfile
+    should decompress it."""
+    with open(path, 'rb') as f:
+        magic = f.read(len(_ZSTD_MAGIC))
+    if magic.startswith(_ZSTD_MAGIC):
+        # tarfile doesn't support zstd.
+        if shutil.which('zstd'):
+            return ['zstd', '-dcq']
+    elif magic.startswith(_GZIP_MAGIC):
+        if os.environ.get(PARALLEL_ENV_VAR,
+                          '1') != '0' and shutil.which('pigz'):
+            return ['pigz', '-dc']
+    return None
+
+
+def is_archive(path):
+    """Returns whether |path| is a tarball extract() can read."""
+    if tarfile.is_tarfile(path):
+        return True
+    command = _DecompressCommand(path)
+    if not command or command[0] != 'zstd':
+        return False
+    proc = subprocess2.Popen(command + [path],
+                             stdout=subprocess2.PIPE,
+                             stderr=subprocess2.DEVNULL)
+    try:
+        block = proc.stdout.read(tarfile.BLOCKSIZE)
+    finally:
+        proc.kill()
+        proc.stdout.close()
+        proc.wait()
+    try:
+        tarfile.TarInfo.frombuf(block, tarfile.ENCODING, 'surrogateescape')
+    except tarfile.HeaderError:
+        return False
+    return True
+
+
+def _IsSafe(tarinfo):
+    """Returns whether extracting |tarinfo| stays inside the destination."""
+    if os.path.isabs(tarinfo.name) or '..' in tarinfo.name.replace(
+            '\\', '/').split('/'):
+        return False
+    if tarinfo.issym() or tarinfo.islnk():
+        if os.path.isabs(tarinfo.linkname):
+            return False
+        target = tarinfo.linkname
+        if tarinfo.issym():
+            target = os.path.join(os.path.dirname(tarinfo.name), target)
+        target = os.path.normpath(target).replace('\\', '/')
+        if target == '..' or target.startswith('../'):
+            return False
+    return True
+
+
+def _ExtractMembers(tar, staging_dir, validate, members):
+    # Like TarFile.extractall(), but validates each member as it is read and
+    # works on a stream.
+    directories = []
+    for tarinfo in tar:
+        if not _IsSafe(tarinfo) or (validate and not validate(tarinfo)):
+            raise InvalidMemberError(tarinfo.name)
+        members.append(tarinfo)
+        if tarinfo.isdir():
+            # Permissions are set last, the directory may be read-only.
+            directories.append(tarinfo)
+        tar.extract(tarinfo, staging_dir, set_attrs=not tarinfo.isdir())
+    directories.sort(key=lambda tarinfo: tarinfo.name, reverse=True)
+    for tarinfo in directories:
+        path = os.path.join(staging_dir, tarinfo.name)
+        tar.chown(tarinfo, path, False)
+        tar.utime(tarinfo, path)
+        tar.chmod(tarinfo, path)
+
+
+def _ExtractPiped(reader, command, staging_dir, validate, members):
+    proc = subprocess2.Popen(command,
+                             stdin=subprocess2.PIPE,
+                             stdout=subprocess2.PIPE)
+
+    def feed():
+        try:
+            for data in iter(lambda: reader.read(BLOCK_SIZE), b''):
+                proc.stdin.write(data)
+            proc.stdin.close()
+        except OSError:
+            # The decompressor exited, its status is checked below.
+            pass
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            _ExtractMembers(tar, staging_dir, validate, members)
+        while proc.stdout.read(BLOCK_SIZE):
+            pass
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        feeder.join()
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode:
+        raise ArchiveError('%s exited with %d' % (command[0], proc.returncode))
+
+
+def extract(archive, staging_dir, validate=None, hashes=()):
+    """Extracts the tarball |archive| into the directory |staging_dir|.
+
+    Members whose path or link target escape |staging_dir| are always rejected,
+    |validate| is called with the TarInfo of each member to reject more.
+
+    Returns a Result whose digests map each of |hashes| to the hex digest of
+    the archive. Raises tarfile.TarError if |archive| can't be extracted, or
+    InvalidMemberError. |staging_dir| is left partially extracted on errors.
+    """
+    command = _DecompressCommand(archive)
+    members = []
+    with open(archive, 'rb') as f:
+        reader = _HashingReader(f, hashes)
+        if command:
+            _ExtractPiped(reader, command, staging_dir, validate, members)
+        else:
+            with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                _ExtractMembers(tar, staging_dir, validate, members)
+        # The end of the archive may not have been read.
+        reader.drain()
+    return Result(reader.hexdigests(), reader.size, members)
+
+
+def publish(staging_dir, output_dir):
+    """Moves the contents of |staging_dir| into |output_dir|, then removes it.
+
+    Each entry missing from |output_dir| is moved with a single rename. Existing
+    directories are merged into, other existing entries are replaced.
+    """
+    for name in os.listdir(staging_dir):
+        source = os.path.join(staging_dir, name)
+        dest = os.path.join(output_dir, name)
+        source_is_dir = os.path.isdir(source) and not os.path.islink(source)
+        dest_is_dir = os.path.isdir(dest) and not os.path.islink(dest)
+        if source_is_dir and dest_is_dir:
+            publish(source, dest)
+            continue
+        if dest_is_dir:
+            shutil.rmtree(dest)
+        elif source_is_dir and os.path.lexists(dest):
+            os.remove(dest)
+        os.replace(source, dest)
+    os.rmdir(staging_dir)
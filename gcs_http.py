@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Downloads Google Storage objects over pooled HTTP connections.
+
+This is an in-process alternative to running `gsutil.py cp` for each object.
+Connections are kept alive and shared between threads, large objects are
+fetched with parallel ranged GETs, the requested digests are computed as the
+bytes arrive and an interrupted download is resumed from where it stopped.
+
+Only objects readable with the given credentials, anonymously by default, can
+be downloaded. Callers fall back to gsutil on any HttpError.
+"""
+
+import collections
+import contextlib
+import hashlib
+import http.client
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+# Where objects are served from. Can be pointed at a local server in tests.
+GCS_URL = 'https://storage.googleapis.com'
+
+# Set to 0 to always download objects with gsutil.
+ENABLE_ENV_VAR = 'DEPOT_TOOLS_GCS_HTTP'
+
+# Number of concurrent ranged GETs used for one large object.
+DEFAULT_JOBS = 4
+# Objects at least this large are fetched with ranged GETs.
+RANGED_MIN_SIZE = 64 * 1024 * 1024
+# Size of each ranged GET.
+CHUNK_SIZE = 16 * 1024 * 1024
+# Size of the reads from a response.
+BLOCK_SIZE = 1024 * 1024
+
+MAX_TRIES = 5
+RETRY_BASE_DELAY = 1.0
+TIMEOUT = 60
+
+# Responses worth retrying.
+_TRANSIENT_STATUSES = (408, 429, 500, 502, 503, 504)
+
+# Metadata and digests of a downloaded object.
+Result = collections.namedtuple('Result',
+                                ['size', 'etag', 'executable', 'digests'])
+
+
+class HttpError(Exception):
+    """An object could not be downloaded."""
+    def __init__(self, status, url, message=''):
+        super(HttpError,
+              self).__init__('%s: HTTP %s %s' % (url, status, message))
+        self.status = status
+        self.url = url
+
+
+class _TransientError(Exception):
+    """A request failed in a way that is worth retrying."""
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections to one host, shared by several threads.
+
+    Connections are created on demand, so the number of concurrent requests is
+    only limited by the callers. Methods of this class are thread safe.
+    """
+    def __init__(self, url, timeout=TIMEOUT):
+        parsed = urllib.parse.urlparse(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _Connect(self):
+        if self.scheme == 'https':
+            connection_class = http.client.HTTPSConnection
+        else:
+            connection_class = http.client.HTTPConnection
+        proxy = urllib.request.getproxies().get(self.scheme)
+        if proxy and not urllib.request.proxy_bypass(self.host):
+            proxy = urllib.parse.urlparse(proxy)
+            connection = connection_class(proxy.hostname,
+                                          proxy.port,
+                                          timeout=self._timeout)
+            connection.set_tunnel(self.host, self.port)
+            return connection
+        return connection_class(self.host, self.port, timeout=self._timeout)
+
+    @contextlib.contextmanager
+    def request(self, method, path, headers=None):
+        """Sends a request and yields its http.client.HTTPResponse.
+
+        The connection is reused by later requests if the response was read
+        entirely.
+        """
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = self._Connect()
+        try:
+            connection.request(method, path, headers=headers or {})
+            response = connection.getresponse()
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.append(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class _RangedFetch(object):
+    """Fetches a byte range of an object as chunks on several threads and
+    passes them in order to a single writer."""
+    def __init__(self, downloader, path, etag, chunks, jobs):
+        self._downloader = downloader
+        self._path = path
+        self._etag = etag
+        # (start, end) of each chunk.
+        self._chunks = chunks
+        self._jobs = jobs
+        self._cond = threading.Condition()
+        # Fetched chunks not written yet, by index.
+        self._fetched = {}
+        # Index of the next chunk to fetch and of the next chunk to write.
+        self._next = 0
+        self._written = 0
+        self._error = None
+        self._stopped = False
+
+    def _Worker(self):
+        # Bound the memory used by the chunks waiting for the writer.
+        window = 2 * self._jobs
+        while True:
+            with self._cond:
+                while (not self._stopped and self._next < len(self._chunks)
+                       and self._next >= self._written + window):
+                    self._cond.wait()
+                if self._stopped or self._next >= len(self._chunks):
+                    return
+                index = self._next
+                self._next += 1
+            data = bytearray()
+            start, end = self._chunks[index]
+            try:
+                self._downloader._Fetch(self._path, start, end, self._etag,
+                                        data.extend)
+            except Exception as e:
+                with self._cond:
+                    self._error = self._error or e
+                    self._stopped = True
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._fetched[index] = data
+                self._cond.notify_all()
+
+    def run(self, write):
+        threads = [
+            threading.Thread(target=self._Worker, name='gcs_http')
+            for _ in range(min(self._jobs, len(self._chunks)))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for index in range(len(self._chunks)):
+                with self._cond:
+                    while index not in self._fetched and not self._error:
+                        self._cond.wait()
+                    if self._error:
+                        raise self._error
+                    data = self._fetched.pop(index)
+                write(data)
+                with self._cond:
+                    self._written = index + 1
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify_all()
+            for thread in threads:
+                thread.join()
+
+
+class Downloader(object):
+    """Downloads objects from Google Storage over a pool of connections.
+
+    Methods of this class are thread safe.
+    """
+    def __init__(self,
+                 base_url=GCS_URL,
+                 jobs=DEFAULT_JOBS,
+                 token=None,
+                 ranged_min_size=RANGED_MIN_SIZE,
+                 chunk_size=CHUNK_SIZE):
+        """jobs is the number of concurrent ranged GETs for one large object.
+        token is a function returning an OAuth2 access token, or None to send
+        anonymous requests."""
+        self.base_url = base_url.rstrip('/')
+        self.jobs = jobs
+        self._token = token
+        self.ranged_min_size = ranged_min_size
+        self.chunk_size = chunk_size
+        self._pool = ConnectionPool(self.base_url)
+        self._prefix = urllib.parse.urlparse(self.base_url).path
+
+    def _Path(self, gs_url):
+        """Returns the HTTP path of a gs://bucket/object URL."""
+        parsed = urllib.parse.urlparse(gs_url)
+        if parsed.scheme != 'gs' or not parsed.netloc:
+            raise ValueError('Not a gs:// URL: %s' % gs_url)
+        return '%s/%s/%s' % (self._prefix, parsed.netloc,
+                             urllib.parse.quote(parsed.path.lstrip('/')))
+
+    def _Headers(self, **extra):
+        headers = {'User-Agent': 'depot_tools'}
+        if self._token:
+            headers['Authorization'] = 'Bearer %s' % self._token()
+        headers.update(extra)
+        return headers
+
+    def _Check(self, response, path, expected):
+        """Raises if |response| doesn't have one of the |expected| statuses."""
+        if response.status in expected:
+            return
+        # Drain the body so the connection can be reused.
+        message = response.read(4096).decode('utf-8', 'replace').strip()
+        if response.status in _TRANSIENT_STATUSES:
+            raise _TransientError('%s: HTTP %s' % (path, response.status))
+        raise HttpError(response.status, self.base_url + path, message)
+
+    def _Retry(self, function):
+        """Calls |function| until it doesn't fail transiently."""
+        delay = RETRY_BASE_DELAY
+        for attempt in range(MAX_TRIES):
+            try:
+                return function()
+            except (_TransientError, http.client.HTTPException, OSError) as e:
+                if attempt == MAX_TRIES - 1:
+                    if isinstance(e, _TransientError):
+                        raise HttpError(None, self.base_url, str(e))
+                    raise
+                logging.warning('Retrying after %s', e)
+            time.sleep(delay)
+            delay *= 2
+
+    def stat(self, gs_url):
+        """Returns the Result of |gs_url|, without digests."""
+        path = self._Path(gs_url)
+
+        def head():
+            with self._pool.request('HEAD', path, self._Headers()) as response:
+                self._Check(response, path, (200, ))
+                # Closes the response, there is no body.
+                response.read()
+                return response.getheaders()
+
+        headers = {k.lower(): v for k, v in self._Retry(head)}
+        if headers.get('x-goog-stored-content-encoding',
+                       'identity') != 'identity':
+            # Google Storage would transcode the object and ignore ranges.
+            raise HttpError(None, self.base_url + path,
+                            'compressed objects are not supported')
+        size = headers.get('x-goog-stored-content-length',
+                           headers.get('content-length'))
+        return Result(size=int(size),
+                      etag=headers.get('etag'),
+                      executable=headers.get('x-goog-meta-executable') == '1',
+                      digests={})
+
+    def _Fetch(self, path, start, end, etag, sink):
+        """Passes the bytes [start, end) of an object to |sink| as they arrive.
+
+        Transient failures are retried from the first byte not received yet. If
+        |etag| is set, fails with HTTP 412 if the object changed.
+        """
+        position = [start]
+
+        def get():
+            headers = self._Headers(Range='bytes=%d-%d' %
+                                    (position[0], end - 1))
+            if etag:
+                headers['If-Match'] = etag
+            with self._pool.request('GET', path, headers) as response:
+                self._Check(response, path, (206, ))
+                while position[0] < end:
+                    data = response.read(min(BLOCK_SIZE, end - position[0]))
+                    if not data:
+                        raise http.client.IncompleteRead(b'', end - position[0])
+                    sink(data)
+                    position[0] += len(data)
+
+        if start < end:
+            self._Retry(get)
+
+    @staticmethod
+    def _ResumeOffset(partial, state_file, info):
+        """Returns how many bytes of |partial| can be reused."""
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+            size = os.path.getsize(partial)
+        except (IOError, OSError, ValueError):
+            return 0
+        if (state.get('etag') != info.etag or state.get('size') != info.size
+                or size > info.size):
+            return 0
+        return size
+
+    def download(self, gs_url, output, hashes=('sha256', )):
+        """Downloads |gs_url| to the file |output|.
+
+        The object is first written to |output|.partial, which is resumed by a
+        later call if the download is interrupted and the object didn't change.
+
+        Returns a Result whose digests map each of |hashes| to the hex digest of
+        the object.
+        """
+        path = self._Path(gs_url)
+        info = self.stat(gs_url)
+        partial = output + '.partial'
+        state_file = partial + '.json'
+        digests = {name: hashlib.new(name) for name in hashes}
+
+        offset = self._ResumeOffset(partial, state_file, info)
+        if offset:
+            logging.info('Resuming %s at byte %d', gs_url, offset)
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(BLOCK_SIZE), b''):
+                    for digest in digests.values():
+                        digest.update(chunk)
+        else:
+            with open(state_file, 'w') as f:
+                json.dump({'etag': info.etag, 'size': info.size}, f)
+
+        with open(partial, 'ab' if offset else 'wb') as f:
+
+            def write(data):
+                f.write(data)
+                for digest in digests.values():
+                    digest.update(data)
+
+            try:
+                if (self.jobs > 1
+                        and info.size - offset >= self.ranged_min_size):
+                    chunks = [
+                        (start, min(start + self.chunk_size, info.size))
+                        for start in range(offset, info.size, self.chunk_size)
+                    ]
+                    _RangedFetch(self, path, info.etag, chunks,
+                                 self.jobs).run(write)
+                else:
+                    self._Fetch(path, offset, info.size, info.etag, write)
+            except HttpError as e:
+                if e.status == 412:
+                    # The object changed, what was fetched is useless.
+                    f.close()
+                    os.remove(partial)
+                    os.remove(state_file)
+                raise
+
+        os.replace(partial, output)
+        os.remove(state_file)
+        return info._replace(digests={
+            name: d.hexdigest()
+            for name, d in digests.items()
+        })
+
+    @staticmethod
+    def discard_partial(output):
+        """Removes what download() fetched of |output| so far, once the caller
+        got |output| another way."""
+        partial = output + '.partial'
+        for path in (partial, partial + '.json'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self._pool.close()
+
+
+_default_downloader = None
+_default_downloader_lock = threading.Lock()
+
+
+def GetDownloader():
+    """Returns the Downloader shared by this process, or None if disabled."""
+    global _default_downloader
+    if os.environ.get(ENABLE_ENV_VAR, '1') == '0':
+        return None
+    with _default_downloader_lock:
+        if _default_downloader is None:
+            _default_downloader = Downloader()
+        return _default_downloader
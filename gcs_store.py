@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""A machine-wide content-addressed store of downloaded GCS objects.
+
+Objects are stored under <store>/<algorithm>/<first 2 hex digits>/<digest>
+once their digest was verified, and are materialized into checkouts with a
+hardlink, a reflink or, if neither is possible, a copy. Checkouts of the same
+tree then download each object once per machine.
+
+The store is enabled by pointing STORE_ENV_VAR at a directory. Objects used
+least recently are evicted once the store is larger than MAX_SIZE_ENV_VAR,
+e.g. '100G'.
+
+Materialized files may share their inode with the store, so they must be
+replaced rather than modified in place. For the same reason, when an object
+was last used is recorded by the mtime of a <digest>.used file next to it
+rather than by the object's own mtime, which checkouts see.
+
+Since a checkout may still modify its file, objects aren't trusted blindly:
+the size, mtime and inode an object had when its digest was last verified
+are recorded in a <digest>.verified file, and the object is hashed again
+before it is used if they changed. Objects which don't match their digest
+are removed.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import uuid
+
+import lockfile
+
+STORE_ENV_VAR = 'DEPOT_TOOLS_GCS_STORE'
+MAX_SIZE_ENV_VAR = 'DEPOT_TOOLS_GCS_STORE_MAX_SIZE'
+
+DEFAULT_MAX_SIZE = 50 * 1024**3
+
+# From linux/fs.h.
+_FICLONE = 0x40049409
+
+_USED_SUFFIX = '.used'
+_VERIFIED_SUFFIX = '.verified'
+_SIDECAR_SUFFIXES = (_USED_SUFFIX, _VERIFIED_SUFFIX)
+
+_SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def ParseSize(value):
+    """Parses a size in bytes with an optional K, M, G or T suffix."""
+    match = re.match(r'^\s*(\d+)\s*([KMGT]?)B?\s*$', value, re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size: %r' % value)
+    return int(match.group(1)) * _SIZE_SUFFIXES[match.group(2).upper()]
+
+
+def _Reflink(source, dest):
+    """Makes |dest| a copy-on-write clone of |source|, if supported."""
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOTSUP, 'reflinks are not supported')
+    import fcntl
+    with open(source, 'rb') as s, open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dest)
+            raise
+    shutil.copymode(source, dest)
+
+
+def _Touch(path):
+    """Sets the mtime of |path| to now, creating it if needed."""
+    with open(path, 'a'):
+        pass
+    os.utime(path)
+
+
+def _Signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def _Hash(path, algorithm):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _Link(source, dest):
+    """Creates |dest| with the contents and mode of |source|, as cheaply as
+    possible."""
+    try:
+        os.link(source, dest)
+        return
+    except OSError as e:
+        logging.debug('Could not hardlink %s to %s: %s', source, dest, e)
+    try:
+        _Reflink(source, dest)
+        return
+    except OSError as e:
+        logging.debug('Could not reflink %s to %s: %s', source, dest, e)
+    shutil.copy2(source, dest)
+
+
+class Store(object):
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def _Path(self, algorithm, digest):
+        return os.path.join(self.path, algorithm, digest[:2], digest)
+
+    def _Remove(self, path):
+        """Removes the object |path| and its sidecar files."""
+        for suffix in ('', ) + _SIDECAR_SUFFIXES:
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _RecordVerified(self, path):
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(_Signature(path), f)
+            os.replace(tmp, path + _VERIFIED_SUFFIX)
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+
+    def _Verify(self, algorithm, digest, path):
+        """Returns whether the object |path| still has the |algorithm|
+        |digest|. Hashes it only if it changed since it was last verified, and
+        removes it if it doesn't match."""
+        try:
+            with open(path + _VERIFIED_SUFFIX) as f:
+                if json.load(f) == _Signature(path):
+                    return True
+        except (OSError, ValueError):
+            pass
+        valid = _Hash(path, algorithm) == digest
+        if valid:
+            self._RecordVerified(path)
+        else:
+            logging.warning('Removing %s from the store, its contents changed.',
+                            path)
+            self._Remove(path)
+        return valid
+
+    def materialize(self, algorithm, digest, output, size=None):
+        """Creates |output| from the stored object with the |algorithm|
+        |digest|, if there is one of |size| bytes which still matches
+        |digest|.
+
+        Returns whether |output| was created.
+        """
+        path = self._Path(algorithm, digest)
+        try:
+            if size is not None and os.path.getsize(path) != size:
+                return False
+            if not self._Verify(algorithm, digest, path):
+                return False
+            if os.path.lexists(output):
+                os.remove(output)
+            _Link(path, output)
+            _Touch(path + _USED_SUFFIX)
+        except FileNotFoundError:
+            # Not stored, or evicted concurrently.
+            return False
+        return True
+
+    def add(self, algorithm, digest, path):
+        """Adds the file |path| whose |algorithm| digest was verified to be
+        |digest|, then evicts objects if the store is too large."""
+        dest = self._Path(algorithm, digest)
+        if os.path.exists(dest):
+            _Touch(dest + _USED_SUFFIX)
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = '%s.%s.tmp' % (dest, uuid.uuid4().hex)
+        try:
+            _Link(path, tmp)
+            os.replace(tmp, dest)
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+        self._RecordVerified(dest)
+        _Touch(dest + _USED_SUFFIX)
+        self.evict()
+
+    def _Objects(self):
+        """Yields the (last used time, size, path) of each stored object."""
+        for algorithm in os.listdir(self.path):
+            root = os.path.join(self.path, algorithm)
+            if not os.path.isdir(root):
+                continue
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    if name.endswith(('.tmp', ) + _SIDECAR_SUFFIXES):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    try:
+                        used = os.stat(path + _USED_SUFFIX).st_mtime
+                    except FileNotFoundError:
+                        used = st.st_mtime
+                    yield used, st.st_size, path
+
+    def evict(self):
+        """Removes the least recently used objects until the store fits in
+        max_size."""
+        try:
+            with lockfile.lock(os.path.join(self.path, 'evict')):
+                objects = sorted(self._Objects())
+                total = sum(size for _, size, _ in objects)
+                for _, size, path in objects:
+                    if total <= self.max_size:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        # E.g. opened by another process on Windows.
+                        logging.info('Could not evict %s: %s', path, e)
+                        continue
+                    total -= size
+                    self._Remove(path)
+        except lockfile.LockError:
+            # Another process is evicting objects.
+            pass
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def GetStore():
+    """Returns the Store configured by the environment, or None."""
+    global _default_store
+    path = os.environ.get(STORE_ENV_VAR)
+    if not path:
+        return None
+    with _default_store_lock:
+        if _default_store is None or _default_store.path != path:
+            max_size = DEFAULT_MAX_SIZE
+            if os.environ.get(MAX_SIZE_ENV_VAR):
+                max_size = ParseSize(os.environ[MAX_SIZE_ENV_VAR])
+            os.makedirs(path, exist_ok=True)
+            _default_store = Store(path, max_size)
+        return _default_store
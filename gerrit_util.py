@@ -10,6 +10,7 @@ https://gerrit-review.googlesource.com/Documentation/rest-api.html
 from __future__ import annotations
 
 import base64
+import collections
 import contextlib
 import http.cookiejar
 import json
@@ -19,6 +20,7 @@ import random
 import re
 import socket
 import tempfile
+import threading
 import time
 import urllib.parse
 
@@ -405,6 +407,66 @@ class LuciContextAuthenticator(Authenticator):
         return ''
 
 
+_authenticator: Optional[Authenticator] = None
+_authenticator_lock = threading.Lock()
+
+
+def _GetAuthenticator() -> Authenticator:
+    """Returns the Authenticator used for the requests of this process.
+
+    It is identified on first use, so that requests don't probe the
+    environment and parse the credentials each time.
+    """
+    global _authenticator
+    with _authenticator_lock:
+        if _authenticator is None:
+            _authenticator = Authenticator.get()
+            # TODO(crbug.com/1059384): Automatically detect when running on
+            # cloudtop.
+            if isinstance(_authenticator, GceAuthenticator):
+                print('If you\'re on a cloudtop instance, export '
+                      'SKIP_GCE_AUTH_FOR_GIT=1 in your env.')
+        return _authenticator
+
+
+class _ConnectionPool(object):
+    """Keeps the connections of finished requests open, so that the next
+    requests to the same host don't pay a new TCP and TLS handshake.
+
+    Each set of connections is used by one request at a time, and at most
+    MAX_CONCURRENT_CONNECTION idle ones are kept per host.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Maps (host, timeout) to the idle httplib2 connection dicts.
+        self._idle = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def connections(self, host, timeout):
+        key = (host, timeout)
+        with self._lock:
+            connections = self._idle[key].pop() if self._idle[key] else {}
+        try:
+            yield connections
+        except BaseException:
+            # The connections may be in the middle of a request.
+            self._close(connections)
+            raise
+        with self._lock:
+            if len(self._idle[key]) < MAX_CONCURRENT_CONNECTION:
+                self._idle[key].append(connections)
+                return
+        self._close(connections)
+
+    @staticmethod
+    def _close(connections):
+        for conn in connections.values():
+            conn.close()
+
+
+_connection_pool = _ConnectionPool()
+
+
 class ReqParams(TypedDict):
     uri: str
     method: str
@@ -425,6 +487,16 @@ class HttpConn(httplib2.Http):
         self.req_body = req_body
         super().__init__(*args, **kwargs)
 
+    def request(self, *args, **kwargs):
+        # Reuses the connections of the previous requests to the host.
+        with _connection_pool.connections(self.req_host,
+                                          self.timeout) as connections:
+            self.connections = connections
+            try:
+                return super().request(*args, **kwargs)
+            finally:
+                self.connections = {}
+
     @property
     def req_params(self) -> ReqParams:
         return {
@@ -464,13 +536,7 @@ def CreateHttpConn(host,
                     req_headers=headers,
                     req_body=rendered_body)
 
-    authenticator = Authenticator.get()
-    # TODO(crbug.com/1059384): Automatically detect when running on cloudtop.
-    if isinstance(authenticator, GceAuthenticator):
-        print('If you\'re on a cloudtop instance, export '
-              'SKIP_GCE_AUTH_FOR_GIT=1 in your env.')
-
-    authenticator.authenticate(conn)
+    _GetAuthenticator().authenticate(conn)
 
     if 'Authorization' not in conn.req_headers:
         LOGGER.debug('No authorization found for %s.' % bare_host)
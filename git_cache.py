@@ -5,6 +5,8 @@
 """A git command for managing a local cache of git repositories."""
 
 import contextlib
+import hashlib
+import json
 import logging
 import optparse
 import os
@@ -28,6 +30,27 @@ GC_AUTOPACKLIMIT = 50
 GIT_CACHE_CORRUPT_MESSAGE = 'WARNING: The Git cache is corrupt.'
 INIT_SENTIENT_FILE = ".mirror_init"
 
+# Lists the size and sha256 of each pack file of a bootstrap. It is written
+# into the mirror by update_bootstrap, and so uploaded with each bootstrap.
+BOOTSTRAP_MANIFEST = 'bootstrap_manifest.json'
+# update_bootstrap packs the objects added since the previous bootstrap into a
+# new pack, so that mirrors only download that pack, until there would be more
+# packs than this. Then it repacks everything again.
+MAX_BOOTSTRAP_PACKS = 10
+# The content of the .keep files marking the packs of the bootstrap, which
+# must not be repacked.
+BOOTSTRAP_KEEP_MESSAGE = 'git cache bootstrap\n'
+PACK_FILE_EXTENSIONS = ('.pack', '.idx', '.rev', '.bitmap')
+# Fetches update the refs under this prefix, e.g. refs/heads/main is fetched
+# into refs/git-cache/staging/refs/heads/main, then all the fetched refs are
+# updated at once. The refs under it are hidden from the clones of the mirror.
+STAGING_REFS = 'refs/git-cache/staging/'
+# How long to wait for the readers of a mirror before deleting or replacing it,
+# and for readers to wait for that.
+READERS_LOCK_TIMEOUT = 30 * 60
+# Packs at least this large are never repacked by 'git cache maintenance'.
+MAINTENANCE_KEEP_SIZE = 1024 * 1024 * 1024
+
 # gsutil creates many processes and threads. Creating too many gsutil cp
 # processes may result in running out of resources, and may perform worse due to
 # contextr switching. This limits how many concurrent gsutil cp processes
@@ -47,6 +70,23 @@ class ClobberNeeded(Exception):
     pass
 
 
+def _RefMatches(pattern, ref):
+    """Returns whether |ref| matches the refspec side |pattern|."""
+    if '*' not in pattern:
+        return ref == pattern
+    prefix, suffix = pattern.split('*', 1)
+    return (len(ref) >= len(prefix) + len(suffix) and ref.startswith(prefix)
+            and ref.endswith(suffix))
+
+
+def _FileSha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
 def exponential_backoff_retry(fn,
                               excs=(Exception, ),
                               name=None,
@@ -113,10 +153,18 @@ class Mirror(object):
         regex = r'\+%s:.*' % src.replace('*', r'\*')
         return ('+%s:%s' % (src, dest), regex)
 
-    def __init__(self, url, refs=None, commits=None, print_func=None):
+    def __init__(self,
+                 url,
+                 refs=None,
+                 commits=None,
+                 print_func=None,
+                 filter_spec=None):
         self.url = url
         self.fetch_specs = {self.parse_fetch_spec(ref) for ref in (refs or [])}
         self.fetch_commits = set(commits or [])
+        # The --filter of a partial mirror, e.g. 'blob:none'. It is kept in the
+        # mirror's config, so it only needs to be passed when creating it.
+        self.filter_spec = filter_spec
         self.basedir = self.UrlToCacheDir(url)
         self.mirror_path = os.path.join(self.GetCachePath(), self.basedir)
         if print_func:
@@ -291,6 +339,17 @@ class Mirror(object):
         ])
 
         self.RunGit(['config', 'remote.origin.url', self.url])
+        self.RunGit([
+            'config', '--replace-all', 'uploadpack.hideRefs', STAGING_REFS,
+            '^%s$' % re.escape(STAGING_REFS)
+        ])
+        if self.filter_spec:
+            # Makes every fetch from origin a partial one, and lets git fetch
+            # the missing objects from origin on demand.
+            self.RunGit(['config', 'remote.origin.promisor', 'true'])
+            self.RunGit([
+                'config', 'remote.origin.partialclonefilter', self.filter_spec
+            ])
         self.RunGit([
             'config', '--replace-all', 'remote.origin.fetch',
             '+refs/heads/*:refs/heads/*', r'\+refs/heads/\*:.*'
@@ -345,12 +404,170 @@ class Mirror(object):
             self.print('Encountered error: %s' % str(e), file=sys.stderr)
             gclient_utils.rmtree(tempdir)
             return False
-        # delete the old directory
-        if os.path.exists(directory):
-            gclient_utils.rmtree(directory)
-        self.Rename(tempdir, directory)
+        with self._replace_lock():
+            # delete the old directory
+            if os.path.exists(directory):
+                gclient_utils.rmtree(directory)
+            self.Rename(tempdir, directory)
+        return True
+
+    @property
+    def _pack_dir(self):
+        return os.path.join(self.mirror_path, 'objects', 'pack')
+
+    def _read_bootstrap_manifest(self):
+        """Returns the manifest of the bootstrap which the mirror was last
+        updated from or uploaded to, or None."""
+        path = os.path.join(self.mirror_path, BOOTSTRAP_MANIFEST)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                return self._parse_bootstrap_manifest(f.read())
+        except (IOError, ValueError) as e:
+            logging.warning('Ignoring invalid %s: %s' % (path, e))
+            return None
+
+    @staticmethod
+    def _parse_bootstrap_manifest(content):
+        manifest = json.loads(content)
+        if not isinstance(manifest, dict) or not isinstance(
+                manifest.get('files'), dict):
+            raise ValueError('no files in the bootstrap manifest')
+        for name, entry in manifest['files'].items():
+            if (not re.match(r'^pack-[0-9a-f]+\.(pack|idx|rev|bitmap)$', name)
+                    or not isinstance(entry, dict)
+                    or not isinstance(entry.get('size'), int)
+                    or not isinstance(entry.get('sha256'), str)):
+                raise ValueError('invalid bootstrap manifest entry %r' % name)
+        return manifest
+
+    def _write_bootstrap_manifest(self, manifest):
+        fd, tmp = tempfile.mkstemp(prefix=BOOTSTRAP_MANIFEST,
+                                   dir=self.mirror_path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp, os.path.join(self.mirror_path, BOOTSTRAP_MANIFEST))
+
+    def _keep_packs(self, names):
+        """Marks the packs |names| (e.g. 'pack-<hash>') with a .keep file, so
+        that repacking leaves them alone, and unmarks the others."""
+        for name in os.listdir(self._pack_dir):
+            if not name.endswith('.pack'):
+                continue
+            keep = os.path.join(self._pack_dir, name[:-len('.pack')] + '.keep')
+            if name[:-len('.pack')] in names:
+                if not os.path.exists(keep):
+                    with open(keep, 'w') as f:
+                        f.write(BOOTSTRAP_KEEP_MESSAGE)
+                continue
+            # Leave the .keep files created by git alone.
+            try:
+                with open(keep) as f:
+                    if f.read() != BOOTSTRAP_KEEP_MESSAGE:
+                        continue
+            except FileNotFoundError:
+                continue
+            os.remove(keep)
+
+    def bootstrap_incrementally(self):
+        """Downloads the pack files of the latest bootstrap which the mirror
+        lacks, then repacks the packs fetched since into one.
+
+        This only works if the mirror shares packs with the latest bootstrap,
+        e.g. if it was bootstrapped from an earlier one. Returns whether the
+        mirror was updated.
+        """
+        manifest = self._read_bootstrap_manifest()
+        if not self.bootstrap_bucket or not manifest:
+            return False
+
+        gsutil = Gsutil(self.gsutil_exe, boto_path=None)
+        _, ls_out, _ = gsutil.check_call('ls', self._gs_path)
+        latest_dir = self._GetMostRecentCacheDirectory(
+            set(ls_out.strip().splitlines()))
+        if not latest_dir:
+            return False
+        code, out, err = gsutil.check_call(
+            'cat', '%s/%s' % (latest_dir, BOOTSTRAP_MANIFEST))
+        if code:
+            self.print('No bootstrap manifest in %s, stderr:\n  %s' %
+                       (latest_dir, '  '.join(err.splitlines(True))))
+            return False
+        try:
+            latest = self._parse_bootstrap_manifest(out)
+        except ValueError as e:
+            self.print('Invalid bootstrap manifest in %s: %s' % (latest_dir, e),
+                       file=sys.stderr)
+            return False
+
+        files = latest['files']
+        present = {
+            name
+            for name in files
+            if os.path.exists(os.path.join(self._pack_dir, name))
+        }
+        if not any(name.endswith('.pack') for name in present):
+            # Nothing in common, e.g. everything was repacked since. A full
+            # bootstrap replaces the mirror rather than adding to it.
+            return False
+        missing = sorted(set(files) - present)
+        self.print('Downloading %d of the %d pack files of %s.' %
+                   (len(missing), len(files), latest_dir))
+
+        tempdir = tempfile.mkdtemp(prefix='_cache_tmp', dir=self.GetCachePath())
+        try:
+            if missing:
+                with self.print_duration_of('download'):
+                    with GSUTIL_CP_SEMAPHORE:
+                        code = gsutil.call(
+                            '-m', 'cp', *[
+                                '%s/objects/pack/%s' % (latest_dir, name)
+                                for name in missing
+                            ], tempdir)
+                if code:
+                    return False
+            for name in missing:
+                path = os.path.join(tempdir, name)
+                if (not os.path.isfile(path)
+                        or os.path.getsize(path) != files[name]['size']
+                        or _FileSha256(path) != files[name]['sha256']):
+                    self.print('%s does not match the bootstrap manifest.' %
+                               name,
+                               file=sys.stderr)
+                    return False
+            # git ignores packs until their index exists, so move it last.
+            for name in sorted(missing, key=lambda n: n.endswith('.idx')):
+                os.replace(os.path.join(tempdir, name),
+                           os.path.join(self._pack_dir, name))
+        finally:
+            gclient_utils.rmtree(tempdir)
+
+        self._keep_packs(
+            {name[:-len('.pack')]
+             for name in files if name.endswith('.pack')})
+        with self.print_duration_of('repack'):
+            self.RunGit(['repack', '-a', '-d'])
+        self._write_bootstrap_manifest(latest)
         return True
 
+    def read_lock(self):
+        """Keeps the mirror from being deleted or replaced while reading it,
+        e.g. cloning from it.
+
+        Any number of processes can read the mirror at once, and fetches into
+        the mirror don't wait for them.
+        """
+        return lockfile.lock(self.mirror_path + '.readers',
+                             READERS_LOCK_TIMEOUT,
+                             shared=True)
+
+    def _replace_lock(self):
+        """Waits for the readers of the mirror, then keeps new readers out
+        while the mirror is deleted or replaced."""
+        return lockfile.lock(self.mirror_path + '.readers',
+                             READERS_LOCK_TIMEOUT)
+
     def contains_revision(self, revision):
         if not self.exists():
             return False
@@ -364,7 +581,10 @@ class Mirror(object):
         try:
             # cat-file exits with 0 on success, that is git object of given hash
             # was found.
-            self.RunGit(['cat-file', '-e', needle])
+            with self.read_lock():
+                if not self.exists():
+                    return False
+                self.RunGit(['cat-file', '-e', needle])
             return True
         except subprocess.CalledProcessError:
             self.print('Commit with hash "%s" not found' % revision,
@@ -381,6 +601,22 @@ class Mirror(object):
             'chromium.googlesource.com', 'chrome-internal.googlesource.com'
         ]
 
+    def _preserve_filter_spec(self):
+        """Reads the filter of an existing partial mirror.
+
+        This modifies self.filter_spec.
+        """
+        if self.filter_spec or not self.exists():
+            return
+        try:
+            self.filter_spec = subprocess.check_output([
+                self.git_exe, '--git-dir', self.mirror_path, 'config',
+                'remote.origin.partialclonefilter'
+            ]).decode('utf-8', 'ignore').strip() or None
+        except subprocess.CalledProcessError:
+            # Not a partial mirror.
+            pass
+
     def _preserve_fetchspec(self):
         """Read and preserve remote.origin.fetch from an existing mirror.
 
@@ -436,7 +672,8 @@ class Mirror(object):
 
             if show_ref_master_cmd.returncode != 0:
                 # Remove mirror
-                gclient_utils.rmtree(self.mirror_path)
+                with self._replace_lock():
+                    gclient_utils.rmtree(self.mirror_path)
 
                 # force bootstrap
                 force = True
@@ -457,13 +694,20 @@ class Mirror(object):
                 # If the mirror path exists but self.exists() returns false,
                 # we're in an unexpected state. Nuke the previous mirror
                 # directory and start fresh.
-                gclient_utils.rmtree(self.mirror_path)
+                with self._replace_lock():
+                    gclient_utils.rmtree(self.mirror_path)
             os.mkdir(self.mirror_path)
+        elif (not force and pack_files and not depth and bootstrap
+              and not self.filter_spec and self.bootstrap_incrementally()):
+            # Too many packs; replaced them with those of the latest
+            # bootstrap without downloading it all again.
+            return
         elif not reset_fetch_config:
             # Re-bootstrapping an existing mirror; preserve existing fetch spec.
             self._preserve_fetchspec()
 
-        bootstrapped = (not depth and bootstrap
+        # Bootstraps contain every blob, which partial mirrors don't want.
+        bootstrapped = (not depth and bootstrap and not self.filter_spec
                         and self.bootstrap_repo(self.mirror_path))
 
         if not bootstrapped:
@@ -497,6 +741,92 @@ class Mirror(object):
             self.RunGit(['symbolic-ref', 'HEAD', 'refs/heads/' + m.groups()[0]])
 
 
+    def _fetch_specs(self, fetch_cmd, specs):
+        """Fetches the refspecs or commits |specs| with |fetch_cmd|.
+
+        They are all fetched at once, so that the mirror negotiates with the
+        server once rather than once per spec. If that fails, they are fetched
+        one by one to find the ones which fail.
+
+        Returns the specs which could not be fetched.
+        """
+        if len(specs) > 1:
+            self.print('Fetching %s' % ' '.join(specs))
+            try:
+                with self.print_duration_of('fetch of %d specs' % len(specs)):
+                    self.RunGit(fetch_cmd + specs)
+                return []
+            except subprocess.CalledProcessError:
+                logging.warning('Fetch of %d specs failed, fetching them one '
+                                'by one' % len(specs))
+        failed = []
+        for spec in specs:
+            self.print('Fetching %s' % spec)
+            try:
+                with self.print_duration_of('fetch %s' % spec):
+                    self.RunGit(fetch_cmd + [spec], retry=True)
+            except subprocess.CalledProcessError:
+                failed.append(spec)
+        return failed
+
+    @staticmethod
+    def _staged_spec(spec):
+        """Returns |spec| fetching into the staging refs."""
+        if ':' not in spec:
+            return spec
+        src, dest = spec.split(':', 1)
+        return '%s:%s%s' % (src, STAGING_REFS, dest)
+
+    def _publish_refs(self, fetch_specs, prune):
+        """Updates the refs fetched by |fetch_specs| to their staged value in
+        a single transaction, and deletes the ones which are not staged
+        anymore if |prune| is set."""
+        patterns = [
+            spec.split(':', 1)[1] for spec in fetch_specs if ':' in spec
+        ]
+        staged = {}
+        current = {}
+        for line in self.RunGit(
+            ['for-each-ref', '--format=%(objectname) %(refname)'],
+                print_stdout=False).decode('utf-8', 'ignore').splitlines():
+            sha, ref = line.split(' ', 1)
+            if ref.startswith(STAGING_REFS):
+                staged[ref[len(STAGING_REFS):]] = sha
+            else:
+                current[ref] = sha
+        deletes = [
+            'delete %s %s\n' % (ref, sha)
+            for ref, sha in sorted(current.items())
+            if (prune and ref not in staged and any(
+                _RefMatches(p, ref) for p in patterns))
+        ]
+        updates = [
+            'update %s %s\n' % (ref, sha) for ref, sha in sorted(staged.items())
+            if (current.get(ref) != sha and any(
+                _RefMatches(p, ref) for p in patterns))
+        ]
+        if not deletes and not updates:
+            return
+        self.print('Updating %d refs' % (len(deletes) + len(updates)))
+        # A ref can't be created in the same transaction as the deletion of a
+        # ref conflicting with it, e.g. refs/heads/foo/bar and refs/heads/foo.
+        deleted = [line.split()[1] for line in deletes]
+        updated = [line.split()[1] for line in updates]
+        if any(
+                ref.startswith(d + '/') or d.startswith(ref + '/')
+                for ref in updated for d in deleted):
+            transactions = [deletes, updates]
+        else:
+            transactions = [deletes + updates]
+        for commands in transactions:
+            subprocess.run([
+                self.git_exe, '--git-dir',
+                os.path.abspath(self.mirror_path), 'update-ref', '--stdin'
+            ],
+                           input=''.join(commands).encode('utf-8'),
+                           cwd=self.mirror_path,
+                           check=True)
+
     def _fetch(self,
                verbose,
                depth,
@@ -514,7 +844,9 @@ class Mirror(object):
             fetch_cmd.append('--no-tags')
         if prune:
             fetch_cmd.append('--prune')
-        fetch_cmd.append('origin')
+        # Only the staging refs are updated by the fetch, not the ones matching
+        # remote.origin.fetch.
+        fetch_cmd.extend(['--refmap=', 'origin'])
 
         fetch_specs = subprocess.check_output(
             [
@@ -524,22 +856,23 @@ class Mirror(object):
             ],
             cwd=self.mirror_path).decode('utf-8',
                                          'ignore').strip().splitlines()
-        for spec in fetch_specs:
-            try:
-                self.print('Fetching %s' % spec)
-                with self.print_duration_of('fetch %s' % spec):
-                    self.RunGit(fetch_cmd + [spec], retry=True)
-            except subprocess.CalledProcessError:
-                if spec == '+refs/heads/*:refs/heads/*':
-                    raise ClobberNeeded()  # Corrupted cache.
-                logging.warning('Fetch of %s failed' % spec)
-        for commit in self.fetch_commits:
-            self.print('Fetching %s' % commit)
-            try:
-                with self.print_duration_of('fetch %s' % commit):
-                    self.RunGit(['fetch', 'origin', commit], retry=True)
-            except subprocess.CalledProcessError:
-                logging.warning('Fetch of %s failed' % commit)
+        # Readers of the mirror see either none or all of the fetched refs.
+        staged_specs = [self._staged_spec(spec) for spec in fetch_specs]
+        commits = sorted(self.fetch_commits)
+        if depth:
+            # Commits are fetched with their full history.
+            failed = self._fetch_specs(fetch_cmd, staged_specs)
+            failed += self._fetch_specs(['fetch', 'origin'], commits)
+        else:
+            failed = self._fetch_specs(fetch_cmd, staged_specs + commits)
+        if self._staged_spec('+refs/heads/*:refs/heads/*') in failed:
+            raise ClobberNeeded()  # Corrupted cache.
+        for spec in failed:
+            logging.warning('Fetch of %s failed' % spec)
+        self._publish_refs([
+            spec for spec, staged_spec in zip(fetch_specs, staged_specs)
+            if staged_spec not in failed
+        ], prune)
         if os.path.isfile(self._init_sentient_file):
             os.remove(self._init_sentient_file)
 
@@ -572,9 +905,11 @@ class Mirror(object):
 
         def wipe_cache():
             self.print(GIT_CACHE_CORRUPT_MESSAGE)
-            gclient_utils.rmtree(self.mirror_path)
+            with self._replace_lock():
+                gclient_utils.rmtree(self.mirror_path)
 
         with lockfile.lock(self.mirror_path, lock_timeout):
+            self._preserve_filter_spec()
             if os.path.isfile(self._init_sentient_file):
                 # Previous bootstrap didn't finish
                 wipe_cache()
@@ -588,6 +923,10 @@ class Mirror(object):
                 bootstrap_cache(force=True)
 
     def update_bootstrap(self, prune=False, gc_aggressive=False):
+        self._preserve_filter_spec()
+        if self.filter_spec:
+            raise RuntimeError('%s is a partial mirror, it can\'t be used as a '
+                               'bootstrap.' % self.mirror_path)
         # NOTE: There have been cases where repos were being recursively
         # uploaded to google storage. E.g.
         # `<host_url>-<repo>/<gen_number>/<host_url>-<repo>/` in GS and
@@ -627,6 +966,76 @@ class Mirror(object):
         # Reduce the number of individual files to download & write on disk.
         self.RunGit(['pack-refs', '--all'])
 
+        self._repack_for_bootstrap(gc_aggressive)
+
+        self.print('running "gsutil -m rsync -r -d %s %s"' %
+                   (self.mirror_path, dest_prefix))
+        gsutil.call('-m', 'rsync', '-r', '-d', self.mirror_path, dest_prefix)
+
+        # Create .ready file and upload
+        _, ready_file_name = tempfile.mkstemp(suffix='.ready')
+        try:
+            self.print('running "gsutil cp %s %s.ready"' %
+                       (ready_file_name, dest_prefix))
+            gsutil.call('cp', ready_file_name, '%s.ready' % (dest_prefix))
+        finally:
+            os.remove(ready_file_name)
+
+        # remove all other directory/.ready files in the same gs_path
+        # except for the directory/.ready file previously created
+        # which can be used for bootstrapping while the current one is
+        # being uploaded
+        if not prune:
+            return
+        prev_dest_prefix = self._GetMostRecentCacheDirectory(ls_out_set)
+        if not prev_dest_prefix:
+            return
+        for path in ls_out_set:
+            if path in (prev_dest_prefix + '/', prev_dest_prefix + '.ready'):
+                continue
+            if path.endswith('.ready'):
+                gsutil.call('rm', path)
+                continue
+            gsutil.call('-m', 'rm', '-r', path)
+
+    def _pack_files_manifest(self, previous=None):
+        """Returns the manifest of the pack files of the mirror, reusing the
+        checksums of the files listed in |previous|."""
+        previous_files = (previous or {}).get('files', {})
+        files = {}
+        for name in sorted(os.listdir(self._pack_dir)):
+            if (not name.startswith('pack-')
+                    or not name.endswith(PACK_FILE_EXTENSIONS)):
+                continue
+            path = os.path.join(self._pack_dir, name)
+            size = os.path.getsize(path)
+            # Pack files are named after their content.
+            if previous_files.get(name, {}).get('size') == size:
+                files[name] = previous_files[name]
+            else:
+                files[name] = {'size': size, 'sha256': _FileSha256(path)}
+        return {'files': files}
+
+    def _repack_for_bootstrap(self, gc_aggressive=False):
+        """Packs the mirror to be uploaded as a bootstrap, and writes its
+        manifest."""
+        manifest = self._read_bootstrap_manifest()
+        packs = {
+            name[:-len('.pack')]
+            for name in (manifest or {}).get('files', {})
+            if name.endswith('.pack')
+        }
+        if (packs and not gc_aggressive and len(packs) < MAX_BOOTSTRAP_PACKS
+                and all(
+                    os.path.exists(os.path.join(self._pack_dir, name + '.pack'))
+                    for name in packs)):
+            # Only pack the objects added since the previous bootstrap, so
+            # that the mirrors bootstrapped from it only download them.
+            self._keep_packs(packs)
+            self.RunGit(['repack', '-a', '-d'])
+            self._write_bootstrap_manifest(self._pack_files_manifest(manifest))
+            return
+
         # Run Garbage Collect to compress packfile.
         gc_args = ['gc', '--prune=all']
         if gc_aggressive:
@@ -657,37 +1066,42 @@ class Mirror(object):
             # didn't show much difference in outcomes on our current repos, but
             # it might be worth trying if the repos grow much larger and the
             # packs don't seem to be getting compressed enough.
+        self._keep_packs(set())
         self.RunGit(gc_args)
+        self._write_bootstrap_manifest(self._pack_files_manifest())
 
-        self.print('running "gsutil -m rsync -r -d %s %s"' %
-                   (self.mirror_path, dest_prefix))
-        gsutil.call('-m', 'rsync', '-r', '-d', self.mirror_path, dest_prefix)
-
-        # Create .ready file and upload
-        _, ready_file_name = tempfile.mkstemp(suffix='.ready')
-        try:
-            self.print('running "gsutil cp %s %s.ready"' %
-                       (ready_file_name, dest_prefix))
-            gsutil.call('cp', ready_file_name, '%s.ready' % (dest_prefix))
-        finally:
-            os.remove(ready_file_name)
+    def maintain(self, keep_size=MAINTENANCE_KEEP_SIZE, lock_timeout=0):
+        """Keeps the mirror fast to read without repacking all of it.
 
-        # remove all other directory/.ready files in the same gs_path
-        # except for the directory/.ready file previously created
-        # which can be used for bootstrapping while the current one is
-        # being uploaded
-        if not prune:
-            return
-        prev_dest_prefix = self._GetMostRecentCacheDirectory(ls_out_set)
-        if not prev_dest_prefix:
+        The packs of the bootstrap and the packs of at least |keep_size| bytes
+        are marked .keep, and the other packs are repacked geometrically, so
+        that there are few of them. Then a multi-pack-index with a bitmap and
+        an incremental commit-graph with Bloom filters, which speed up clones
+        and path-limited history walks, are written.
+        """
+        if not self.exists():
             return
-        for path in ls_out_set:
-            if path in (prev_dest_prefix + '/', prev_dest_prefix + '.ready'):
-                continue
-            if path.endswith('.ready'):
-                gsutil.call('rm', path)
-                continue
-            gsutil.call('-m', 'rm', '-r', path)
+        with lockfile.lock(self.mirror_path, lock_timeout):
+            manifest = self._read_bootstrap_manifest() or {'files': {}}
+            keep = {
+                name[:-len('.pack')]
+                for name in manifest['files'] if name.endswith('.pack')
+            }
+            for name in os.listdir(self._pack_dir):
+                if (name.endswith('.pack') and os.path.getsize(
+                        os.path.join(self._pack_dir, name)) >= keep_size):
+                    keep.add(name[:-len('.pack')])
+            self._keep_packs(keep)
+            with self.print_duration_of('repack'):
+                self.RunGit([
+                    'repack', '-d', '-l', '--geometric=2', '--write-midx',
+                    '--write-bitmap-index'
+                ])
+            with self.print_duration_of('commit-graph'):
+                self.RunGit([
+                    'commit-graph', 'write', '--reachable', '--split',
+                    '--changed-paths'
+                ])
 
     @staticmethod
     def DeleteTmpPackFiles(path):
@@ -808,6 +1222,11 @@ def CMDpopulate(parser, args):
         action='store_true',
         default=False,
         help='Reset the fetch config before populating the cache.')
+    parser.add_option(
+        '--filter',
+        help=('Create a partial mirror, e.g. with --filter=blob:none for bots '
+              'which only need the history. Missing objects are fetched on '
+              'demand. Only needed when creating the mirror.'))
 
     options, args = parser.parse_args(args)
     if not len(args) == 1:
@@ -818,7 +1237,10 @@ def CMDpopulate(parser, args):
         print('break_locks is no longer used. Please remove its usage.')
     url = args[0]
 
-    mirror = Mirror(url, refs=options.ref, commits=options.commit)
+    mirror = Mirror(url,
+                    refs=options.ref,
+                    commits=options.commit,
+                    filter_spec=options.filter)
     kwargs = {
         'no_fetch_tags': options.no_fetch_tags,
         'verbose': options.verbose,
@@ -832,6 +1254,58 @@ def CMDpopulate(parser, args):
     mirror.populate(**kwargs)
 
 
+@subcommand.usage('[url of repo to maintain]')
+@metrics.collector.collect_metrics('git cache maintenance')
+def CMDmaintenance(parser, args):
+    """Repack and index mirrors incrementally, to keep them fast to read.
+
+    Meant to be run periodically, e.g. hourly. Mirrors locked by another git
+    cache command are skipped, unless --timeout allows waiting for them.
+    """
+    if gclient_utils.IsEnvCog():
+        print('maintaining cache is not supported in non-git environment.',
+              file=sys.stderr)
+        return 1
+
+    parser.add_option('--all',
+                      action='store_true',
+                      help='Maintain all the mirrors in the cache')
+    parser.add_option(
+        '--keep-size-mb',
+        type='int',
+        default=MAINTENANCE_KEEP_SIZE // (1024 * 1024),
+        help='Never repack the packs of at least this size, in MiB')
+    options, args = parser.parse_args(args)
+    if options.all == bool(args):
+        parser.error('git cache maintenance takes either --all or exactly one '
+                     'repo url.')
+    mirrors = [Mirror(url) for url in args]
+    if options.all:
+        cachepath = Mirror.GetCachePath()
+        for name in sorted(os.listdir(cachepath)):
+            path = os.path.join(cachepath, name)
+            if (name.startswith('_cache_tmp')
+                    or not os.path.isfile(os.path.join(path, 'config'))):
+                continue
+            mirror = Mirror.FromPath(path)
+            # Mirrors of local repos don't map back to their path.
+            mirror.mirror_path = path
+            mirrors.append(mirror)
+
+    code = 0
+    for mirror in mirrors:
+        try:
+            mirror.maintain(options.keep_size_mb * 1024 * 1024,
+                            lock_timeout=options.timeout)
+        except lockfile.LockError:
+            print('Skipped %s, it is in use.' % mirror.mirror_path)
+        except subprocess.CalledProcessError as e:
+            print('Maintenance of %s failed: %s' % (mirror.mirror_path, e),
+                  file=sys.stderr)
+            code = 1
+    return code
+
+
 @subcommand.usage('Fetch new commits into cache and current checkout')
 @metrics.collector.collect_metrics('git cache fetch')
 def CMDfetch(parser, args):
@@ -890,6 +890,17 @@ class Settings(object):
             return False
         return None
 
+    def GetUsePresubmitCache(self):
+        """Returns True if presubmit checks that passed before can be skipped
+        when neither they nor the files of the change under their directory
+        were modified since.
+
+        The description of the change, modules imported by PRESUBMIT.py and
+        other files read by the checks are not considered, see
+        presubmit_support --use_cache.
+        """
+        return self._GetConfig('presubmit.use-cache').lower() == 'true'
+
     def GetIsGerrit(self):
         """Return True if gerrit.host is set."""
         if self.is_gerrit is None:
@@ -1720,6 +1731,8 @@ class Changelist(object):
             args.append('--source_controlled_only')
         if files or all_files:
             args.append('--no_diffs')
+        if not committing and settings.GetUsePresubmitCache():
+            args.append('--use_cache')
 
         if resultdb and not realm:
             # TODO (crbug.com/1113463): store realm somewhere and look it up so
@@ -4671,9 +4684,9 @@ def CMDlint(parser, args):
         extra_check_functions = [
             cpplint_chromium.CheckPointerDeclarationWhitespace
         ]
-        for file in files_to_lint:
-            cpplint.ProcessFile(file, cpplint._cpplint_state.verbose_level,
-                                extra_check_functions)
+        cpplint.ProcessFiles(files_to_lint,
+                             cpplint._cpplint_state.verbose_level,
+                             extra_check_functions)
     finally:
         os.chdir(previous_cwd)
 
@@ -25,6 +25,7 @@ IMapIterator.next = wrapper(IMapIterator.next)
 IMapIterator.__next__ = IMapIterator.next
 # TODO(iannucci): Monkeypatch all other 'wait' methods too.
 
+import atexit
 import binascii
 import collections
 import contextlib
@@ -616,10 +617,22 @@ def get_or_create_merge_base(branch, parent=None):
 
 
 def hash_multi(*reflike):
-    return run('rev-parse', *reflike).splitlines()
+    batch = CatFileBatch.for_repo()
+    hashes = []
+    for r in reflike:
+        info = None if '..' in r or r.startswith('^') else batch.info(r)
+        if not info:
+            # Let rev-parse handle ranges and report errors.
+            return run('rev-parse', *reflike).splitlines()
+        hashes.append(info[0])
+    return hashes
 
 
 def hash_one(reflike, short=False):
+    if not short:
+        info = CatFileBatch.for_repo().info(reflike)
+        if info:
+            return info[0]
     args = ['rev-parse', reflike]
     if short:
         args.insert(1, '--short')
@@ -895,6 +908,149 @@ def run_with_stderr(*cmd, **kwargs):
     return ret, err
 
 
+class CatFileBatch(object):
+    """A long-lived `git cat-file --batch` co-process for one repository.
+
+    Looking up objects and revisions through this class costs one round trip
+    over a pipe instead of one git process per lookup. The co-processes
+    (one for --batch-check and one for --batch, started on first use) are
+    shared by all the threads of this process; see |for_repo|. Only the
+    MAX_INSTANCES repositories used most recently keep their co-processes,
+    so that walking many checkouts doesn't leave a process and its pipes open
+    for each.
+
+    Lookups return None when git can't resolve the revision unambiguously, so
+    that callers can fall back to the equivalent git command and get its error
+    reporting.
+    """
+
+    MAX_INSTANCES = 8
+
+    _INSTANCES = collections.OrderedDict()
+    _INSTANCES_LOCK = threading.Lock()
+
+    def __init__(self, cwd):
+        self.cwd = cwd
+        self._lock = threading.Lock()
+        self._procs = {}
+        # Set once evicted from _INSTANCES, lookups then return None.
+        self._evicted = False
+
+    @classmethod
+    def for_repo(cls, cwd=None):
+        """Returns the shared CatFileBatch for the repository at |cwd|."""
+        cwd = os.path.abspath(cwd or os.getcwd())
+        evicted = []
+        with cls._INSTANCES_LOCK:
+            if cwd in cls._INSTANCES:
+                cls._INSTANCES.move_to_end(cwd)
+            else:
+                cls._INSTANCES[cwd] = cls(cwd)
+                while len(cls._INSTANCES) > cls.MAX_INSTANCES:
+                    evicted.append(cls._INSTANCES.popitem(last=False)[1])
+            instance = cls._INSTANCES[cwd]
+        for old in evicted:
+            old._evicted = True
+            old.close()
+        return instance
+
+    @classmethod
+    def close_all(cls):
+        """Stops every co-process. They are restarted on the next lookup."""
+        with cls._INSTANCES_LOCK:
+            instances = list(cls._INSTANCES.values())
+            cls._INSTANCES.clear()
+        for instance in instances:
+            instance.close()
+
+    def close(self):
+        with self._lock:
+            for proc in self._procs.values():
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+                proc.wait()
+            self._procs.clear()
+
+    def _proc(self, mode):
+        proc = self._procs.get(mode)
+        if proc and proc.poll() is None:
+            return proc
+        proc = subprocess2.Popen(
+            (GIT_EXE, '-c', 'color.ui=never', 'cat-file', mode),
+            cwd=self.cwd,
+            stdin=subprocess2.PIPE,
+            stdout=subprocess2.PIPE,
+            stderr=subprocess2.DEVNULL,
+            shell=False)
+        self._procs[mode] = proc
+        return proc
+
+    def _request(self, mode, rev):
+        """Returns the header fields and the raw output for |rev|, or None."""
+        if not rev or '\n' in rev or rev.startswith('-'):
+            return None
+        with self._lock:
+            if self._evicted:
+                return None
+            proc = self._proc(mode)
+            try:
+                proc.stdin.write(rev.encode('utf-8') + b'\n')
+                proc.stdin.flush()
+                header = proc.stdout.readline().decode('utf-8').split()
+                if len(header) != 3:
+                    # '<rev> missing' or '<rev> ambiguous'.
+                    return None
+                data = None
+                if mode == '--batch':
+                    size = int(header[2])
+                    data = proc.stdout.read(size + 1)[:size]
+            except (OSError, ValueError):
+                # The co-process died, restart it on the next request.
+                self._procs.pop(mode, None)
+                return None
+        return header, data
+
+    def info(self, rev):
+        """Returns (hash, type, size) for |rev|, or None."""
+        result = self._request('--batch-check', rev)
+        if not result:
+            return None
+        sha, typ, size = result[0]
+        return sha, typ, int(size)
+
+    def contents(self, rev):
+        """Returns (hash, type, raw bytes) for |rev|, or None."""
+        result = self._request('--batch', rev)
+        if not result:
+            return None
+        (sha, typ, _), data = result
+        return sha, typ, data
+
+
+atexit.register(CatFileBatch.close_all)
+
+
+def _parse_tree_object(data, hash_len):
+    """Yields (mode, type, hash, name) for each entry of a raw tree object."""
+    pos = 0
+    while pos < len(data):
+        space = data.index(b' ', pos)
+        nul = data.index(b'\0', space)
+        mode = data[pos:space].decode('ascii').zfill(6)
+        name = data[space + 1:nul].decode('utf-8', 'replace')
+        ref = binascii.hexlify(data[nul + 1:nul + 1 + hash_len]).decode('ascii')
+        pos = nul + 1 + hash_len
+        if mode == '040000':
+            typ = 'tree'
+        elif mode == '160000':
+            typ = 'commit'
+        else:
+            typ = 'blob'
+        yield mode, typ, ref, name
+
+
 def set_branch_config(branch, option, value, scope='local'):
     set_config('branch.%s.%s' % (branch, option), value, scope=scope)
 
@@ -1105,16 +1261,26 @@ def tree(treeref, recurse=False):
         ref is the hex encoded hash of the entry.
     """
     ret = {}
-    opts = ['ls-tree', '--full-tree']
-    if recurse:
-        opts.append('-r')
-    opts.append(treeref)
-    try:
-        for line in run(*opts).splitlines():
-            mode, typ, ref, name = line.split(None, 3)
-            ret[name] = (mode, typ, ref)
-    except subprocess2.CalledProcessError:
+    batch = CatFileBatch.for_repo()
+    root = batch.contents(treeref)
+    if root and root[1] in ('commit', 'tag'):
+        # Not appended to |treeref|, which may be a '<rev>:<path>'.
+        root = batch.contents('%s^{tree}' % root[0])
+    if not root or root[1] != 'tree':
         return None
+    hash_len = len(root[0]) // 2
+    pending = [('', root[2])]
+    while pending:
+        prefix, data = pending.pop()
+        for mode, typ, ref, name in _parse_tree_object(data, hash_len):
+            name = prefix + name
+            if recurse and typ == 'tree':
+                subtree = batch.contents(ref)
+                if not subtree:
+                    return None
+                pending.append((name + '/', subtree[2]))
+            else:
+                ret[name] = (mode, typ, ref)
     return ret
 
 
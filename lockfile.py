@@ -1,7 +1,7 @@
 # Copyright 2020 The Chromium Authors. All rights reserved.
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
-"""Exclusive filelocking for all supported platforms."""
+"""Exclusive and shared filelocking for all supported platforms."""
 
 import contextlib
 import logging
@@ -20,14 +20,23 @@ if sys.platform.startswith('win'):
 
     BYTES_TO_LOCK = 1
 
-    def _open_file(lockfile):
+    def _open_file(lockfile, shared=False):
+        if shared:
+            # Let the other holders of the shared lock open the file too.
+            share_mode = (win32imports.FILE_SHARE_READ
+                          | win32imports.FILE_SHARE_WRITE)
+            disposition = win32imports.OPEN_ALWAYS
+        else:
+            # Prevent others from opening the file.
+            share_mode = 0
+            disposition = win32imports.CREATE_ALWAYS
         return win32imports.Handle(
             win32imports.CreateFileW(
                 lockfile,  # lpFileName
                 win32imports.GENERIC_WRITE,  # dwDesiredAccess
-                0,  # dwShareMode=prevent others from opening file
+                share_mode,  # dwShareMode
                 None,  # lpSecurityAttributes
-                win32imports.CREATE_ALWAYS,  # dwCreationDisposition
+                disposition,  # dwCreationDisposition
                 win32imports.FILE_ATTRIBUTE_NORMAL,  # dwFlagsAndAttributes
                 None  # hTemplateFile
             ))
@@ -36,11 +45,13 @@ if sys.platform.startswith('win'):
         # CloseHandle releases lock too.
         win32imports.CloseHandle(handle)
 
-    def _lock_file(handle):
+    def _lock_file(handle, shared=False):
+        flags = win32imports.LOCKFILE_FAIL_IMMEDIATELY
+        if not shared:
+            flags |= win32imports.LOCKFILE_EXCLUSIVE_LOCK
         ret = win32imports.LockFileEx(
             handle,  # hFile
-            win32imports.LOCKFILE_FAIL_IMMEDIATELY
-            | win32imports.LOCKFILE_EXCLUSIVE_LOCK,  # dwFlags
+            flags,  # dwFlags
             0,  #dwReserved
             BYTES_TO_LOCK,  # nNumberOfBytesToLockLow
             0,  # nNumberOfBytesToLockHigh
@@ -56,28 +67,29 @@ else:
     # Unix implementation
     import fcntl
 
-    def _open_file(lockfile):
+    def _open_file(lockfile, shared=False):
         open_flags = (os.O_CREAT | os.O_WRONLY)
         return os.open(lockfile, open_flags, 0o644)
 
     def _close_file(fd):
         os.close(fd)
 
-    def _lock_file(fd):
-        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    def _lock_file(fd, shared=False):
+        fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                    | fcntl.LOCK_NB)
 
 
-def _try_lock(lockfile):
-    f = _open_file(lockfile)
+def _try_lock(lockfile, shared=False):
+    f = _open_file(lockfile, shared)
     try:
-        _lock_file(f)
+        _lock_file(f, shared)
     except Exception:
         _close_file(f)
         raise
     return lambda: _close_file(f)
 
 
-def _lock(path, timeout=0):
+def _lock(path, timeout=0, shared=False):
     """_lock returns function to release the lock if locking was successful.
 
     _lock also implements simple retry logic.
@@ -87,7 +99,7 @@ def _lock(path, timeout=0):
     sleep_time = 0.1
     while True:
         try:
-            return _try_lock(path + '.locked')
+            return _try_lock(path + '.locked', shared)
         except (OSError, IOError) as e:
             if elapsed < timeout:
                 logging.info(
@@ -100,8 +112,11 @@ def _lock(path, timeout=0):
 
 
 @contextlib.contextmanager
-def lock(path, timeout=0):
-    """Get exclusive lock to path.
+def lock(path, timeout=0, shared=False):
+    """Get exclusive lock to path, or a shared one if |shared| is set.
+
+    Any number of processes can hold a shared lock at once, but none while
+    another process holds the exclusive lock.
 
     Usage:
         import lockfile
@@ -110,7 +125,7 @@ def lock(path, timeout=0):
             pass
 
     """
-    release_fn = _lock(path, timeout)
+    release_fn = _lock(path, timeout, shared)
     try:
         yield
     finally:
@@ -330,14 +330,19 @@ def CheckChangeLintsClean(input_api,
         f.AbsoluteLocalPath()
         for f in input_api.AffectedSourceFiles(source_file_filter)
     ]
-    for file_name in files:
-        if _RE_IS_TEST.match(file_name):
-            level = 5
-        else:
-            level = 4
-
-        verbose_level = verbose_level or level
-        cpplint.ProcessFile(file_name, verbose_level)
+    if files:
+        if not verbose_level:
+            verbose_level = 5 if _RE_IS_TEST.match(files[0]) else 4
+        # If enabled with the presubmit.cpplint-cache git config, preprocessed
+        # files are cached so that presubmits run again on an unchanged file
+        # don't parse it again.
+        import scm
+        root = input_api.change.RepositoryRoot()
+        git_dir = (scm.GIT.GetConfigBool(root, 'presubmit.cpplint-cache')
+                   and scm.GIT.GetCommonGitDir(root))
+        if git_dir:
+            cpplint._SetParseCacheDir(_os.path.join(git_dir, 'cpplint_cache'))
+        cpplint.ProcessFiles(files, verbose_level, jobs=input_api.cpu_count)
 
     if cpplint._cpplint_state.error_count > 0:
         # cpplint errors currently cannot be counted as errors during upload
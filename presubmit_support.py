@@ -17,6 +17,7 @@ import contextlib
 import cpplint
 import fnmatch  # Exposed through the API.
 import glob
+import hashlib
 import inspect
 import json  # Exposed through the API.
 import logging
@@ -169,19 +170,105 @@ class Timer(object):
         self.completed = True
 
 
+class TestDurations(object):
+    """Wall times of the tests run by ThreadPool, remembered across runs.
+
+    Durations are keyed on the working directory, name and command line of a
+    CommandData, and smoothed so that a single slow run doesn't dominate.
+    """
+
+    # Weight of the latest run in the smoothed duration.
+    SMOOTHING = 0.5
+    # Oldest entries are dropped once there are more than this many.
+    MAX_ENTRIES = 10000
+
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._dirty = False
+        if path:
+            try:
+                with open(path) as f:
+                    durations = json.load(f)
+                if isinstance(durations, dict):
+                    self._durations = durations
+            except (OSError, ValueError):
+                pass
+
+    @staticmethod
+    def _Key(test):
+        parts = [test.kwargs.get('cwd'), test.name] + list(test.cmd)
+        return '\n'.join(str(part) for part in parts)
+
+    def Get(self, test):
+        """Returns the expected duration of |test| in seconds, or None."""
+        with self._lock:
+            return self._durations.get(self._Key(test))
+
+    def Record(self, test, duration):
+        key = self._Key(test)
+        with self._lock:
+            previous = self._durations.pop(key, None)
+            if previous is not None:
+                duration = (self.SMOOTHING * duration +
+                            (1 - self.SMOOTHING) * previous)
+            # Re-inserting keeps the most recently run tests last.
+            self._durations[key] = duration
+            self._dirty = True
+
+    def Save(self):
+        with self._lock:
+            if not self._path or not self._dirty:
+                return
+            keys = list(self._durations)
+            for key in keys[:-self.MAX_ENTRIES]:
+                del self._durations[key]
+            try:
+                tmp_path = self._path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(self._durations, f)
+                os.replace(tmp_path, self._path)
+                self._dirty = False
+            except OSError as e:
+                logging.warning('Failed to save test durations: %s', e)
+
+
 class ThreadPool(object):
-    def __init__(self, pool_size=None, timeout=None):
+    """Runs the tests added by RunTests, longest expected duration first.
+
+    Args:
+        pool_size: maximum number of tests running at once.
+        timeout: seconds after which a test is terminated.
+        durations: TestDurations used to order tests. Durations of the tests
+            run by this pool are recorded into it.
+        on_result: if set, called as on_result(test, duration, passed) as soon
+            as each test finishes.
+        test_env: variables added to the environment of each test process.
+    """
+
+    def __init__(self,
+                 pool_size=None,
+                 timeout=None,
+                 durations=None,
+                 on_result=None,
+                 test_env=None):
         self.timeout = timeout
         self._pool_size = pool_size or multiprocessing.cpu_count()
         if sys.platform == 'win32':
             # TODO(crbug.com/1190269) - we can't use more than 56 child
             # processes on Windows or Python3 may hang.
             self._pool_size = min(self._pool_size, 56)
+        self._durations = durations or TestDurations()
+        self._on_result = on_result
+        self._test_env = test_env
         self._messages = []
         self._messages_lock = threading.Lock()
         self._tests = []
         self._tests_lock = threading.Lock()
         self._nonparallel_tests = []
+        # Number of tests added so far.
+        self.tests_added = 0
 
     def _GetCommand(self, test):
         vpython = 'vpython3'
@@ -217,41 +304,77 @@ class ThreadPool(object):
                                                               stdout)
             return p.returncode, stdout
 
-    def CallCommand(self, test, show_callstack=None):
-        """Runs an external program.
-
-        This function converts invocation of .py files and invocations of 'python'
-        to vpython invocations.
-        """
+    def _CallCommand(self, test, show_callstack=None):
+        """Runs |test|; returns (result message or None, passed, duration)."""
         cmd = self._GetCommand(test)
+        kwargs = test.kwargs
+        if self._test_env:
+            env = dict(kwargs.get('env') or os.environ)
+            env.update(self._test_env)
+            kwargs = dict(kwargs, env=env)
         try:
             start = time_time()
-            returncode, stdout = self._RunWithTimeout(cmd, test.stdin,
-                                                      test.kwargs)
+            returncode, stdout = self._RunWithTimeout(cmd, test.stdin, kwargs)
             duration = time_time() - start
         except Exception:
             duration = time_time() - start
             return test.message(
                 '%s\n%s exec failure (%4.2fs)\n%s' %
                 (test.name, ' '.join(cmd), duration, traceback.format_exc()),
-                show_callstack=show_callstack)
+                show_callstack=show_callstack), False, duration
 
         if returncode != 0:
             return test.message('%s\n%s (%4.2fs) failed\n%s' %
                                 (test.name, ' '.join(cmd), duration, stdout),
-                                show_callstack=show_callstack)
+                                show_callstack=show_callstack), False, duration
 
         if test.info:
             return test.info('%s\n%s (%4.2fs)' %
                              (test.name, ' '.join(cmd), duration),
-                             show_callstack=show_callstack)
+                             show_callstack=show_callstack), True, duration
+        return None, True, duration
+
+    def CallCommand(self, test, show_callstack=None):
+        """Runs an external program.
+
+        This function converts invocation of .py files and invocations of 'python'
+        to vpython invocations.
+        """
+        return self._CallCommand(test, show_callstack)[0]
 
     def AddTests(self, tests, parallel=True):
+        self.tests_added += len(tests)
         if parallel:
             self._tests.extend(tests)
         else:
             self._nonparallel_tests.extend(tests)
 
+    def SaveDurations(self):
+        self._durations.Save()
+
+    def _RunTest(self, test, show_callstack=None):
+        result, passed, duration = self._CallCommand(test, show_callstack)
+        self._durations.Record(test, duration)
+        with self._messages_lock:
+            if result:
+                self._messages.append(result)
+            if self._on_result:
+                self._on_result(test, duration, passed)
+
+    def _SortTests(self):
+        """Orders self._tests so that pop() returns the longest test first.
+
+        Tests that never ran are assumed to be the longest ones.
+        """
+        def _Expected(test):
+            duration = self._durations.Get(test)
+            return float('inf') if duration is None else duration
+
+        # sort() is stable, so tests with the same expected duration keep
+        # running in the order they were added.
+        self._tests.reverse()
+        self._tests.sort(key=_Expected)
+
     def RunAsync(self):
         self._messages = []
 
@@ -262,10 +385,7 @@ class ThreadPool(object):
                     if not self._tests:
                         break
                     test = self._tests.pop()
-                result = self.CallCommand(test, show_callstack=False)
-                if result:
-                    with self._messages_lock:
-                        self._messages.append(result)
+                self._RunTest(test, show_callstack=False)
 
         def _StartDaemon():
             t = threading.Thread(target=_WorkerFn)
@@ -274,19 +394,37 @@ class ThreadPool(object):
             return t
 
         while self._nonparallel_tests:
-            test = self._nonparallel_tests.pop()
-            result = self.CallCommand(test)
-            if result:
-                self._messages.append(result)
+            self._RunTest(self._nonparallel_tests.pop())
 
         if self._tests:
-            threads = [_StartDaemon() for _ in range(self._pool_size)]
+            self._SortTests()
+            threads = [
+                _StartDaemon()
+                for _ in range(min(self._pool_size, len(self._tests)))
+            ]
             for worker in threads:
                 worker.join()
 
         return self._messages
 
 
+def _PresubmitJobs():
+    """Returns the number of tests to run at once, from PRESUBMIT_MAX_JOBS."""
+    try:
+        return max(1, int(os.environ.get('PRESUBMIT_MAX_JOBS', '')))
+    except ValueError:
+        return None
+
+
+def _FileHash(path):
+    """Returns the sha256 of the contents of |path|."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def normpath(path):
     """Version of os.path.normpath that also changes backward slashes to
     forward slashes when not running on Windows.
@@ -924,6 +1062,73 @@ class _DiffCache(object):
         """Get the old version for a particular path."""
         raise NotImplementedError()
 
+    def Close(self):
+        """Releases the resources held for the diffs, if any."""
+
+
+class _SpooledDiff(object):
+    """A unified git diff spooled to a temporary file and indexed by path.
+
+    Only the offsets of each per-file section are kept in memory. The text of a
+    section is read back and decoded when it is requested, so that very large
+    diffs never need to be held in memory as a whole.
+    """
+
+    # Diffs up to this size stay in memory, larger ones are spilled to disk.
+    MAX_IN_MEMORY_SIZE = 8 * 1024 * 1024
+
+    # Same as the marker in _parse_unified_diff, but for undecoded lines.
+    _FILE_MARKER = re.compile(
+        br'^diff --git (?:a/)?(?P<filename>.*) (?:b/)?(?P=filename)$')
+
+    def __init__(self, lines):
+        """Consumes an iterable of diff lines (bytes, line endings included)."""
+        self._lock = threading.Lock()
+        self._offsets = {}
+        self._file = tempfile.SpooledTemporaryFile(
+            max_size=self.MAX_IN_MEMORY_SIZE)
+        try:
+            self._index(lines)
+        except:
+            self._file.close()
+            raise
+
+    def _index(self, lines):
+        path = None
+        start = offset = 0
+        for line in lines:
+            match = self._FILE_MARKER.match(line)
+            if match:
+                # Marks the start of a new per-file section.
+                if path is not None:
+                    self._offsets[path] = (start, offset)
+                path = normpath(
+                    match.group('filename').decode('utf-8', 'replace'))
+                start = offset
+            elif line.startswith(b'diff --git'):
+                raise PresubmitFailure('Unexpected diff line: %s' %
+                                       line.decode('utf-8', 'replace'))
+            elif path is None:
+                # Drop anything preceding the first section.
+                continue
+            self._file.write(line)
+            offset += len(line)
+        if path is not None:
+            self._offsets[path] = (start, offset)
+
+    def get(self, path):
+        """Returns the diff for |path|, or '' if it isn't part of the diff."""
+        if path not in self._offsets:
+            return ''
+        start, end = self._offsets[path]
+        with self._lock:
+            self._file.seek(start)
+            data = self._file.read(end - start)
+        return data.decode('utf-8', 'replace')
+
+    def close(self):
+        self._file.close()
+
 
 class _GitDiffCache(_DiffCache):
     """DiffCache implementation for git; gets all file diffs at once."""
@@ -933,33 +1138,38 @@ class _GitDiffCache(_DiffCache):
         super(_GitDiffCache, self).__init__()
         self._upstream = upstream
         self._diffs_by_file = None
+        self._lock = threading.Lock()
 
     def GetDiff(self, path, local_root):
-        # Compare against None to distinguish between None and an initialized
-        # but empty dictionary.
-        if self._diffs_by_file == None:
-            # Don't specify any filenames below, because there are command line
-            # length limits on some platforms and GenerateDiff would fail.
-            unified_diff = scm.GIT.GenerateDiff(local_root,
+        with self._lock:
+            if self._diffs_by_file is None:
+                # Don't specify any filenames below, because there are command
+                # line length limits on some platforms and GenerateDiff would
+                # fail.
+                with scm.GIT.GenerateDiffStream(local_root,
                                                 files=[],
                                                 full_move=True,
-                                                branch=self._upstream)
-            # Compute a single diff for all files and parse the output; with git
-            # this is much faster than computing one diff for each file.
-            self._diffs_by_file = _parse_unified_diff(unified_diff)
-
-        if path not in self._diffs_by_file:
-            # SCM didn't have any diff on this file. It could be that the file
-            # was not modified at all (e.g. user used --all flag in git cl
-            # presubmit). Intead of failing, return empty string. See:
-            # https://crbug.com/808346.
-            return ''
-
-        return self._diffs_by_file[path]
+                                                branch=self._upstream) as lines:
+                    # Compute a single diff for all files and index the output
+                    # as it is produced; with git this is much faster than
+                    # computing one diff for each file.
+                    self._diffs_by_file = _SpooledDiff(lines)
+
+        # If SCM didn't have any diff on this file, it could be that the file
+        # was not modified at all (e.g. user used --all flag in git cl
+        # presubmit). Intead of failing, return empty string. See:
+        # https://crbug.com/808346.
+        return self._diffs_by_file.get(path)
 
     def GetOldContents(self, path, local_root):
         return scm.GIT.GetOldContents(local_root, path, branch=self._upstream)
 
+    def Close(self):
+        with self._lock:
+            if self._diffs_by_file is not None:
+                self._diffs_by_file.close()
+                self._diffs_by_file = None
+
 
 class _ProvidedDiffCache(_DiffCache):
     """Caches diffs from the provided diff file."""
@@ -1205,15 +1415,20 @@ class Change(object):
         assert all((isinstance(f, (list, tuple)) and len(f) == 2)
                    for f in files), files
 
-        diff_cache = self._diff_cache()
+        self._diffs = self._diff_cache()
         self._affected_files = [
             self._AFFECTED_FILES(path, action.strip(), self._local_root,
-                                 diff_cache) for action, path in files
+                                 self._diffs) for action, path in files
         ]
 
     def _diff_cache(self):
         return self._AFFECTED_FILES.DIFF_CACHE()
 
+    def Close(self):
+        """Releases the resources held for the diffs of the change, e.g. the
+        temporary file of a git diff. They are recomputed if needed again."""
+        self._diffs.Close()
+
     def Name(self):
         """Returns the change name."""
         return self._name
@@ -1649,6 +1864,101 @@ def DoPostUploadExecuter(change, gerrit_obj, verbose):
     return exit_code
 
 
+class PresubmitResultCache(object):
+    """Results of presubmit checks that passed, stored across runs.
+
+    Entries are keyed on the presubmit script, the check name and the contents
+    of the affected files under the script's directory, which
+    input_api.AffectedFiles() returns (see PresubmitExecuter._CacheKey). Only
+    checks that didn't report an error and didn't queue any test are stored.
+
+    Other inputs of the checks are not part of the key: the description, issue
+    and patchset of the change, the affected files outside of the script's
+    directory, the modules imported by the presubmit script, and the files they
+    read outside of the change, e.g. configuration files. A check that passed
+    is not run again when only these change, so the cache is opt-in.
+    """
+
+    # Bump when the format of the entries or of the keys changes.
+    VERSION = 2
+    # Least recently used entries are dropped once there are more than this.
+    MAX_ENTRIES = 2000
+
+    _RESULT_TYPES = {
+        'warning': _PresubmitPromptWarning,
+        'notify': _PresubmitNotifyResult,
+    }
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self._entries = data['entries']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    @staticmethod
+    def Key(*parts):
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            h.update(b'%d:' % len(part))
+            h.update(part)
+        return h.hexdigest()
+
+    def Get(self, key):
+        """Returns the (results, more_cc) stored for |key|, or None."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        # Re-inserting keeps the most recently used entries last.
+        self._entries[key] = entry
+        self._dirty = True
+        results = [
+            self._RESULT_TYPES[r['type']](r['message'], r['items'],
+                                          r['long_text'])
+            for r in entry['results']
+        ]
+        return results, entry['more_cc']
+
+    def Set(self, key, results, more_cc):
+        """Stores the outcome of a check; ignored if it reported an error."""
+        if any(r.fatal for r in results):
+            return
+        stored = []
+        for result in results:
+            fields = result.json_format()
+            fields['type'] = 'warning' if result.should_prompt else 'notify'
+            del fields['fatal']
+            stored.append(fields)
+        self._entries.pop(key, None)
+        self._entries[key] = {'results': stored, 'more_cc': list(more_cc)}
+        self._dirty = True
+
+    def Save(self):
+        if not self._dirty:
+            return
+        keys = list(self._entries)
+        for key in keys[:-self.MAX_ENTRIES]:
+            del self._entries[key]
+        try:
+            tmp_path = self._path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'version': self.VERSION,
+                    'entries': self._entries
+                }, f)
+            os.replace(tmp_path, self._path)
+            self._dirty = False
+        except OSError as e:
+            logging.warning('Failed to save presubmit results: %s', e)
+
+
 class PresubmitExecuter(object):
     def __init__(self,
                  change,
@@ -1658,7 +1968,8 @@ class PresubmitExecuter(object):
                  dry_run=None,
                  thread_pool=None,
                  parallel=False,
-                 no_diffs=False):
+                 no_diffs=False,
+                 result_cache=None):
         """
         Args:
             change: The Change object.
@@ -1670,6 +1981,9 @@ class PresubmitExecuter(object):
                 PRESUBMIT files will be run in parallel.
             no_diffs: if true, implies that --files or --all was specified so some
                 checks can be skipped, and some errors will be messages.
+            result_cache: if set, a PresubmitResultCache used to skip the
+                checks whose inputs didn't change since they last passed.
+                It is ignored when committing.
         """
         self.change = change
         self.committing = committing
@@ -1680,6 +1994,61 @@ class PresubmitExecuter(object):
         self.thread_pool = thread_pool
         self.parallel = parallel
         self.no_diffs = no_diffs
+        self.result_cache = None if committing else result_cache
+        self._environment_fingerprint = None
+        self._files_fingerprints = {}
+
+    def _EnvironmentFingerprint(self):
+        """Returns a hash of the presubmit code and of its settings."""
+        if self._environment_fingerprint is None:
+            parts = [
+                __version__,
+                _FileHash(__file__),
+                _FileHash(presubmit_canned_checks.__file__),
+                self.change.RepositoryRoot(),
+                self.change.author_email or '',
+                str(getattr(self.change, '_upstream', None)),
+                repr((self.verbose, self.dry_run, self.no_diffs)),
+            ]
+            if self.gerrit:
+                parts.append(
+                    repr((self.gerrit.host, self.gerrit.project,
+                          self.gerrit.branch)))
+            self._environment_fingerprint = PresubmitResultCache.Key(*parts)
+        return self._environment_fingerprint
+
+    def _FilesFingerprint(self, presubmit_dir):
+        """Returns a hash of the affected files under |presubmit_dir|, which
+        input_api.AffectedFiles() returns to the presubmit scripts there."""
+        fingerprint = self._files_fingerprints.get(presubmit_dir)
+        if fingerprint is None:
+            dir_with_slash = normpath(presubmit_dir)
+            if len(dir_with_slash) > 0:
+                dir_with_slash += os.path.sep
+            files = self.change.AffectedFiles() + list(
+                self.change.AffectedSubmodules())
+            parts = []
+            for f in sorted(files, key=lambda f: f.LocalPath()):
+                path = f.AbsoluteLocalPath()
+                if not normpath(path).startswith(dir_with_slash):
+                    continue
+                if os.path.isfile(path):
+                    content = _FileHash(path)
+                else:
+                    # Deleted files and submodules.
+                    content = PresubmitResultCache.Key(f.GenerateScmDiff())
+                parts.extend([f.Action(), f.LocalPath(), content])
+            fingerprint = PresubmitResultCache.Key(*parts)
+            self._files_fingerprints[presubmit_dir] = fingerprint
+        return fingerprint
+
+    def _CacheKey(self, presubmit_path, script_text, function_name):
+        """Returns the key of the results of |function_name| from the
+        presubmit script |presubmit_path| in self.result_cache."""
+        return PresubmitResultCache.Key(
+            self._EnvironmentFingerprint(),
+            self._FilesFingerprint(os.path.dirname(presubmit_path)),
+            presubmit_path, script_text, function_name)
 
     def ExecPresubmitScript(self, script_text, presubmit_path):
         """Executes a single presubmit script.
@@ -1773,7 +2142,8 @@ class PresubmitExecuter(object):
                                       presubmit_path)
                         results.extend(
                             self._run_check_function(function_name, context,
-                                                     sink, presubmit_path))
+                                                     sink, presubmit_path,
+                                                     script_text))
                         logging.debug('Running %s done.', function_name)
                         self.more_cc.extend(output_api.more_cc)
                         # Clear the CC list between running each presubmit check
@@ -1790,7 +2160,8 @@ class PresubmitExecuter(object):
                                       presubmit_path)
                         results.extend(
                             self._run_check_function(function_name, context,
-                                                     sink, presubmit_path))
+                                                     sink, presubmit_path,
+                                                     script_text))
                         logging.debug('Running %s done.', function_name)
                         self.more_cc.extend(output_api.more_cc)
                         # Clear the CC list between running each presubmit check
@@ -1805,7 +2176,12 @@ class PresubmitExecuter(object):
 
         return results
 
-    def _run_check_function(self, function_name, context, sink, presubmit_path):
+    def _run_check_function(self,
+                            function_name,
+                            context,
+                            sink,
+                            presubmit_path,
+                            script_text=None):
         """Evaluates and returns the result of a given presubmit function.
 
         If sink is given, the result of the presubmit function will be reported
@@ -1815,10 +2191,31 @@ class PresubmitExecuter(object):
             function_name: the name of the presubmit function to evaluate
             context: a context dictionary in which the function will be evaluated
             sink: an instance of ResultSink. None, by default.
+            presubmit_path: the path to the presubmit script.
+            script_text: the text of the presubmit script. Needed to use
+                self.result_cache.
         Returns:
             the result of the presubmit function call.
         """
+        cache_key = None
+        if self.result_cache and script_text is not None:
+            cache_key = self._CacheKey(presubmit_path, script_text,
+                                       function_name)
+            cached = self.result_cache.Get(cache_key)
+            if cached:
+                result, more_cc = cached
+                context['__args'][1].more_cc.extend(more_cc)
+                if self.verbose:
+                    sys.stdout.write('Skipping %s from %s, unchanged since it '
+                                     'last passed.\n' %
+                                     (function_name, presubmit_path))
+                if sink:
+                    status, failure_reason = RDBStatusFrom(result)
+                    sink.report(function_name, status, 0, failure_reason)
+                return result
+
         start_time = time_time()
+        tests_added = self.thread_pool.tests_added if self.thread_pool else 0
         try:
             result = eval(function_name + '(*__args)', context)
             self._check_result_type(result)
@@ -1829,6 +2226,14 @@ class PresubmitExecuter(object):
                     'Evaluation of %s failed: %s, %s' %
                     (function_name, e_value, traceback.format_exc()))
             ]
+            cache_key = None
+
+        # Tests queued to run later with --parallel aren't part of |result|, so
+        # the check has to run again next time.
+        if cache_key and (not self.parallel or not self.thread_pool
+                          or self.thread_pool.tests_added == tests_added):
+            self.result_cache.Set(cache_key, result,
+                                  context['__args'][1].more_cc)
 
         elapsed_time = time_time() - start_time
         if elapsed_time > 10.0:
@@ -1879,7 +2284,8 @@ def DoPresubmitChecks(change,
                       dry_run=None,
                       parallel=False,
                       json_output=None,
-                      no_diffs=False):
+                      no_diffs=False,
+                      use_cache=False):
     """Runs all presubmit checks that apply to the files in the change.
 
     This finds all PRESUBMIT.py files in directories enclosing the files in the
@@ -1902,6 +2308,9 @@ def DoPresubmitChecks(change,
             PRESUBMIT files will be run in parallel.
         no_diffs: if true, implies that --files or --all was specified so some
             checks can be skipped, and some errors will be messages.
+        use_cache: if true, checks that passed before are skipped when
+            neither they nor the files of the change under their directory
+            were modified since.
     Return:
         1 if presubmit checks failed or 0 otherwise.
     """
@@ -1920,9 +2329,31 @@ def DoPresubmitChecks(change,
         if not presubmit_files and verbose:
             sys.stdout.write('Warning, no PRESUBMIT.py found.\n')
         results = []
-        thread_pool = ThreadPool()
+        durations_path = None
+        result_cache = None
+        git_dir = scm.GIT.GetCommonGitDir(change.RepositoryRoot())
+        if git_dir:
+            durations_path = os.path.join(git_dir,
+                                          'presubmit_test_durations.json')
+            if use_cache:
+                result_cache = PresubmitResultCache(
+                    os.path.join(git_dir, 'presubmit_result_cache.json'))
+
+        def _ReportTest(test, duration, passed):
+            sys.stdout.write(
+                '%s %s (%4.2fs)\n' %
+                ('Passed' if passed else 'FAILED', test.name, duration))
+            sys.stdout.flush()
+
+        # Tests may run presubmits of their own; those run one test at a time
+        # so that the total number of concurrent tests stays capped.
+        thread_pool = ThreadPool(pool_size=_PresubmitJobs(),
+                                 durations=TestDurations(durations_path),
+                                 on_result=_ReportTest if verbose else None,
+                                 test_env={'PRESUBMIT_MAX_JOBS': '1'})
         executer = PresubmitExecuter(change, committing, verbose, gerrit_obj,
-                                     dry_run, thread_pool, parallel, no_diffs)
+                                     dry_run, thread_pool, parallel, no_diffs,
+                                     result_cache)
         if default_presubmit:
             if verbose:
                 sys.stdout.write('Running default presubmit script.\n')
@@ -1939,6 +2370,9 @@ def DoPresubmitChecks(change,
             results += executer.ExecPresubmitScript(presubmit_script, filename)
 
         results += thread_pool.RunAsync()
+        thread_pool.SaveDurations()
+        if executer.result_cache:
+            executer.result_cache.Save()
 
         messages = {}
         should_prompt = False
@@ -2333,6 +2767,14 @@ def main(argv=None):
     parser.add_argument('--no_diffs',
                         action='store_true',
                         help='Assume that all "modified" files have no diffs.')
+    parser.add_argument('--use_cache',
+                        action='store_true',
+                        help='Skip checks that passed before if neither they '
+                        'nor the files of the change under their directory '
+                        'were modified since. The description of the change, '
+                        'modules imported by PRESUBMIT.py and other files '
+                        'read by the checks are not considered, so a check '
+                        'may be skipped even though its result would change.')
     options = parser.parse_args(argv)
 
     log_level = logging.ERROR
@@ -2359,11 +2801,11 @@ def main(argv=None):
         if options.post_upload:
             return DoPostUploadExecuter(change, gerrit_obj, options.verbose)
         with canned_check_filter(options.skip_canned):
-            return DoPresubmitChecks(change, options.commit, options.verbose,
-                                     options.default_presubmit,
-                                     options.may_prompt, gerrit_obj,
-                                     options.dry_run, options.parallel,
-                                     options.json_output, options.no_diffs)
+            return DoPresubmitChecks(
+                change, options.commit, options.verbose,
+                options.default_presubmit, options.may_prompt, gerrit_obj,
+                options.dry_run, options.parallel, options.json_output,
+                options.no_diffs, options.use_cache and not options.skip_canned)
     except PresubmitFailure as e:
         import utils
         print(e, file=sys.stderr)
@@ -2371,6 +2813,8 @@ def main(argv=None):
         print('depot_tools version: %s' % utils.depot_tools_version(),
               file=sys.stderr)
         return 2
+    finally:
+        change.Close()
 
 
 if __name__ == '__main__':
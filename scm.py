@@ -4,10 +4,13 @@
 """SCM-specific utility classes."""
 
 from collections import defaultdict
+import contextlib
 import os
 import platform
 import re
-from typing import Mapping, List
+import tempfile
+import threading
+from typing import Mapping, List, Optional, Sequence, Tuple
 
 import gclient_utils
 import git_common
@@ -22,6 +25,73 @@ VERSIONED_DIR = 1
 VERSIONED_SUBMODULE = 2
 
 
+def _file_signature(path):
+    """Returns a value that changes when |path| is modified, or None."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    # git rewrites config and ref files through a lock file and a rename, so
+    # the inode changes even when mtime and size don't.
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class StatValidatedCache(object):
+    """Thread-safe cache whose entries are dropped when files change.
+
+    Each entry records the stat signature of the files it was computed from
+    and is only returned while all of them are unchanged, including files that
+    didn't exist yet.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        signatures, value = entry
+        if any(_file_signature(path) != sig for path, sig in signatures):
+            self.pop(key)
+            return None
+        return value
+
+    def set(self, key, value, paths):
+        # type: (object, object, Sequence[str]) -> None
+        """Caches |value| until one of |paths| changes.
+
+        The signatures must be taken before computing |value|, otherwise a
+        concurrent change could go unnoticed; see |signatures|.
+        """
+        self.set_with_signatures(key, value, self.signatures(paths))
+
+    @staticmethod
+    def signatures(paths):
+        return tuple((path, _file_signature(path)) for path in paths)
+
+    def set_with_signatures(self, key, value, signatures):
+        with self._lock:
+            self._entries[key] = (signatures, value)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except (IOError, UnicodeDecodeError):
+        return None
+
+
 def determine_scm(root):
     """Similar to upload.py's version but much simpler.
 
@@ -42,20 +112,125 @@ def determine_scm(root):
 
 class GIT(object):
     current_version = None
-    rev_parse_cache = {}
+
+    # Maps (cwd, revision) -> hash. Entries for full SHAs never expire, and
+    # entries for ref names expire when the files they were read from change.
+    rev_parse_cache = StatValidatedCache()
 
     # Maps cwd -> {config key, [config values]}
     # This cache speeds up all `git config ...` operations by only running a
     # single subcommand, which can greatly accelerate things like
-    # git-map-branches.
-    _CONFIG_CACHE: Mapping[str, Mapping[str, List[str]]] = {}
+    # git-map-branches. Entries expire when a config file changes, so that
+    # long-running commands see edits made by other processes.
+    _CONFIG_CACHE = StatValidatedCache()
+
+    # Maps cwd -> (git dir, common git dir).
+    _GIT_DIRS_CACHE: Mapping[str, Optional[Tuple[str, str]]] = {}
+
+    # Revisions that are looked up as ref names, see _RefFiles.
+    _REF_NAME_RE = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_./-]*$')
+
+    @staticmethod
+    def _GitDirs(cwd: str) -> Optional[Tuple[str, str]]:
+        """Returns the git dir and the common git dir of |cwd|, if any.
+
+        This only looks at the file system, so that validating cache entries
+        doesn't need a git process.
+        """
+        if cwd in GIT._GIT_DIRS_CACHE:
+            return GIT._GIT_DIRS_CACHE[cwd]
+        git_dir = os.environ.get('GIT_DIR')
+        if git_dir:
+            git_dir = os.path.join(cwd, git_dir)
+        else:
+            path = os.path.abspath(cwd)
+            while True:
+                dot_git = os.path.join(path, '.git')
+                if os.path.isdir(dot_git):
+                    git_dir = dot_git
+                    break
+                if os.path.isfile(dot_git):
+                    # Worktrees and submodules: 'gitdir: <path>'.
+                    line = _read_first_line(dot_git) or ''
+                    if line.startswith('gitdir:'):
+                        git_dir = os.path.join(path,
+                                               line[len('gitdir:'):].strip())
+                    break
+                parent = os.path.dirname(path)
+                if parent == path:
+                    break
+                path = parent
+        if not git_dir:
+            # Not cached, |cwd| may become a checkout later.
+            return None
+        common_dir = _read_first_line(os.path.join(git_dir, 'commondir'))
+        common_dir = os.path.join(git_dir, common_dir or '')
+        result = (os.path.normpath(git_dir), os.path.normpath(common_dir))
+        GIT._GIT_DIRS_CACHE[cwd] = result
+        return result
+
+    @staticmethod
+    def GetCommonGitDir(cwd: str) -> Optional[str]:
+        """Returns the git dir shared by all worktrees of |cwd|, if any."""
+        git_dirs = GIT._GitDirs(cwd)
+        return git_dirs[1] if git_dirs else None
+
+    @staticmethod
+    def _ConfigFiles(cwd: str) -> List[str]:
+        """Returns the config files that `git config --list` reads in |cwd|.
+
+        Files pulled in with [include] directives are not tracked.
+        """
+        home = os.path.expanduser('~')
+        xdg = os.environ.get('XDG_CONFIG_HOME') or os.path.join(home, '.config')
+        files = [
+            os.environ.get('GIT_CONFIG_SYSTEM') or '/etc/gitconfig',
+            os.path.join(xdg, 'git', 'config'),
+            os.environ.get('GIT_CONFIG_GLOBAL')
+            or os.path.join(home, '.gitconfig'),
+        ]
+        git_dirs = GIT._GitDirs(cwd)
+        if git_dirs:
+            files.append(os.path.join(git_dirs[1], 'config'))
+            files.append(os.path.join(git_dirs[0], 'config.worktree'))
+        return files
+
+    @staticmethod
+    def _RefFiles(cwd: str, rev: str) -> Optional[List[str]]:
+        """Returns the files that determine what the ref name |rev| resolves
+        to, or None if |rev| isn't a plain ref name."""
+        git_dirs = GIT._GitDirs(cwd)
+        if not git_dirs or not GIT._REF_NAME_RE.match(rev):
+            return None
+        git_dir, common_dir = git_dirs
+        if os.path.exists(os.path.join(common_dir, 'reftable')):
+            return None
+        # The candidates git tries for a short ref name, see
+        # `git help revisions`.
+        names = [
+            rev, 'refs/' + rev, 'refs/tags/' + rev, 'refs/heads/' + rev,
+            'refs/remotes/' + rev,
+            'refs/remotes/%s/HEAD' % rev
+        ]
+        files = [os.path.join(common_dir, 'packed-refs')]
+        for name in names:
+            files.append(os.path.join(git_dir, name))
+            if common_dir != git_dir:
+                files.append(os.path.join(common_dir, name))
+            # Follow symbolic refs such as HEAD one level down.
+            target = _read_first_line(os.path.join(git_dir, name))
+            if target and target.startswith('ref:'):
+                target = target[len('ref:'):].strip()
+                files.append(os.path.join(git_dir, target))
+                files.append(os.path.join(common_dir, target))
+        return files
 
     @staticmethod
     def _load_config(cwd: str) -> Mapping[str, List[str]]:
         """Loads git config for the given cwd.
 
         The calls to this method are cached in-memory for performance. The
-        config is only reloaded on cache misses.
+        config is only reloaded when a config file changed.
 
         Args:
             cwd: path to fetch `git config` for.
@@ -63,28 +238,31 @@ class GIT(object):
         Returns:
             A dict mapping git config keys to a list of its values.
         """
-        if cwd not in GIT._CONFIG_CACHE:
-            try:
-                rawConfig = GIT.Capture(['config', '--list', '-z'],
-                                        cwd=cwd,
-                                        strip_out=False)
-            except subprocess2.CalledProcessError:
-                return {}
+        cfg = GIT._CONFIG_CACHE.get(cwd)
+        if cfg is not None:
+            return cfg
 
-            cfg = defaultdict(list)
+        signatures = StatValidatedCache.signatures(GIT._ConfigFiles(cwd))
+        try:
+            rawConfig = GIT.Capture(['config', '--list', '-z'],
+                                    cwd=cwd,
+                                    strip_out=False)
+        except subprocess2.CalledProcessError:
+            return {}
 
-            # Splitting by '\x00' gets an additional empty string at the end.
-            for line in rawConfig.split('\x00')[:-1]:
-                key, value = map(str.strip, line.split('\n', 1))
-                cfg[key].append(value)
+        cfg = defaultdict(list)
 
-            GIT._CONFIG_CACHE[cwd] = cfg
+        # Splitting by '\x00' gets an additional empty string at the end.
+        for line in rawConfig.split('\x00')[:-1]:
+            key, value = map(str.strip, line.split('\n', 1))
+            cfg[key].append(value)
 
-        return GIT._CONFIG_CACHE[cwd]
+        GIT._CONFIG_CACHE.set_with_signatures(cwd, cfg, signatures)
+        return cfg
 
     @staticmethod
     def _clear_config(cwd: str) -> None:
-        GIT._CONFIG_CACHE.pop(cwd, None)
+        GIT._CONFIG_CACHE.pop(cwd)
 
 
     @staticmethod
@@ -382,6 +560,10 @@ class GIT(object):
         if platform.system() == 'Windows':
             # git show <sha>:<path> wants a posix path.
             filename = filename.replace('\\', '/')
+        blob = git_common.CatFileBatch.for_repo(cwd).contents(
+            '%s:%s' % (branch, filename))
+        if blob and blob[1] == 'blob':
+            return blob[2].decode('utf-8', 'replace')
         command = ['show', '%s:%s' % (branch, filename)]
         try:
             return GIT.Capture(command, cwd=cwd, strip_out=False)
@@ -389,15 +571,7 @@ class GIT(object):
             return ''
 
     @staticmethod
-    def GenerateDiff(cwd,
-                     branch=None,
-                     branch_head='HEAD',
-                     full_move=False,
-                     files=None):
-        """Diffs against the upstream branch or optionally another branch.
-
-        full_move means that move or copy operations should completely recreate the
-        files, usually in the prospect to apply the patch for a try job."""
+    def _DiffCommand(cwd, branch, branch_head, full_move, files):
         if not branch:
             branch = GIT.GetUpstreamBranch(cwd)
         command = [
@@ -412,6 +586,19 @@ class GIT(object):
         if files:
             command.append('--')
             command.extend(files)
+        return command
+
+    @staticmethod
+    def GenerateDiff(cwd,
+                     branch=None,
+                     branch_head='HEAD',
+                     full_move=False,
+                     files=None):
+        """Diffs against the upstream branch or optionally another branch.
+
+        full_move means that move or copy operations should completely recreate the
+        files, usually in the prospect to apply the patch for a try job."""
+        command = GIT._DiffCommand(cwd, branch, branch_head, full_move, files)
         diff = GIT.Capture(command, cwd=cwd, strip_out=False).splitlines(True)
         for i in range(len(diff)):
             # In the case of added files, replace /dev/null with the path to the
@@ -420,6 +607,53 @@ class GIT(object):
                 diff[i] = '--- %s' % diff[i + 1][4:]
         return ''.join(diff)
 
+    @staticmethod
+    @contextlib.contextmanager
+    def GenerateDiffStream(cwd,
+                           branch=None,
+                           branch_head='HEAD',
+                           full_move=False,
+                           files=None):
+        """Same as GenerateDiff, but yields an iterator over the lines of the
+        diff, as bytes, while git produces them.
+
+        Raises subprocess2.CalledProcessError with git's stderr if git fails.
+        """
+        command = GIT._DiffCommand(cwd, branch, branch_head, full_move, files)
+        # stderr goes to a file rather than a pipe, so that git can't block on
+        # it while stdout is read.
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                with git_common.run_stream_with_retcode(
+                        *command, cwd=cwd, env=GIT.ApplyEnvVars({}),
+                        stderr=stderr) as stdout:
+
+                    def lines():
+                        previous = None
+                        for line in stdout:
+                            if previous is not None:
+                                # In the case of added files, replace /dev/null
+                                # with the path to the file being added.
+                                if previous.startswith(b'--- /dev/null'):
+                                    previous = b'--- ' + line[4:]
+                                yield previous
+                            previous = line
+                        if previous is not None:
+                            yield previous
+
+                    try:
+                        yield lines()
+                    finally:
+                        # Drain whatever the caller didn't consume so that git
+                        # can exit instead of blocking on a full pipe.
+                        while stdout.read(65536):
+                            pass
+                        stdout.close()
+            except subprocess2.CalledProcessError as e:
+                stderr.seek(0)
+                raise subprocess2.CalledProcessError(e.returncode, e.cmd, cwd,
+                                                     b'', stderr.read())
+
     @staticmethod
     def GetAllFiles(cwd):
         """Returns the list of all files under revision control."""
@@ -492,25 +726,37 @@ class GIT(object):
 
     @staticmethod
     def ResolveCommit(cwd, rev):
-        cache_key = None
         # We do this instead of rev-parse --verify rev^{commit}, since on
         # Windows git can be either an executable or batch script, each of which
         # requires escaping the caret (^) a different way.
-        if gclient_utils.IsFullGitSha(rev):
-            # Only cache full SHAs
-            cache_key = hash(cwd + rev)
-            if val := GIT.rev_parse_cache.get(cache_key):
-                return val
-
-            # git-rev parse --verify FULL_GIT_SHA always succeeds, even if we
-            # don't have FULL_GIT_SHA locally. Removing the last character
-            # forces git to check if FULL_GIT_SHA refers to an object in the
-            # local database.
-            rev = rev[:-1]
-        res = GIT.Capture(['rev-parse', '--quiet', '--verify', rev], cwd=cwd)
-        if cache_key:
-            # We don't expect concurrent execution, so we don't lock anything.
-            GIT.rev_parse_cache[cache_key] = res
+        cache_key = (cwd, rev)
+        if val := GIT.rev_parse_cache.get(cache_key):
+            return val
+        is_full_sha = gclient_utils.IsFullGitSha(rev)
+        if is_full_sha:
+            # Objects don't go away.
+            signatures = ()
+        else:
+            ref_files = GIT._RefFiles(cwd, rev)
+            signatures = (StatValidatedCache.signatures(ref_files)
+                          if ref_files else None)
+
+        # The batch co-process only resolves revisions that name an object in
+        # the local database, so full SHAs are verified too.
+        info = git_common.CatFileBatch.for_repo(cwd).info(rev)
+        if info:
+            res = info[0]
+        else:
+            if is_full_sha:
+                # git-rev parse --verify FULL_GIT_SHA always succeeds, even if
+                # we don't have FULL_GIT_SHA locally. Removing the last
+                # character forces git to check if FULL_GIT_SHA refers to an
+                # object in the local database.
+                rev = rev[:-1]
+            res = GIT.Capture(['rev-parse', '--quiet', '--verify', rev],
+                              cwd=cwd)
+        if signatures is not None:
+            GIT.rev_parse_cache.set_with_signatures(cache_key, res, signatures)
 
         return res
 
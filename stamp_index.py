@@ -0,0 +1,164 @@
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Remembers the verified digests of files, keyed by their stat signature.
+
+Hashing every downloaded binary to check it is up to date makes no-op syncs
+slow. Once a file was hashed, its digest is recorded along with its size,
+mtime and inode. It is hashed again only if one of these changed, or in
+paranoid mode, which is enabled by setting PARANOID_ENV_VAR to 1.
+
+The index is shared by all the checkouts of the user, files are keyed by their
+absolute path. It is stored in the user's cache directory, see _DefaultIndex.
+Set INDEX_ENV_VAR to another file to use, or to 0 to always hash files.
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+import lockfile
+
+INDEX_ENV_VAR = 'DEPOT_TOOLS_STAMP_INDEX'
+PARANOID_ENV_VAR = 'DEPOT_TOOLS_PARANOID'
+
+
+def _DefaultIndex():
+    """Returns the index in the user's cache directory, so that it isn't
+    written to a depot_tools checkout which may be read-only or shared."""
+    if sys.platform == 'win32':
+        cache_dir = os.environ.get('LOCALAPPDATA')
+    else:
+        cache_dir = os.environ.get('XDG_CACHE_HOME')
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'depot_tools', 'stamp_index.json')
+
+
+def _Signature(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class StampIndex(object):
+    def __init__(self, path, paranoid=False):
+        self.path = path
+        self.paranoid = paranoid
+        self._lock = threading.Lock()
+        # Maps absolute paths to {'signature': [...], 'digests': {...}}.
+        self._entries = None
+        # The entries recorded since the index was last saved.
+        self._updates = {}
+
+    def _Read(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)['files']
+            if isinstance(entries, dict):
+                return entries
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            if os.path.exists(self.path):
+                logging.warning('Ignoring invalid %s: %s', self.path, e)
+        return {}
+
+    def _Entries(self):
+        if self._entries is None:
+            self._entries = self._Read()
+        return self._entries
+
+    def lookup(self, filename, algorithm):
+        """Returns the |algorithm| digest of |filename| recorded when it had
+        its current stat signature, or None."""
+        if self.paranoid:
+            return None
+        key = os.path.abspath(filename)
+        with self._lock:
+            entry = self._Entries().get(key)
+        if not entry or algorithm not in entry.get('digests', {}):
+            return None
+        try:
+            if entry.get('signature') != _Signature(filename):
+                return None
+        except OSError:
+            return None
+        return entry['digests'][algorithm]
+
+    def record(self, filename, algorithm, digest):
+        """Records that |filename| was verified to have the |algorithm|
+        |digest|."""
+        key = os.path.abspath(filename)
+        signature = _Signature(filename)
+        with self._lock:
+            entry = self._Entries().get(key)
+            if not entry or entry.get('signature') != signature:
+                entry = {'signature': signature, 'digests': {}}
+            else:
+                entry = {
+                    'signature': signature,
+                    'digests': dict(entry['digests'])
+                }
+            entry['digests'][algorithm] = digest
+            self._entries[key] = entry
+            self._updates[key] = entry
+
+    def digest(self, filename, algorithm, compute):
+        """Returns the |algorithm| digest of |filename|, calling
+        compute(filename) only if it isn't known."""
+        digest = self.lookup(filename, algorithm)
+        if digest is None:
+            digest = compute(filename)
+            self.record(filename, algorithm, digest)
+        return digest
+
+    def save(self):
+        """Merges the recorded entries into the index file. Does nothing if
+        nothing was recorded."""
+        with self._lock:
+            updates, self._updates = self._updates, {}
+        if not updates:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            with lockfile.lock(self.path, timeout=10):
+                entries = self._Read()
+                entries.update(updates)
+                # Forget the files which were removed.
+                entries = {
+                    path: entry
+                    for path, entry in entries.items()
+                    if path in updates or os.path.exists(path)
+                }
+                fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.path),
+                                           dir=os.path.dirname(self.path))
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump({'files': entries}, f)
+                    os.replace(tmp, self.path)
+                except BaseException:
+                    os.remove(tmp)
+                    raise
+        except (OSError, lockfile.LockError) as e:
+            # Files are hashed again next time.
+            logging.warning('Could not save %s: %s', self.path, e)
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+
+def GetStampIndex():
+    """Returns the StampIndex configured by the environment, or None."""
+    global _default_index
+    path = os.environ.get(INDEX_ENV_VAR) or _DefaultIndex()
+    if path == '0':
+        return None
+    paranoid = os.environ.get(PARANOID_ENV_VAR) == '1'
+    with _default_index_lock:
+        if (_default_index is None or _default_index.path != path
+                or _default_index.paranoid != paranoid):
+            _default_index = StampIndex(path, paranoid)
+        return _default_index
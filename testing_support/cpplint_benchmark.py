@@ -0,0 +1,305 @@
+#!/usr/bin/env vpython3
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Measures the throughput of cpplint.py, check by check.
+
+Runs cpplint.ProcessFileData over synthetic C++ translation units, and over any
+real files given on the command line, timing every Check* function of cpplint
+separately. The results are printed as JSON, e.g.:
+
+  testing_support/cpplint_benchmark.py --lines 50000 out/chromium/src/*.cc
+
+Compare the output of two revisions of cpplint.py to spot a check that became
+slower.
+"""
+
+import argparse
+import codecs
+import functools
+import json
+import os
+import random
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import cpplint
+
+# Functions of cpplint timed in addition to the Check* ones.
+_EXTRA_TIMED_FUNCTIONS = (
+    'CleansedLines',
+    'FlagCxx11Features',
+    'RemoveMultiLineComments',
+)
+
+_TYPES = ('int', 'std::string', 'base::FilePath', 'std::vector<int>',
+          'std::map<std::string, std::unique_ptr<Foo>>', 'const char*')
+
+
+class _SyntheticFile(object):
+    """Builds a C++ translation unit with constructs that stress cpplint."""
+    def __init__(self, rng, name):
+        self._rng = rng
+        self._name = name
+        self.lines = []
+
+    def _Type(self):
+        return self._rng.choice(_TYPES)
+
+    def _Macros(self):
+        name = 'MACRO_%d' % self._rng.randrange(1 << 16)
+        self.lines.extend([
+            '#define %s(x, y)          \\' % name,
+            '  do {                          \\',
+            '    if ((x) > (y)) {            \\',
+            '      Swap(&(x), &(y));         \\',
+            '    }                           \\',
+            '  } while (0)',
+            '#if defined(OS_WIN) && !defined(%s_DISABLED)' % name,
+            '#include <windows.h>',
+            '#endif  // defined(OS_WIN)',
+        ])
+
+    def _RawString(self):
+        self.lines.extend([
+            '  const char* kRaw%d = R"json({' % len(self.lines),
+            '    "key": "value with \\"quotes\\" and // comments",',
+            '    "other": [1, 2, 3] /* not a comment */',
+            '  })json";',
+        ])
+
+    def _Method(self, class_name, i):
+        kind = self._rng.randrange(5)
+        if kind == 0:
+            # Non-const reference parameters and long argument lists.
+            self.lines.extend([
+                '  void Update%d(%s& value,' % (i, self._Type()),
+                '               const %s& other,' % self._Type(),
+                '               int count) {',
+                '    for (int j = 0; j < count; ++j) {',
+                '      value = other+j;',
+                '    }',
+                '  }',
+            ])
+        elif kind == 1:
+            self.lines.extend([
+                '  virtual %s Get%d() const override { return %s_; }' %
+                (self._Type(), i, 'member%d' % i),
+            ])
+        elif kind == 2:
+            self.lines.extend([
+                '  template <typename T, typename U = std::vector<T>>',
+                '  static T Convert%d(const U& input) {' % i,
+                '    return static_cast<T>(input.size()) * (sizeof(T)+1);',
+                '  }',
+            ])
+        elif kind == 3:
+            self.lines.extend([
+                '  %s(int a, int b) : a_(a), b_(b) {' % class_name,
+                '    char buffer[256];',
+                '    sprintf(buffer, "%d %d", a, b);',
+                '    CHECK(a == b) << "mismatch";',
+                '  }',
+            ])
+        else:
+            self._RawString()
+
+    def _Class(self, num_methods):
+        class_name = 'Class%d' % len(self.lines)
+        self.lines.extend([
+            '// A class with a long body.',
+            'class %s : public Base {' % class_name,
+            ' public:',
+        ])
+        for i in range(num_methods):
+            self._Method(class_name, i)
+        self.lines.append(' private:')
+        for i in range(num_methods // 2):
+            self.lines.append('  %s member%d_;' % (self._Type(), i))
+        self.lines.extend(
+            ['  DISALLOW_COPY_AND_ASSIGN(%s);' % class_name, '};', ''])
+
+    def Build(self, num_lines, max_depth):
+        self.lines.extend([
+            '// Copyright 2024 The Chromium Authors',
+            '',
+            '#include "%s.h"' % self._name,
+            '',
+            '#include <map>',
+            '#include <string>',
+            '#include <vector>',
+            '',
+        ])
+        depth = 0
+        while len(self.lines) < num_lines:
+            if depth < max_depth and self._rng.random() < 0.3:
+                depth += 1
+                self.lines.extend(['namespace ns%d {' % depth, ''])
+            elif depth and self._rng.random() < 0.1:
+                self.lines.extend(['}  // namespace ns%d' % depth, ''])
+                depth -= 1
+            elif self._rng.random() < 0.2:
+                self._Macros()
+            else:
+                self._Class(self._rng.randrange(5, 60))
+        while depth:
+            self.lines.append('}  // namespace ns%d' % depth)
+            depth -= 1
+        self.lines.append('')
+        return self.lines
+
+
+def GenerateCorpus(num_files, num_lines, max_depth=8, seed=0):
+    """Returns a list of (filename, lines) of synthetic C++ files."""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(num_files):
+        name = 'synthetic/file%d' % i
+        corpus.append(
+            (name + '.cc', _SyntheticFile(rng,
+                                          name).Build(num_lines, max_depth)))
+    return corpus
+
+
+def ReadCorpus(paths):
+    """Returns a list of (filename, lines) of the files in |paths|."""
+    corpus = []
+    for path in paths:
+        with codecs.open(path, 'r', 'utf8', 'replace') as f:
+            lines = f.read().split('\n')
+        corpus.append((path, [line.rstrip('\r') for line in lines]))
+    return corpus
+
+
+class _Timings(object):
+    """Times the functions of cpplint while they are patched by Patch()."""
+    def __init__(self):
+        self.calls = {}
+        self.total = {}
+        self.own = {}
+        # Time spent in timed functions called by the running ones.
+        self._children = [0.0]
+
+    def _Wrap(self, name, function):
+        @functools.wraps(function)
+        def Timed(*args, **kwargs):
+            self._children.append(0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = self._children.pop()
+                self._children[-1] += elapsed
+                self.calls[name] = self.calls.get(name, 0) + 1
+                self.total[name] = self.total.get(name, 0.0) + elapsed
+                self.own[name] = self.own.get(name, 0.0) + elapsed - children
+
+        return Timed
+
+    def Patch(self):
+        """Replaces the timed functions of cpplint; returns the originals."""
+        originals = {}
+        for name, value in list(vars(cpplint).items()):
+            if not callable(value) or isinstance(value, type(sys)):
+                continue
+            if not (name.startswith('Check') or name in _EXTRA_TIMED_FUNCTIONS):
+                continue
+            originals[name] = value
+            setattr(cpplint, name, self._Wrap(name, value))
+        return originals
+
+
+def Run(corpus, repeat=1):
+    """Lints |corpus| |repeat| times and returns the measurements."""
+    num_lines = sum(len(lines) for _, lines in corpus) * repeat
+    errors = [0]
+
+    def Error(*_args):
+        errors[0] += 1
+
+    timings = _Timings()
+    originals = timings.Patch()
+    # Parsed files must not be reused across repetitions.
+    parse_cache_dir = cpplint._parse_cache_dir
+    cpplint._SetParseCacheDir(None)
+    try:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for filename, lines in corpus:
+                cpplint._parse_cache.clear()
+                extension = filename[filename.rfind('.') + 1:]
+                cpplint.ProcessFileData(filename, extension, list(lines), Error)
+        elapsed = time.perf_counter() - start
+    finally:
+        for name, value in originals.items():
+            setattr(cpplint, name, value)
+        cpplint._SetParseCacheDir(parse_cache_dir)
+
+    checks = {}
+    for name in sorted(timings.calls):
+        own = timings.own[name]
+        checks[name] = {
+            'calls': timings.calls[name],
+            'seconds': round(own, 6),
+            'seconds_including_callees': round(timings.total[name], 6),
+            'lines_per_second': round(num_lines / own) if own else None,
+        }
+    return {
+        'files': len(corpus),
+        'lines': num_lines,
+        'errors': errors[0],
+        'seconds': round(elapsed, 6),
+        'lines_per_second': round(num_lines / elapsed) if elapsed else None,
+        'checks': checks,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('files',
+                        nargs='*',
+                        help='Real C++ files to lint in addition to the '
+                        'synthetic ones.')
+    parser.add_argument('--synthetic-files',
+                        type=int,
+                        default=4,
+                        help='Number of synthetic files to generate.')
+    parser.add_argument('--lines',
+                        type=int,
+                        default=5000,
+                        help='Approximate number of lines of each synthetic '
+                        'file.')
+    parser.add_argument('--depth',
+                        type=int,
+                        default=8,
+                        help='Maximum namespace depth of synthetic files.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='Number of times the corpus is linted.')
+    parser.add_argument('--output',
+                        help='Write the JSON results to this file instead of '
+                        'stdout.')
+    options = parser.parse_args(argv)
+
+    corpus = GenerateCorpus(options.synthetic_files, options.lines,
+                            options.depth, options.seed)
+    corpus.extend(ReadCorpus(options.files))
+    results = Run(corpus, options.repeat)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,148 @@
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""A local HTTP server standing in for storage.googleapis.com in tests."""
+
+import hashlib
+import http.server
+import re
+import threading
+import urllib.parse
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(_Handler, self).setup()
+        with self.server.fake.lock:
+            self.server.fake.connections += 1
+
+    def log_message(self, *_args):
+        pass
+
+    def _Error(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _Object(self, method):
+        """Returns the (data, headers, bytes to send before dropping the
+        connection or None) to serve, or None if an error was sent."""
+        fake = self.server.fake
+        path = urllib.parse.unquote(self.path)
+        with fake.lock:
+            fake.requests.append((method, path, self.headers.get('Range')))
+            obj = fake.objects.get(path)
+            failures = fake.failures.get(path)
+            if failures:
+                fake.failures[path] = failures[1:]
+        if failures and failures[0] is not None and failures[0] < 0:
+            self._Error(-failures[0])
+            return None
+        if not obj:
+            self._Error(404)
+            return None
+        data, headers = obj
+        if fake.token and (self.headers.get('Authorization')
+                           != 'Bearer %s' % fake.token):
+            self._Error(401)
+            return None
+        if_match = self.headers.get('If-Match')
+        if if_match and if_match != headers['ETag']:
+            self._Error(412)
+            return None
+        return data, headers, failures[0] if failures else None
+
+    def do_HEAD(self):
+        served = self._Object('HEAD')
+        if not served:
+            return
+        data, headers, _ = served
+        self.send_response(200)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+    def do_GET(self):
+        served = self._Object('GET')
+        if not served:
+            return
+        data, headers, drop_after = served
+        status = 200
+        start, end = 0, len(data)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            status = 206
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)) + 1)
+        body = data[start:end]
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 206:
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end - 1, len(data)))
+        self.end_headers()
+        if drop_after is not None:
+            # Simulate a connection reset in the middle of the body.
+            self.wfile.write(body[:drop_after])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class FakeGcsServer(object):
+    """Serves the objects of fake buckets like Google Storage's XML API.
+
+    Supports HEAD, ranged GETs, If-Match on the ETag, x-goog-meta-executable
+    and bearer tokens. Requests and connections are counted so tests can check
+    how objects were fetched.
+    """
+    def __init__(self, token=None):
+        self.lock = threading.Lock()
+        # Maps '/bucket/object' to (data, headers).
+        self.objects = {}
+        # Maps '/bucket/object' to a list with an entry for each of the next
+        # requests: a negative HTTP status to fail with, a number of bytes of
+        # the body after which the connection is dropped, or None.
+        self.failures = {}
+        # (method, path, Range header) of each request.
+        self.requests = []
+        self.connections = 0
+        # If set, requests without this bearer token fail with HTTP 401.
+        self.token = token
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                       _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def add(self, bucket, name, data, executable=False):
+        headers = {'ETag': '"%s"' % hashlib.md5(data).hexdigest()}
+        if executable:
+            headers['x-goog-meta-executable'] = '1'
+        with self.lock:
+            self.objects['/%s/%s' % (bucket, name)] = (data, headers)
+
+    def fail(self, bucket, name, *failures):
+        with self.lock:
+            self.failures['/%s/%s' % (bucket, name)] = list(failures)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.01})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -0,0 +1,165 @@
+#!/usr/bin/env vpython3
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Unit tests for the depot_tools additions to cpplint.py."""
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cpplint
+import gclient_utils
+from testing_support import cpplint_benchmark
+
+
+class ProcessFilesTest(unittest.TestCase):
+    def setUp(self):
+        super(ProcessFilesTest, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(gclient_utils.rmtree, self.tmp)
+        self.files = []
+        for i in range(6):
+            path = os.path.join(self.tmp, 'dir%d' % (i % 2), 'file%d.cc' % i)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            gclient_utils.FileWrite(
+                path, '// Copyright\n'
+                'namespace foo {\n'
+                '  int a%d;  \n'
+                '}\n' % i + 'int b = %s;\n' % ('x' * (70 + i)))
+            self.files.append(path)
+        # Only applies to the files in dir1.
+        gclient_utils.FileWrite(
+            os.path.join(self.tmp, 'dir1', 'CPPLINT.cfg'),
+            'linelength=100\nfilter=-whitespace/end_of_line')
+        cpplint._SetFilters('-build/namespaces')
+        cpplint._SetCountingStyle('detailed')
+        self.addCleanup(cpplint._SetFilters, '')
+        self.addCleanup(cpplint._SetCountingStyle, 'total')
+
+    def _Run(self, jobs):
+        cpplint._cpplint_state.ResetErrorCounts()
+        with mock.patch('sys.stderr', io.StringIO()) as stderr:
+            cpplint.ProcessFiles(self.files, 1, jobs=jobs)
+        return (stderr.getvalue(), cpplint._cpplint_state.error_count,
+                list(cpplint._cpplint_state.errors_by_category.items()))
+
+    def testParallelMatchesSerial(self):
+        serial = self._Run(jobs=1)
+        self.assertIn('file2.cc:5:  (cpplint) Lines should be <= 80', serial[0])
+        self.assertNotIn('file3.cc:', serial[0])
+        self.assertEqual(serial, self._Run(jobs=3))
+
+    def testFiltersAreRestored(self):
+        filters = cpplint._Filters()[:]
+        self._Run(jobs=3)
+        self.assertEqual(filters, cpplint._Filters())
+
+
+class ParseCacheTest(unittest.TestCase):
+    CONTENTS = '\n'.join([
+        '// Copyright 2024',
+        '#include "foo.h"',
+        'namespace foo {',
+        'int Foo(int a, int b) {',
+        '  if (Bar(a,',
+        '          b)){ return "a(\\"b";}  ',
+        '  std::vector<std::pair<int, int> > v;',
+        '  return a+b;',
+        '}',
+        '}  // namespace foo',
+        '',
+    ])
+
+    def setUp(self):
+        super(ParseCacheTest, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(gclient_utils.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'foo.cc')
+        gclient_utils.FileWrite(self.path, self.CONTENTS)
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+        mock.patch('cpplint._parse_cache',
+                   cpplint.collections.OrderedDict()).start()
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(cpplint._SetParseCacheDir, None)
+
+    def _Lint(self):
+        cpplint._cpplint_state.ResetErrorCounts()
+        with mock.patch('sys.stderr', io.StringIO()) as stderr:
+            cpplint.ProcessFiles([self.path], 1, jobs=1)
+        return stderr.getvalue()
+
+    def testCachedParseGivesSameOutput(self):
+        expected = self._Lint()
+        self.assertIn('Missing space before {', expected)
+
+        cpplint._SetParseCacheDir(self.cache_dir)
+        cpplint._parse_cache.clear()
+        self.assertEqual(expected, self._Lint())
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+        # From disk, then from memory.
+        cpplint._parse_cache.clear()
+        with mock.patch('cpplint.CleansedLines.__init__') as init:
+            self.assertEqual(expected, self._Lint())
+            self.assertEqual(expected, self._Lint())
+        init.assert_not_called()
+
+    def testPruneParseCacheDir(self):
+        cpplint._SetParseCacheDir(self.cache_dir)
+        os.mkdir(self.cache_dir)
+        for i in range(4):
+            path = os.path.join(self.cache_dir, '%d.json' % i)
+            gclient_utils.FileWrite(path, 'x' * 10)
+            os.utime(path, (i, i))
+        with mock.patch('cpplint._PARSE_CACHE_DIR_SIZE', 3):
+            cpplint._PruneParseCacheDir()
+        self.assertEqual(['1.json', '2.json', '3.json'],
+                         sorted(os.listdir(self.cache_dir)))
+        with mock.patch('cpplint._PARSE_CACHE_DIR_MAX_BYTES', 15):
+            cpplint._PruneParseCacheDir()
+        self.assertEqual(['3.json'], os.listdir(self.cache_dir))
+
+    def testCloseExpressionIsMemoized(self):
+        lines = self.CONTENTS.split('\n')
+        clean_lines = cpplint._GetCleansedLines(lines)
+        with mock.patch('cpplint._CloseExpression',
+                        wraps=cpplint._CloseExpression) as close:
+            self.assertEqual(('          b)){ return "";}  ', 5, 13),
+                             cpplint.CloseExpression(clean_lines, 4, 5))
+            cpplint.CloseExpression(cpplint._GetCleansedLines(lines), 4, 5)
+        close.assert_called_once_with(clean_lines, 4, 5)
+
+
+class BenchmarkTest(unittest.TestCase):
+    def testGenerateCorpusIsDeterministic(self):
+        corpus = cpplint_benchmark.GenerateCorpus(2, 300, seed=1)
+        again = cpplint_benchmark.GenerateCorpus(2, 300, seed=1)
+        self.assertEqual(corpus, again)
+        self.assertEqual(['synthetic/file0.cc', 'synthetic/file1.cc'],
+                         [name for name, _ in corpus])
+        self.assertGreaterEqual(len(corpus[0][1]), 300)
+
+    def testRun(self):
+        check_language = cpplint.CheckLanguage
+        results = cpplint_benchmark.Run(cpplint_benchmark.GenerateCorpus(
+            1, 300))
+
+        self.assertIs(check_language, cpplint.CheckLanguage)
+        self.assertGreater(results['lines'], 300)
+        self.assertGreater(results['errors'], 0)
+        for name in ('CheckLanguage', 'CheckForNonConstReference',
+                     'CleansedLines'):
+            self.assertGreater(results['checks'][name]['calls'], 0)
+            self.assertLessEqual(
+                results['checks'][name]['seconds'],
+                results['checks'][name]['seconds_including_callees'])
+
+
+if __name__ == '__main__':
+    unittest.main()
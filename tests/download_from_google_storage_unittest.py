@@ -15,11 +15,16 @@ import tarfile
 import tempfile
 import threading
 import unittest
+from unittest import mock
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import upload_to_google_storage
 import download_from_google_storage
+import gcs_http
+import gcs_store
+import stamp_index
+from testing_support import fake_gcs_server
 
 # ../third_party/gsutil/gsutil
 GSUTIL_DEFAULT_PATH = os.path.join(
@@ -263,6 +268,132 @@ class DownloadTests(unittest.TestCase):
         self.assertEqual(self.gsutil.history, expected_calls)
         self.assertEqual(list(self.ret_codes.queue), expected_ret_codes)
 
+    def test_download_worker_with_downloader(self):
+        server = fake_gcs_server.FakeGcsServer()
+        server.start()
+        self.addCleanup(server.stop)
+        downloader = gcs_http.Downloader(server.url)
+        self.addCleanup(downloader.close)
+        with open(self.lorem_ipsum, 'rb') as f:
+            server.add('sometesturl', self.lorem_ipsum_sha1, f.read(), True)
+        missing_sha1 = 'e6c4fbd4fe7607f3e6ebf68b2ea4ef694da7b4fe'
+        output_filename = os.path.join(self.base_path,
+                                       'uploaded_lorem_ipsum.txt')
+        missing_filename = os.path.join(self.base_path, 'rootfolder_text.txt')
+        self.gsutil.add_expected(
+            0, '', '', lambda: shutil.copyfile(
+                os.path.join(self.checkout_test_files, 'rootfolder_text.txt'),
+                missing_filename))
+        # Left by an earlier download which failed.
+        for path in (missing_filename + '.partial',
+                     missing_filename + '.partial.json'):
+            with open(path, 'w') as f:
+                f.write('{}')
+        self.queue.put((self.lorem_ipsum_sha1, output_filename))
+        self.queue.put((missing_sha1, missing_filename))
+        self.queue.put((None, None))
+        download_from_google_storage._downloader_worker_thread(
+            0, self.queue, True, self.base_url, self.gsutil, queue.Queue(),
+            self.ret_codes, False, False, True, downloader)
+        # The partial download is removed once gsutil got the object.
+        self.assertFalse(os.path.exists(missing_filename + '.partial'))
+        self.assertFalse(os.path.exists(missing_filename + '.partial.json'))
+        with open(output_filename, 'rb') as f, open(self.lorem_ipsum,
+                                                    'rb') as g:
+            self.assertEqual(g.read(), f.read())
+        if sys.platform != 'win32':
+            self.assertTrue(os.access(output_filename, os.X_OK))
+        # Only the missing object is fetched with gsutil.
+        self.assertEqual([
+            ('check_call',
+             ('cp', 'gs://sometesturl/' + missing_sha1, missing_filename)),
+        ] + ([('check_call',
+               ('stat', 'gs://sometesturl/' +
+                missing_sha1))] if sys.platform != 'win32' else []),
+                         self.gsutil.history)
+        self.assertEqual([], list(self.ret_codes.queue))
+
+    def test_download_worker_with_store(self):
+        store = gcs_store.Store(os.path.join(self.temp_dir, 'store'))
+        output_filename = os.path.join(self.base_path,
+                                       'uploaded_lorem_ipsum.txt')
+        self.gsutil.add_expected(
+            0, '', '',
+            lambda: shutil.copyfile(self.lorem_ipsum, output_filename))
+        for _ in range(2):
+            self.queue.put((self.lorem_ipsum_sha1, output_filename))
+            self.queue.put((None, None))
+            download_from_google_storage._downloader_worker_thread(
+                0, self.queue, True, self.base_url, self.gsutil, queue.Queue(),
+                self.ret_codes, False, False, True, None, store)
+        # The second download comes from the store.
+        self.assertEqual(
+            1, len([c for c in self.gsutil.history if c[1][0] == 'cp']))
+        self.assertEqual(download_from_google_storage.get_sha1(output_filename),
+                         self.lorem_ipsum_sha1)
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(store.path, 'sha1', self.lorem_ipsum_sha1[:2],
+                             self.lorem_ipsum_sha1)))
+        self.assertEqual([], list(self.ret_codes.queue))
+
+    def test_download_worker_with_corrupted_store(self):
+        store = gcs_store.Store(os.path.join(self.temp_dir, 'store'))
+        output_filename = os.path.join(self.base_path,
+                                       'uploaded_lorem_ipsum.txt')
+        self.gsutil.add_expected(
+            0, '', '',
+            lambda: shutil.copyfile(self.lorem_ipsum, output_filename))
+        self.queue.put((self.lorem_ipsum_sha1, output_filename))
+        self.queue.put((None, None))
+        download_from_google_storage._downloader_worker_thread(
+            0, self.queue, True, self.base_url, self.gsutil, queue.Queue(),
+            self.ret_codes, False, False, True, None, store)
+        # Modifying the output in place also modifies the stored object.
+        with open(output_filename, 'a') as f:
+            f.write('modified')
+
+        other_output = os.path.join(self.temp_dir, 'other_lorem_ipsum.txt')
+        self.gsutil.add_expected(
+            0, '', '', lambda: shutil.copyfile(self.lorem_ipsum, other_output))
+        self.queue.put((self.lorem_ipsum_sha1, other_output))
+        self.queue.put((None, None))
+        download_from_google_storage._downloader_worker_thread(
+            0, self.queue, True, self.base_url, self.gsutil, queue.Queue(),
+            self.ret_codes, False, False, True, None, store)
+        # The corrupted object isn't used, the file is downloaded again.
+        self.assertEqual(
+            2, len([c for c in self.gsutil.history if c[1][0] == 'cp']))
+        self.assertEqual(download_from_google_storage.get_sha1(other_output),
+                         self.lorem_ipsum_sha1)
+        self.assertEqual([], list(self.ret_codes.queue))
+
+    def test_data_exists_with_stamps(self):
+        stamps = stamp_index.StampIndex(os.path.join(self.temp_dir, 'index'))
+        output_filename = os.path.join(self.base_path, 'rootfolder_text.txt')
+        sha1_hash = 'e6c4fbd4fe7607f3e6ebf68b2ea4ef694da7b4fe'
+        with mock.patch('download_from_google_storage.get_sha1',
+                        wraps=download_from_google_storage.get_sha1) as get:
+            for _ in range(2):
+                self.assertTrue(
+                    download_from_google_storage._data_exists(
+                        sha1_hash, output_filename, False, stamps))
+            self.assertEqual(1, get.call_count)
+
+            stamps.paranoid = True
+            self.assertTrue(
+                download_from_google_storage._data_exists(
+                    sha1_hash, output_filename, False, stamps))
+            self.assertEqual(2, get.call_count)
+
+            stamps.paranoid = False
+            with open(output_filename, 'a') as f:
+                f.write('changed')
+            self.assertFalse(
+                download_from_google_storage._data_exists(
+                    sha1_hash, output_filename, False, stamps))
+            self.assertEqual(3, get.call_count)
+
     def test_download_worker_skips_file(self):
         sha1_hash = 'e6c4fbd4fe7607f3e6ebf68b2ea4ef694da7b4fe'
         output_filename = os.path.join(self.base_path, 'rootfolder_text.txt')
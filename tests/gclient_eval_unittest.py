@@ -3,11 +3,14 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import ast
 import itertools
 import logging
 import os
 import sys
+import tempfile
 import unittest
+from unittest import mock
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -437,6 +440,40 @@ class EvaluateConditionTest(unittest.TestCase):
             gclient_eval.EvaluateCondition('s_var in ("baz", "quux")',
                                            {'s_var': Str("foo")}))
 
+    def test_compiles_conditions_once(self):
+        gclient_eval._CompileCondition.cache_clear()
+        with mock.patch('ast.parse', wraps=ast.parse) as parse:
+            for value in ['True', 'False', 'True']:
+                gclient_eval.EvaluateCondition('compiled_once and True',
+                                               {'compiled_once': value})
+        self.assertEqual(['compiled_once and True', 'True', 'False'],
+                         [args[0] for args, _ in parse.call_args_list])
+
+    def test_cached_results_follow_variables(self):
+        condition = 'cached_a and cached_b'
+        variables = {'cached_a': 'cached_c', 'cached_b': True, 'cached_c': True}
+        self.assertTrue(gclient_eval.EvaluateCondition(condition, variables))
+        variables['cached_c'] = False
+        self.assertFalse(gclient_eval.EvaluateCondition(condition, variables))
+        variables['cached_c'] = 1
+        with self.assertRaises(ValueError):
+            gclient_eval.EvaluateCondition(condition, variables)
+        variables['cached_c'] = True
+        self.assertTrue(gclient_eval.EvaluateCondition(condition, variables))
+
+        # Unhashable values are not cached.
+        self.assertEqual(['x'],
+                         gclient_eval.EvaluateCondition('cached_d',
+                                                        {'cached_d': ['x']}))
+
+        for _ in range(2):
+            with self.assertRaises(ValueError) as cm:
+                gclient_eval.EvaluateCondition('cached_e', {
+                    'cached_e': 'cached_f',
+                    'cached_f': 'cached_e'
+                })
+            self.assertIn('invalid cyclic reference', str(cm.exception))
+
 
 class VarTest(unittest.TestCase):
     def assert_adds_var(self, before, after):
@@ -1318,6 +1355,93 @@ class ParseTest(unittest.TestCase):
             }, local_scope)
 
 
+class ParseCacheTest(unittest.TestCase):
+    DEPS = file_join([
+        'vars = {',
+        '  "foo": "bar",',
+        '  "str": Str("{not_expanded}"),',
+        '  "flag": True,',
+        '}',
+        'deps = {',
+        '  "a_dep": "a{foo}b",',
+        '  "b_dep": {',
+        '    "url": Var("foo") + "/b",',
+        '    "condition": "flag",',
+        '  },',
+        '}',
+        'deps_os = {',
+        '  "mac": {',
+        '    "c_dep": "c",',
+        '  },',
+        '}',
+        'recursedeps = [("a_dep", "DEPS.custom"), "b_dep"]',
+        'hooks = [{"action": ["a"], "name": "{foo}"}]',
+    ])
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(gclient_utils.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, '.gclient_deps_cache')
+
+    def _Parse(self, cache, vars_override=None, builtin_vars=None):
+        return gclient_eval.Parse(self.DEPS, 'DEPS', vars_override,
+                                  builtin_vars, cache)
+
+    def test_same_result(self):
+        expected = self._Parse(None)
+        cache = gclient_eval.ParseCache(self.path)
+        miss = self._Parse(cache)
+        with mock.patch('gclient_eval.Exec') as exec_mock:
+            hit = self._Parse(cache)
+        exec_mock.assert_not_called()
+        for result in (miss, hit):
+            self.assertEqual(expected, result)
+            self.assertEqual(list(expected), list(result))
+            self.assertIsInstance(result['vars']['str'],
+                                  gclient_eval.ConstantString)
+            self.assertEqual(('a_dep', 'DEPS.custom'), result['recursedeps'][0])
+        # Each result can be modified without affecting the cache.
+        hit['deps']['a_dep']['url'] = 'modified'
+        self.assertEqual(expected, self._Parse(cache))
+
+    def test_key_includes_vars(self):
+        cache = gclient_eval.ParseCache(self.path)
+        self._Parse(cache)
+        with mock.patch('gclient_eval.Exec', wraps=gclient_eval.Exec) as e:
+            result = self._Parse(cache, {'foo': 'baz'})
+            self.assertEqual('abazb', result['deps']['a_dep']['url'])
+            self._Parse(cache, builtin_vars={'checkout_mac': True})
+            self.assertEqual(2, e.call_count)
+
+    def test_save(self):
+        cache = gclient_eval.ParseCache(self.path)
+        self._Parse(cache)
+        self._Parse(cache, {'foo': 'baz'})
+        cache.save()
+
+        # Only the entries used since the cache was loaded are kept.
+        cache = gclient_eval.ParseCache(self.path)
+        self._Parse(cache, {'foo': 'other'})
+        cache.save()
+        cache = gclient_eval.ParseCache(self.path)
+        with mock.patch('gclient_eval.Exec', wraps=gclient_eval.Exec) as e:
+            self._Parse(cache, {'foo': 'other'})
+            e.assert_not_called()
+            self._Parse(cache)
+            e.assert_called_once()
+
+    def test_save_without_changes(self):
+        gclient_utils.FileWrite(self.path, 'invalid')
+        cache = gclient_eval.ParseCache(self.path)
+        cache.save()
+        self.assertEqual('invalid', gclient_utils.FileRead(self.path))
+        self._Parse(cache)
+        cache.save()
+        self.assertIsNotNone(
+            gclient_eval.ParseCache(self.path).get(
+                gclient_eval.ParseCache.Key(self.DEPS)))
+
+
 if __name__ == '__main__':
     level = logging.DEBUG if '-v' in sys.argv else logging.FATAL
     logging.basicConfig(level=level,
@@ -7,12 +7,17 @@
 See gclient_smoketest.py for integration tests.
 """
 
+import functools
+import io
 import json
 import logging
 import ntpath
 import os
 import queue
+import subprocess
 import sys
+import threading
+import time
 import unittest
 from unittest import mock
 
@@ -1550,6 +1555,86 @@ class GclientTest(trial_dir.TestCase):
         self.assertEqual('https://example.com/bar_package@bar_version',
                          dep1.url)
 
+    def _CipdEnsureClient(self):
+        options, _ = gclient.OptionParser().parse_args([])
+        obj = gclient.GClient(self.root_dir, options)
+        obj._cipd_root = mock.Mock()
+        sol = gclient.Dependency(parent=obj,
+                                 name='foo',
+                                 url='svn://example.com/foo',
+                                 managed=None,
+                                 custom_deps=None,
+                                 custom_vars=None,
+                                 custom_hooks=None,
+                                 deps_file='DEPS',
+                                 should_process=True,
+                                 should_recurse=True,
+                                 relative=False,
+                                 condition=None,
+                                 protocol='https',
+                                 print_outbuf=True)
+        obj.add_dependencies_and_close([sol], [])
+        sol.add_dependencies_and_close([
+            gclient.CipdDependency(parent=sol,
+                                   name='foo/bar',
+                                   dep_value={
+                                       'package': 'bar_package',
+                                       'version': 'bar_version'
+                                   },
+                                   cipd_root=CIPDRootMock(
+                                       self.root_dir, 'https://example.com'),
+                                   custom_vars=None,
+                                   should_process=True,
+                                   relative=False,
+                                   condition=None),
+        ], [])
+        return obj, sol
+
+    def testCipdEnsureScheduledOnceDepsAreParsed(self):
+        obj, sol = self._CipdEnsureClient()
+        other = mock.Mock(should_process=True, should_recurse=True)
+        scheduler = gclient.CipdEnsureScheduler(obj, {})
+        scheduler.add(sol)
+        scheduler.add(other)
+        work_queue = mock.Mock()
+        for dep in sol.dependencies:
+            scheduler.add(dep)
+
+        scheduler.processed(sol, work_queue)
+        work_queue.enqueue.assert_not_called()
+        scheduler.processed(other, work_queue)
+        work_queue.enqueue.assert_called_once_with(scheduler.item)
+        self.assertEqual(['foo/bar:bar_package'], scheduler.item.requirements)
+
+        scheduler.item.run({}, 'update', [], work_queue=work_queue)
+        obj._cipd_root.run.assert_called_once_with('update')
+
+    def testCipdEnsureWaitsForRemovedGitDirs(self):
+        obj, sol = self._CipdEnsureClient()
+        scheduler = gclient.CipdEnsureScheduler(
+            obj, {
+                'foo': 'svn://example.com/foo',
+                'foo/bar': 'https://example.com/bar.git',
+            })
+        scheduler.add(sol)
+        work_queue = mock.Mock()
+        scheduler.processed(sol, work_queue)
+        work_queue.enqueue.assert_not_called()
+        self.assertIsNone(scheduler.item)
+
+    def testCipdEnsureWaitsForRemovedCipdDirs(self):
+        obj, sol = self._CipdEnsureClient()
+        scheduler = gclient.CipdEnsureScheduler(
+            obj, {
+                'foo': 'svn://example.com/foo',
+                'foo/bar:bar_package': 'https://example.com/bar@1',
+                'foo:old_package': 'https://example.com/old@1',
+            })
+        scheduler.add(sol)
+        work_queue = mock.Mock()
+        scheduler.processed(sol, work_queue)
+        work_queue.enqueue.assert_not_called()
+
     def _testPosixpathImpl(self):
         parser = gclient.OptionParser()
         options, _ = parser.parse_args([])
@@ -1707,6 +1792,350 @@ class GclientTest(trial_dir.TestCase):
                          client._EnforceSkipSyncRevisions(patch_refs))
 
 
+class SyncHistoryTest(trial_dir.TestCase):
+    def setUp(self):
+        super(SyncHistoryTest, self).setUp()
+        self.path = os.path.join(self.root_dir, '.gclient_sync_history')
+
+    def _dep(self, name, parent_name, seconds):
+        start = gclient_utils.datetime.datetime(2020, 1, 1)
+        parent = mock.Mock()
+        parent.name = parent_name
+        dep = mock.Mock(start=start, bytes_fetched=(seconds or 0) * 10)
+        dep.name = name
+        dep.parent = parent
+        dep.finish = None
+        if seconds is not None:
+            dep.finish = start + gclient_utils.datetime.timedelta(
+                seconds=seconds)
+        return dep
+
+    def testRoundTrip(self):
+        history = gclient.SyncHistory(self.path)
+        history.record(self._dep('src', None, 10))
+        history.record(self._dep('src/a', 'src', 30))
+        history.record(self._dep('src/b', 'src', 5))
+        history.record(self._dep('other', None, 20))
+        history.save()
+
+        history = gclient.SyncHistory(self.path)
+        self.assertEqual({
+            'src': 40,
+            'src/a': 30,
+            'src/b': 5,
+            'other': 20,
+        }, history.estimates())
+        self.assertEqual(300, history.entries['src/a']['bytes_fetched'])
+
+    def testSaveDropsRemovedDeps(self):
+        history = gclient.SyncHistory(self.path)
+        history.record(self._dep('src', None, 10))
+        history.record(self._dep('src/a', 'src', 30))
+        history.record(self._dep('src/b', 'src', 5))
+        history.save()
+
+        history = gclient.SyncHistory(self.path)
+        history.save(['src', 'src/b'])
+        self.assertEqual(['src', 'src/b'],
+                         sorted(gclient.SyncHistory(self.path).entries))
+
+    def testRecordSmoothsAndCountsFailures(self):
+        history = gclient.SyncHistory(self.path)
+        history.record(self._dep('src', None, 10))
+        history.record(self._dep('src', None, 20))
+        history.record(self._dep('src', None, None))
+        self.assertEqual(15, history.entries['src']['duration'])
+        self.assertEqual(1, history.entries['src']['failures'])
+        self.assertEqual(3, history.entries['src']['runs'])
+
+    def testInvalidFileIsIgnored(self):
+        write(self.path, 'not json')
+        self.assertEqual({}, gclient.SyncHistory(self.path).entries)
+
+    @mock.patch('gclient_utils.NumLocalCpus', return_value=2)
+    def testSuggestJobs(self, _):
+        history = gclient.SyncHistory(self.path)
+        self.assertEqual(8, history.suggest_jobs(8))
+        history.record(self._dep('src', None, 10))
+        for i in range(20):
+            history.record(self._dep('src/%d' % i, 'src', 10))
+        # 210s of work on a 20s critical path, capped at 4 jobs per CPU.
+        self.assertEqual(8, history.suggest_jobs(4))
+        self.assertEqual(16, history.suggest_jobs(16))
+
+
+class ParallelHooksTest(unittest.TestCase):
+    def setUp(self):
+        super(ParallelHooksTest, self).setUp()
+        self.lock = threading.Lock()
+        self.events = []
+        self.fail = None
+        mock.patch('gclient.Hook.run', autospec=True,
+                   side_effect=self._Run).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _Run(self, hook, out=None, state=None):
+        with self.lock:
+            self.events.append(('start', hook.name))
+        time.sleep(0.05)
+        if hook.name == self.fail:
+            sys.exit(2)
+        print('output of %s' % hook.name, file=out)
+        with self.lock:
+            self.events.append(('end', hook.name))
+
+    def _RunHooks(self, hooks, jobs=4):
+        options = mock.Mock(jobs=jobs)
+        dep = mock.Mock(hooks_ran=False)
+        dep.GetHooks.return_value = hooks
+        dep._RunHooksInParallel = functools.partial(
+            gclient.Dependency._RunHooksInParallel, dep)
+        with mock.patch('sys.stdout', io.StringIO()) as stdout:
+            gclient.Dependency.RunHooksRecursively(dep, options, None)
+        return stdout.getvalue()
+
+    def _Index(self, event, name):
+        return self.events.index((event, name))
+
+    def testRequiresAndResources(self):
+        output = self._RunHooks([
+            gclient.Hook(['a'], name='a'),
+            gclient.Hook(['b'], name='b', requires=[], resources=['r']),
+            gclient.Hook(['c'], name='c', resources=['r']),
+            gclient.Hook(['d'], name='d', requires=['b', 'unknown']),
+            gclient.Hook(['e'], name='e'),
+        ])
+        self.assertEqual(10, len(self.events))
+        for name in 'bcd':
+            self.assertLess(self._Index('end', 'a'), self._Index('start', name))
+            self.assertLess(self._Index('end', name), self._Index('start', 'e'))
+        self.assertLess(self._Index('end', 'b'), self._Index('start', 'd'))
+        # b and c share a resource.
+        self.assertTrue(
+            self._Index('end', 'b') < self._Index('start', 'c')
+            or self._Index('end', 'c') < self._Index('start', 'b'))
+        # c doesn't wait for anything but a.
+        self.assertLess(self._Index('start', 'c'), self._Index('end', 'd'))
+        self.assertIn('output of d', output)
+
+    def testOrderedHooksRunSerially(self):
+        with mock.patch('gclient_utils.ExecutionQueue') as queue_mock:
+            self._RunHooks([
+                gclient.Hook(['a'], name='a'),
+                gclient.Hook(['b'], name='b'),
+            ])
+        queue_mock.assert_not_called()
+        self.assertEqual([('start', 'a'), ('end', 'a'), ('start', 'b'),
+                          ('end', 'b')], self.events)
+
+    def testFailureStopsLaterHooks(self):
+        self.fail = 'b'
+        with mock.patch('sys.stderr', io.StringIO()):
+            with self.assertRaises(SystemExit) as e:
+                self._RunHooks([
+                    gclient.Hook(['b'], name='b', requires=[]),
+                    gclient.Hook(['c'], name='c'),
+                ])
+        self.assertEqual(2, e.exception.code)
+        self.assertNotIn(('start', 'c'), self.events)
+
+
+class HooksStateTest(trial_dir.TestCase):
+    def setUp(self):
+        super(HooksStateTest, self).setUp()
+        self.path = os.path.join(self.root_dir, '.gclient_hooks_state')
+        self.input = os.path.join(self.root_dir, 'input.json')
+        write(self.input, '{}')
+        self.call = mock.patch('gclient_utils.CheckCallAndFilter').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _Hook(self, inputs=('input.json', ), variables=None):
+        return gclient.Hook(['cmd', 'arg'],
+                            name='hook',
+                            variables=variables or {'var': 'value'},
+                            cwd_base=self.root_dir,
+                            inputs=list(inputs) if inputs is not None else None)
+
+    def _Run(self, hook, force=False):
+        self.call.reset_mock()
+        state = gclient.HooksState(self.path, force=force)
+        hook.run(out=io.StringIO(), state=state)
+        state.save()
+        return self.call.called
+
+    def testSkipsUnchangedHooks(self):
+        self.assertTrue(self._Run(self._Hook()))
+        self.assertFalse(self._Run(self._Hook()))
+        self.assertTrue(self._Run(self._Hook(), force=True))
+        self.assertTrue(self._Run(self._Hook(variables={'var': 'other'})))
+        self.assertFalse(self._Run(self._Hook(variables={'var': 'other'})))
+        write(self.input, '{"changed": true}')
+        self.assertTrue(self._Run(self._Hook(variables={'var': 'other'})))
+
+    def testMissingInputs(self):
+        os.remove(self.input)
+        self.assertTrue(self._Run(self._Hook()))
+        self.assertFalse(self._Run(self._Hook()))
+        write(self.input, '{}')
+        self.assertTrue(self._Run(self._Hook()))
+
+    def testHooksWithoutInputsAlwaysRun(self):
+        self.assertTrue(self._Run(self._Hook(inputs=None)))
+        self.assertTrue(self._Run(self._Hook(inputs=None)))
+        self.assertTrue(self._Run(self._Hook(inputs=[])))
+        self.assertFalse(self._Run(self._Hook(inputs=[])))
+
+    def testFailedHooksAreNotRecorded(self):
+        self.call.side_effect = gclient_utils.Error('failed')
+        with mock.patch('sys.stderr', io.StringIO()):
+            with self.assertRaises(SystemExit):
+                self._Run(self._Hook())
+        self.call.side_effect = None
+        self.assertTrue(self._Run(self._Hook()))
+
+    def testUnusedHooksAreDropped(self):
+        self._Run(self._Hook())
+        self._Run(gclient.Hook(['other'], cwd_base=self.root_dir, inputs=[]))
+        with open(self.path) as f:
+            self.assertEqual(1, len(json.load(f)['hooks']))
+
+
+class FlattenStateTest(trial_dir.TestCase):
+    def setUp(self):
+        super(FlattenStateTest, self).setUp()
+        self.path = os.path.join(self.root_dir, '.gclient_flatten_state')
+        self.head = os.path.join(self.root_dir, 'src', 'a', '.git', 'HEAD')
+        write(self.head, '1' * 40)
+        self.root = mock.Mock(root_dir=self.root_dir)
+        self.src = self._Dep('src', 'https://example.com/src', None)
+
+    def _Dep(self, name, url, parent, scm='git'):
+        dep = mock.Mock(url=url, root=self.root)
+        dep.name = name
+        dep.parent = parent
+        dep.GetScmName.return_value = scm
+        return dep
+
+    def _Record(self, dep):
+        state = gclient.FlattenState(self.path)
+        self.assertIsNone(state.lookup(dep))
+        url = dep.url
+        dep.url = url + '@' + '1' * 40
+        state.record(dep, url)
+        dep.url = url
+        state.save()
+
+    def testReusesPinnedRevisions(self):
+        dep = self._Dep('src/a', 'https://example.com/a', self.src)
+        self._Record(dep)
+        self.assertEqual('https://example.com/a@' + '1' * 40,
+                         gclient.FlattenState(self.path).lookup(dep))
+        self.assertIsNone(
+            gclient.FlattenState(self.path, changed=['src']).lookup(dep))
+
+        # Entries which were not used are dropped.
+        gclient.FlattenState(self.path).save()
+        self.assertIsNone(gclient.FlattenState(self.path).lookup(dep))
+
+    def testCheckoutMoved(self):
+        dep = self._Dep('src/a', 'https://example.com/a', self.src)
+        self._Record(dep)
+        write(self.head + '.new', '2' * 40)
+        os.replace(self.head + '.new', self.head)
+        self.assertIsNone(gclient.FlattenState(self.path).lookup(dep))
+
+    def testUrlChanged(self):
+        dep = self._Dep('src/a', 'https://example.com/a', self.src)
+        self._Record(dep)
+        dep.url = 'https://example.com/a@refs/heads/other'
+        self.assertIsNone(gclient.FlattenState(self.path).lookup(dep))
+
+    def testOnlyGitCheckoutsAreRecorded(self):
+        dep = self._Dep('src/a', 'https://example.com/a', self.src, 'cipd')
+        self._Record(dep)
+        dep.GetScmName.return_value = 'git'
+        self.assertIsNone(gclient.FlattenState(self.path).lookup(dep))
+        self.assertIsNone(gclient._GitHeadSignature(self.root_dir))
+
+
+class FlattenReusePinsTest(trial_dir.TestCase):
+    def setUp(self):
+        super(FlattenReusePinsTest, self).setUp()
+        self.previous_dir = os.getcwd()
+        os.chdir(self.root_dir)
+        self.addCleanup(os.chdir, self.previous_dir)
+        self.state_path = os.path.join(self.root_dir, '.gclient_flatten_state')
+        write(
+            '.gclient', 'solutions = [\n'
+            '  { "name": "src", "url": "https://example.com/src" },\n'
+            ']')
+        self._Commit(
+            'src', 'DEPS', 'deps = {\n'
+            '  "src/a": "https://example.com/a",\n'
+            '  "src/b": "https://example.com/b",\n'
+            '}')
+        self._Commit(os.path.join('src', 'a'), 'a', 'a')
+        self._Commit(os.path.join('src', 'b'), 'b', 'b')
+
+    def _Git(self, cwd, *args):
+        return subprocess.check_output(
+            ['git', '-c', 'user.name=a', '-c', 'user.email=a@example.com'] +
+            list(args),
+            cwd=cwd,
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+
+    def _Commit(self, path, filename, content):
+        if not os.path.isdir(os.path.join(path, '.git')):
+            self._Git(self.root_dir, 'init', '-q', path)
+            self._Git(path, 'remote', 'add', 'origin',
+                      'https://example.com/' + os.path.basename(path))
+        write(os.path.join(path, filename), content)
+        self._Git(path, 'add', filename)
+        self._Git(path, 'commit', '-q', '-m', filename)
+
+    def _Flatten(self, state=None):
+        options, _ = gclient.OptionParser().parse_args([])
+        options.nohooks = True
+        options.process_all_deps = True
+        client = gclient.GClient.LoadCurrentConfig(options)
+        self.assertEqual(0, client.RunOnDeps('flatten', []))
+        flattener = gclient.Flattener(client, pin_all_deps=True, state=state)
+        if state:
+            state.save()
+        return flattener.deps_string
+
+    def _FlattenReusingPins(self):
+        pin = gclient.Dependency.PinToActualRevision
+        pinned = []
+
+        def record_pin(dep):
+            pinned.append(dep.name)
+            pin(dep)
+
+        with mock.patch('gclient.Dependency.PinToActualRevision', record_pin):
+            deps_string = self._Flatten(gclient.FlattenState(self.state_path))
+        return deps_string, sorted(pinned)
+
+    def testMatchesFullRun(self):
+        expected = self._Flatten()
+        self.assertEqual((expected, ['src', 'src/a', 'src/b']),
+                         self._FlattenReusingPins())
+        self.assertEqual((expected, []), self._FlattenReusingPins())
+
+        self._Commit(os.path.join('src', 'a'), 'a', 'moved')
+        expected = self._Flatten()
+        self.assertIn(self._Git('src/a', 'rev-parse', 'HEAD'), expected)
+        self.assertEqual((expected, ['src/a']), self._FlattenReusingPins())
+
+    def testRequiresPinAllDeps(self):
+        self._FlattenReusingPins()
+        state = gclient_utils.FileRead(self.state_path)
+        parser = gclient.OptionParser()
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            gclient.CMDflatten(parser, ['--reuse-pins'])
+        self.assertEqual(state, gclient_utils.FileRead(self.state_path))
+
+
 class MergeVarsTest(unittest.TestCase):
     def test_merge_vars(self):
         merge_vars = gclient.merge_vars
@@ -7,6 +7,7 @@
 import io
 import os
 import sys
+import time
 import unittest
 from unittest import mock
 
@@ -301,6 +302,95 @@ class ExtracRefNameTest(unittest.TestCase):
         self.assertIsNone(gclient_utils.ExtractRefName('origin', 'abcbbb1234'))
 
 
+class ExecutionQueueTestCase(unittest.TestCase):
+    class Item(gclient_utils.WorkItem):
+        def __init__(self,
+                     name,
+                     requirements=(),
+                     children=(),
+                     resources=(),
+                     duration=0):
+            super(ExecutionQueueTestCase.Item, self).__init__(name)
+            self.requirements = requirements
+            self.children = children
+            self.resources = list(resources)
+            self.duration = duration
+            self.started = None
+            self.finished = None
+
+        def run(self, ran, work_queue):
+            self.started = time.monotonic()
+            time.sleep(self.duration)
+            self.finished = time.monotonic()
+            ran.append(self.name)
+            for child in self.children:
+                work_queue.enqueue(child)
+
+    def _flush(self, items, jobs=1, estimates=None):
+        ran = []
+        work_queue = gclient_utils.ExecutionQueue(jobs,
+                                                  None,
+                                                  False,
+                                                  estimates=estimates)
+        for item in items:
+            work_queue.enqueue(item)
+        work_queue.flush(ran)
+        self.assertEqual(sorted(ran), sorted(work_queue.ran))
+        return ran
+
+    def testFifoWithoutEstimates(self):
+        items = [self.Item(name) for name in ('c', 'a', 'b')]
+        self.assertEqual(['c', 'a', 'b'], self._flush(items))
+
+    def testRequirements(self):
+        items = [
+            self.Item('c', requirements=('b', )),
+            self.Item('b', requirements=('a', )),
+            self.Item('a'),
+        ]
+        self.assertEqual(['a', 'b', 'c'], self._flush(items))
+
+    def testEstimatesOrderReadyItems(self):
+        items = [self.Item(name) for name in ('small', 'large', 'medium')]
+        estimates = {'small': 1, 'large': 100, 'medium': 10}
+        self.assertEqual(['large', 'medium', 'small'],
+                         self._flush(items, estimates=estimates))
+
+    def testEstimatesPropagateToRequirements(self):
+        # 'b' is cheap itself, but 'slow' waits on it.
+        items = [
+            self.Item('a'),
+            self.Item('b'),
+            self.Item('slow', requirements=('b', )),
+        ]
+        estimates = {'a': 10, 'b': 1, 'slow': 100}
+        self.assertEqual(['b', 'slow', 'a'],
+                         self._flush(items, estimates=estimates))
+
+    def testNestedItemWaitsForLateParent(self):
+        # 'src/foo' is ready first, but 'src' is enqueued by 'other' before
+        # 'src/foo' is started, and must run before it.
+        src = self.Item('src')
+        items = [
+            self.Item('other', children=(src, )),
+            self.Item('src/foo', requirements=('other', )),
+        ]
+        self.assertEqual(['other', 'src', 'src/foo'], self._flush(items))
+
+    def testResourcesConflict(self):
+        a = self.Item('a', resources=('url', ), duration=0.2)
+        b = self.Item('b', resources=('url', ), duration=0.2)
+        c = self.Item('c', duration=0.2)
+        ran = self._flush([a, b, c], jobs=3)
+        self.assertEqual(['a', 'b', 'c'], sorted(ran))
+
+        # 'a' and 'b' share a resource, so one only starts once the other
+        # finished. 'c' runs alongside the first of them.
+        first, second = sorted([a, b], key=lambda item: item.started)
+        self.assertGreaterEqual(second.started, first.finished)
+        self.assertLess(c.started, first.finished)
+
+
 class GClientUtilsTest(trial_dir.TestCase):
     def testHardToDelete(self):
         # Use the fact that tearDown will delete the directory to make it hard
@@ -0,0 +1,187 @@
+#!/usr/bin/env vpython3
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Unit tests for gcs_archive.py."""
+
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gclient_utils
+import gcs_archive
+
+
+class ExtractTest(unittest.TestCase):
+    def setUp(self):
+        super(ExtractTest, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(gclient_utils.rmtree, self.tmp)
+        self.archive = os.path.join(self.tmp, 'archive.tar.gz')
+        self.staging = os.path.join(self.tmp, 'staging')
+        os.mkdir(self.staging)
+        # No pigz, to decompress in-process.
+        mock.patch.dict('os.environ', {
+            gcs_archive.PARALLEL_ENV_VAR: '0'
+        }).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _Write(self, entries, mode='w:gz', path=None):
+        """Writes a tarball of |entries|, (name, contents) for files or
+        (name, None) for directories, or TarInfos."""
+        with tarfile.open(path or self.archive, mode) as tar:
+            for entry in entries:
+                if isinstance(entry, tarfile.TarInfo):
+                    tar.addfile(entry)
+                    continue
+                name, contents = entry
+                tarinfo = tarfile.TarInfo(name)
+                if contents is None:
+                    tarinfo.type = tarfile.DIRTYPE
+                    tarinfo.mode = 0o555
+                    tar.addfile(tarinfo)
+                else:
+                    tarinfo.size = len(contents)
+                    tar.addfile(tarinfo, io.BytesIO(contents))
+        with open(path or self.archive, 'rb') as f:
+            return f.read()
+
+    def _Link(self, name, target, link_type=tarfile.SYMTYPE):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.type = link_type
+        tarinfo.linkname = target
+        return tarinfo
+
+    def _Read(self, *path):
+        with open(os.path.join(self.staging, *path), 'rb') as f:
+            return f.read()
+
+    def testExtract(self):
+        data = self._Write([('dir', None), ('dir/a', b'a' * 100000),
+                            ('dir/sub/b', b'b'),
+                            self._Link('dir/c', 'a', tarfile.SYMTYPE),
+                            self._Link('dir/d', 'dir/a', tarfile.LNKTYPE)])
+        result = gcs_archive.extract(self.archive,
+                                     self.staging,
+                                     hashes=('sha1', 'sha256'))
+        self.assertEqual(
+            {
+                'sha1': hashlib.sha1(data).hexdigest(),
+                'sha256': hashlib.sha256(data).hexdigest(),
+            }, result.digests)
+        self.assertEqual(len(data), result.size)
+        self.assertEqual(['dir', 'dir/a', 'dir/sub/b', 'dir/c', 'dir/d'],
+                         [tarinfo.name for tarinfo in result.members])
+        self.assertEqual(b'a' * 100000, self._Read('dir', 'a'))
+        self.assertEqual(b'b', self._Read('dir', 'sub', 'b'))
+        self.assertEqual(b'a' * 100000, self._Read('dir', 'd'))
+        if sys.platform != 'win32':
+            self.assertEqual(
+                'a', os.readlink(os.path.join(self.staging, 'dir', 'c')))
+            # Directory permissions are set last.
+            self.assertEqual(
+                0o555,
+                os.stat(os.path.join(self.staging, 'dir')).st_mode & 0o777)
+            os.chmod(os.path.join(self.staging, 'dir'), 0o755)
+
+    def testValidate(self):
+        self._Write([('dir/a', b'a'), ('other/b', b'b')])
+        with self.assertRaises(gcs_archive.InvalidMemberError) as e:
+            gcs_archive.extract(self.archive, self.staging,
+                                lambda tarinfo: tarinfo.name.startswith('dir'))
+        self.assertEqual('other/b', e.exception.name)
+
+    def testUnsafeMembers(self):
+        for entry in [('../a', b''), ('/a', b''), ('dir/../../a', b''),
+                      self._Link('dir/a', '../../b'),
+                      self._Link('a', '/etc/passwd'),
+                      self._Link('a', '../b', tarfile.LNKTYPE)]:
+            self._Write([entry])
+            with self.assertRaises(gcs_archive.InvalidMemberError):
+                gcs_archive.extract(self.archive, self.staging)
+        self._Write([('dir/..a', b'a'), self._Link('dir/b', '../c')])
+        gcs_archive.extract(self.archive, self.staging)
+
+    def testNotAnArchive(self):
+        with open(self.archive, 'wb') as f:
+            f.write(b'not an archive' * 100)
+        self.assertFalse(gcs_archive.is_archive(self.archive))
+        with self.assertRaises(tarfile.TarError):
+            gcs_archive.extract(self.archive, self.staging)
+
+    def testPigz(self):
+        data = self._Write([('a', b'a' * 100000)])
+        commands = []
+
+        def popen(command, **kwargs):
+            commands.append(command)
+            return subprocess.Popen([
+                sys.executable, '-c', 'import gzip, shutil, sys; '
+                'shutil.copyfileobj(gzip.open('
+                'sys.stdin.buffer), sys.stdout.buffer)'
+            ], **kwargs)
+
+        with mock.patch.dict('os.environ', {gcs_archive.PARALLEL_ENV_VAR:
+                                            '1'}), \
+                mock.patch('shutil.which', return_value='/bin/pigz'), \
+                mock.patch('subprocess2.Popen', side_effect=popen):
+            result = gcs_archive.extract(self.archive,
+                                         self.staging,
+                                         hashes=('sha256', ))
+        self.assertEqual([['pigz', '-dc']], commands)
+        self.assertEqual(
+            hashlib.sha256(data).hexdigest(), result.digests['sha256'])
+        self.assertEqual(b'a' * 100000, self._Read('a'))
+
+    @unittest.skipUnless(shutil.which('zstd'), 'zstd is not installed')
+    def testZstd(self):
+        tar = os.path.join(self.tmp, 'archive.tar')
+        self._Write([('dir/a', b'a')], 'w', tar)
+        subprocess.check_call(['zstd', '-q', tar, '-o', self.archive])
+        with open(self.archive, 'rb') as f:
+            data = f.read()
+        self.assertTrue(gcs_archive.is_archive(self.archive))
+        result = gcs_archive.extract(self.archive,
+                                     self.staging,
+                                     hashes=('sha256', ))
+        self.assertEqual(
+            hashlib.sha256(data).hexdigest(), result.digests['sha256'])
+        self.assertEqual(b'a', self._Read('dir', 'a'))
+
+    def testPublish(self):
+        output = os.path.join(self.tmp, 'output')
+        os.makedirs(os.path.join(output, 'dir', 'sub'))
+        gclient_utils.FileWrite(os.path.join(output, 'dir', 'kept'), 'kept')
+        gclient_utils.FileWrite(os.path.join(output, 'dir', 'a'), 'old')
+        gclient_utils.FileWrite(os.path.join(output, 'dir', 'sub', 'old'), '')
+        gclient_utils.FileWrite(os.path.join(output, 'file'), 'old')
+        self._Write([('dir/a', b'new'), ('dir/sub', b'file now'),
+                     ('file/b', b'b'), ('new/c', b'c')])
+        gcs_archive.extract(self.archive, self.staging)
+
+        gcs_archive.publish(self.staging, output)
+        self.assertFalse(os.path.exists(self.staging))
+        self.assertEqual(
+            'kept', gclient_utils.FileRead(os.path.join(output, 'dir', 'kept')))
+        self.assertEqual(
+            'new', gclient_utils.FileRead(os.path.join(output, 'dir', 'a')))
+        self.assertEqual(
+            'file now',
+            gclient_utils.FileRead(os.path.join(output, 'dir', 'sub')))
+        self.assertEqual(
+            'b', gclient_utils.FileRead(os.path.join(output, 'file', 'b')))
+        self.assertEqual(
+            'c', gclient_utils.FileRead(os.path.join(output, 'new', 'c')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env vpython3
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Unit tests for gcs_http.py."""
+
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gclient_utils
+import gcs_http
+from testing_support import fake_gcs_server
+
+
+class DownloaderTest(unittest.TestCase):
+    def setUp(self):
+        super(DownloaderTest, self).setUp()
+        self.server = fake_gcs_server.FakeGcsServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(gclient_utils.rmtree, self.tmp)
+        self.output = os.path.join(self.tmp, 'output')
+        self.data = random.Random(0).randbytes(10000)
+        self.server.add('bucket', 'dir/object', self.data)
+        mock.patch('gcs_http.RETRY_BASE_DELAY', 0).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _Downloader(self, **kwargs):
+        kwargs.setdefault('ranged_min_size', 4000)
+        kwargs.setdefault('chunk_size', 1000)
+        downloader = gcs_http.Downloader(self.server.url, **kwargs)
+        self.addCleanup(downloader.close)
+        return downloader
+
+    def _Download(self, downloader, name='dir/object'):
+        return downloader.download('gs://bucket/' + name, self.output,
+                                   ('sha1', 'sha256'))
+
+    def _Ranges(self):
+        return [r for method, _, r in self.server.requests if method == 'GET']
+
+    def assertDownloaded(self, result):
+        with open(self.output, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual(
+            {
+                'sha1': hashlib.sha1(self.data).hexdigest(),
+                'sha256': hashlib.sha256(self.data).hexdigest(),
+            }, result.digests)
+        self.assertEqual(len(self.data), result.size)
+        self.assertEqual(['output'], os.listdir(self.tmp))
+
+    def testSingleStream(self):
+        result = self._Download(self._Downloader(ranged_min_size=20000))
+        self.assertDownloaded(result)
+        self.assertFalse(result.executable)
+        self.assertEqual(['bytes=0-9999'], self._Ranges())
+
+    def testRangedGets(self):
+        self.assertDownloaded(self._Download(self._Downloader(jobs=3)))
+        self.assertEqual(
+            sorted('bytes=%d-%d' % (i, i + 999) for i in range(0, 10000, 1000)),
+            sorted(self._Ranges()))
+        # Connections are kept alive and shared.
+        self.assertLessEqual(self.server.connections, 4)
+
+    def testReusesConnections(self):
+        downloader = self._Downloader(ranged_min_size=20000)
+        for _ in range(3):
+            self.assertDownloaded(self._Download(downloader))
+        self.assertEqual(1, self.server.connections)
+
+    def testRetriesFromTheFirstMissingByte(self):
+        self.server.fail('bucket', 'dir/object', None, 2500, -503)
+        self.assertDownloaded(
+            self._Download(self._Downloader(ranged_min_size=20000)))
+        self.assertEqual(['bytes=0-9999', 'bytes=2500-9999', 'bytes=2500-9999'],
+                         self._Ranges())
+
+    def testRetriesRangedGets(self):
+        self.server.fail('bucket', 'dir/object', None, 500, -500, 10)
+        self.assertDownloaded(self._Download(self._Downloader(jobs=2)))
+
+    def testResumesPartialDownload(self):
+        downloader = self._Downloader(ranged_min_size=20000)
+        etag = downloader.stat('gs://bucket/dir/object').etag
+        with open(self.output + '.partial', 'wb') as f:
+            f.write(self.data[:6000])
+        with open(self.output + '.partial.json', 'w') as f:
+            json.dump({'etag': etag, 'size': len(self.data)}, f)
+        self.assertDownloaded(self._Download(downloader))
+        self.assertEqual(['bytes=6000-9999'], self._Ranges())
+
+    def testRestartsPartialDownloadOfAnotherObject(self):
+        with open(self.output + '.partial', 'wb') as f:
+            f.write(b'x' * 6000)
+        with open(self.output + '.partial.json', 'w') as f:
+            json.dump({'etag': '"old"', 'size': len(self.data)}, f)
+        self.assertDownloaded(
+            self._Download(self._Downloader(ranged_min_size=20000)))
+        self.assertEqual(['bytes=0-9999'], self._Ranges())
+
+    def testDiscardPartial(self):
+        downloader = self._Downloader()
+        with open(self.output + '.partial', 'wb') as f:
+            f.write(self.data[:6000])
+        with open(self.output + '.partial.json', 'w') as f:
+            json.dump({'etag': '"etag"', 'size': len(self.data)}, f)
+        downloader.discard_partial(self.output)
+        self.assertEqual([], os.listdir(self.tmp))
+        downloader.discard_partial(self.output)
+
+    def testObjectChangedDuringDownload(self):
+        downloader = self._Downloader(ranged_min_size=20000)
+        self.server.fail('bucket', 'dir/object', None, 100)
+        real_fetch = downloader._Fetch
+
+        def fetch(*args):
+            # Replace the object after its size was read.
+            self.server.add('bucket', 'dir/object', b'new')
+            return real_fetch(*args)
+
+        with mock.patch.object(downloader, '_Fetch', side_effect=fetch):
+            with self.assertRaises(gcs_http.HttpError) as e:
+                self._Download(downloader)
+        self.assertEqual(412, e.exception.status)
+        self.assertEqual([], os.listdir(self.tmp))
+
+    def testNotFound(self):
+        with self.assertRaises(gcs_http.HttpError) as e:
+            self._Download(self._Downloader(), 'missing')
+        self.assertEqual(404, e.exception.status)
+
+    def testToken(self):
+        self.server.token = 'secret'
+        with self.assertRaises(gcs_http.HttpError) as e:
+            self._Download(self._Downloader())
+        self.assertEqual(401, e.exception.status)
+        self.assertDownloaded(
+            self._Download(self._Downloader(token=lambda: 'secret')))
+
+    def testExecutableAndEmptyObjects(self):
+        self.data = b''
+        self.server.add('bucket', 'empty', b'', executable=True)
+        result = self._Download(self._Downloader(), 'empty')
+        self.assertDownloaded(result)
+        self.assertTrue(result.executable)
+
+    def testGetDownloader(self):
+        with mock.patch.dict('os.environ', {gcs_http.ENABLE_ENV_VAR: '0'}):
+            self.assertIsNone(gcs_http.GetDownloader())
+        with mock.patch.dict('os.environ', {gcs_http.ENABLE_ENV_VAR: '1'}):
+            self.assertIs(gcs_http.GetDownloader(), gcs_http.GetDownloader())
+
+
+if __name__ == '__main__':
+    unittest.main()
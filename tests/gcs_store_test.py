@@ -0,0 +1,137 @@
+#!/usr/bin/env vpython3
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Unit tests for gcs_store.py."""
+
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gclient_utils
+import gcs_store
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        super(StoreTest, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(gclient_utils.rmtree, self.tmp)
+        self.store = gcs_store.Store(os.path.join(self.tmp, 'store'), 10)
+        os.mkdir(self.store.path)
+
+    def _File(self, name, contents):
+        path = os.path.join(self.tmp, name)
+        gclient_utils.FileWrite(path, contents)
+        return path
+
+    def _Stored(self):
+        return sorted(
+            os.path.basename(path) for _, _, path in self.store._Objects())
+
+    def testMaterialize(self):
+        self.store.add('sha1', 'abcd', self._File('a', 'aaa'))
+        output = os.path.join(self.tmp, 'output')
+        self.assertFalse(self.store.materialize('sha1', 'dcba', output))
+        self.assertFalse(self.store.materialize('sha256', 'abcd', output))
+        self.assertFalse(self.store.materialize('sha1', 'abcd', output, 4))
+        self.assertFalse(os.path.exists(output))
+
+        gclient_utils.FileWrite(output, 'old')
+        self.assertTrue(self.store.materialize('sha1', 'abcd', output, 3))
+        self.assertEqual('aaa', gclient_utils.FileRead(output))
+        self.assertEqual(
+            os.stat(output).st_ino,
+            os.stat(os.path.join(self.store.path, 'sha1', 'ab', 'abcd')).st_ino)
+
+    def testCopiesIfLinksAreNotSupported(self):
+        output = os.path.join(self.tmp, 'output')
+        with mock.patch('os.link', side_effect=OSError('cross-device')), \
+                mock.patch('gcs_store._Reflink', side_effect=OSError):
+            self.store.add('sha1', 'abcd', self._File('a', 'aaa'))
+            self.assertTrue(self.store.materialize('sha1', 'abcd', output))
+        self.assertEqual('aaa', gclient_utils.FileRead(output))
+        self.assertNotEqual(
+            os.stat(output).st_ino,
+            os.stat(os.path.join(self.store.path, 'sha1', 'ab', 'abcd')).st_ino)
+
+    def testEvictsLeastRecentlyUsed(self):
+        for i, digest in enumerate(['aa', 'bb', 'cc']):
+            self.store.add('sha256', digest, self._File(digest, 'xxxx'))
+            path = os.path.join(self.store.path, 'sha256', digest, digest)
+            os.utime(path + '.used', (i, i))
+        self.assertEqual(['bb', 'cc'], self._Stored())
+        self.assertEqual([],
+                         os.listdir(
+                             os.path.join(self.store.path, 'sha256', 'aa')))
+
+        # Using cc makes bb the least recently used.
+        os.utime(os.path.join(self.store.path, 'sha256', 'cc', 'cc.used'),
+                 (0, 0))
+        self.store.materialize('sha256', 'cc', os.path.join(self.tmp, 'out'))
+        self.store.add('sha256', 'dd', self._File('dd', 'xxxx'))
+        self.assertEqual(['cc', 'dd'], self._Stored())
+
+    def testMaterializeKeepsSharedMtime(self):
+        # Checkout A adds an object, then checkout B uses it.
+        a = self._File('a', 'aaa')
+        os.utime(a, (1000, 1000))
+        self.store.add('sha1', 'abcd', a)
+        b = os.path.join(self.tmp, 'b')
+        self.assertTrue(self.store.materialize('sha1', 'abcd', b))
+        self.store.add('sha1', 'abcd', b)
+        self.assertEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+        self.assertEqual(1000, os.stat(a).st_mtime)
+
+    def testHashesChangedObjects(self):
+        digest = hashlib.sha1(b'aaa').hexdigest()
+        a = self._File('a', 'aaa')
+        self.store.add('sha1', digest, a)
+        b = os.path.join(self.tmp, 'b')
+        with mock.patch('gcs_store._Hash', wraps=gcs_store._Hash) as h:
+            self.assertTrue(self.store.materialize('sha1', digest, b))
+            h.assert_not_called()
+
+            # Checkout a modifies its file in place, which is the stored
+            # object.
+            with open(a, 'w') as f:
+                f.write('bbb')
+            os.utime(a, ns=(0, 0))
+            c = os.path.join(self.tmp, 'c')
+            self.assertFalse(self.store.materialize('sha1', digest, c))
+            h.assert_called_once()
+        self.assertFalse(os.path.exists(c))
+        self.assertEqual([], self._Stored())
+        self.assertEqual([],
+                         os.listdir(
+                             os.path.join(self.store.path, 'sha1', digest[:2])))
+
+    def testParseSize(self):
+        self.assertEqual(12, gcs_store.ParseSize('12'))
+        self.assertEqual(3 * 1024**3, gcs_store.ParseSize('3G'))
+        self.assertEqual(5 * 1024**2, gcs_store.ParseSize('5mb'))
+        with self.assertRaises(ValueError):
+            gcs_store.ParseSize('many')
+
+    def testGetStore(self):
+        with mock.patch.dict('os.environ', {gcs_store.STORE_ENV_VAR: ''}):
+            self.assertIsNone(gcs_store.GetStore())
+        path = os.path.join(self.tmp, 'default')
+        with mock.patch.dict('os.environ', {
+                gcs_store.STORE_ENV_VAR: path,
+                gcs_store.MAX_SIZE_ENV_VAR: '1K'
+        }):
+            store = gcs_store.GetStore()
+            self.assertIs(store, gcs_store.GetStore())
+        self.assertEqual(path, store.path)
+        self.assertEqual(1024, store.max_size)
+        self.assertTrue(os.path.isdir(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
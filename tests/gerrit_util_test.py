@@ -5,12 +5,14 @@
 # found in the LICENSE file.
 
 from typing import Optional
+import http.server
 import httplib2
 from io import StringIO
 import json
 import os
 import socket
 import sys
+import threading
 import unittest
 from unittest import mock
 
@@ -300,6 +302,7 @@ class GerritUtilTest(unittest.TestCase):
         mock.patch('metrics.collector').start()
         mock.patch('metrics_utils.extract_http_metrics',
                    return_value='http_metrics').start()
+        mock.patch('gerrit_util._authenticator', None).start()
         self.addCleanup(mock.patch.stopall)
 
     def testQueryString(self):
@@ -376,6 +379,49 @@ class GerritUtilTest(unittest.TestCase):
                 'body': '{"d": {"k": "v"}, "l": [1, 2, 3]}',
             }, conn.req_params)
 
+    @mock.patch('gerrit_util.Authenticator.get')
+    def testCreateHttpConn_CachesAuthenticator(self, mockAuth):
+        mockAuth.return_value = mock.Mock(spec=gerrit_util.Authenticator)
+
+        gerrit_util.CreateHttpConn('host.example.com', 'foo')
+        gerrit_util.CreateHttpConn('other.example.com', 'bar')
+        mockAuth.assert_called_once_with()
+        self.assertEqual(2, mockAuth.return_value.authenticate.call_count)
+
+    @mock.patch('gerrit_util.GERRIT_PROTOCOL', 'http')
+    @mock.patch('gerrit_util._connection_pool', gerrit_util._ConnectionPool())
+    @mock.patch('gerrit_util.Authenticator.get')
+    def testReadHttpResponse_ReusesConnections(self, mockAuth):
+        mockAuth.return_value = mock.Mock(spec=gerrit_util.Authenticator)
+        clients = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                clients.append(self.client_address)
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *_args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.addCleanup(server.server_close)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+
+        host = '127.0.0.1:%d' % server.server_address[1]
+        for _ in range(3):
+            conn = gerrit_util.CreateHttpConn(host, 'foo', timeout=30)
+            self.assertEqual('ok', gerrit_util.ReadHttpResponse(conn).read())
+        self.assertEqual(3, len(clients))
+        self.assertEqual(1, len(set(clients)))
+        gerrit_util._connection_pool._close(
+            gerrit_util._connection_pool._idle[(host, 30)][0])
+
     def testReadHttpResponse_200(self):
         conn = mock.Mock()
         conn.req_params = {'uri': 'uri', 'method': 'method'}
@@ -19,6 +19,7 @@ sys.path.insert(0, DEPOT_TOOLS_ROOT)
 
 from testing_support import coverage_utils
 import git_cache
+import lockfile
 
 
 class GitCacheTest(unittest.TestCase):
@@ -223,6 +224,340 @@ class GitCacheTest(unittest.TestCase):
         mirror = git_cache.Mirror(self.origin_dir)
         mirror.populate(reset_fetch_config=True)
 
+    def _commit(self, name):
+        with open(os.path.join(self.origin_dir, name), 'w') as f:
+            f.write('%s\n' % name)
+        self.git(['add', name])
+        self.git([
+            '-c', 'user.name=Test user', '-c', 'user.email=joj@test.com',
+            'commit', '-m', name
+        ])
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=self.origin_dir).decode().strip()
+
+    def _fetches(self, run_git):
+        return [
+            args[0] for args, _ in run_git.call_args_list
+            if args[0][0] == 'fetch'
+        ]
+
+    @mock.patch('sys.stdout', StringIO())
+    def testPopulateFetchesSpecsAtOnce(self):
+        self.git(['init', '-q'])
+        self.git(['config', 'uploadpack.allowAnySHA1InWant', 'true'])
+        self._commit('foo')
+        self.git(['update-ref', 'refs/foo/bar', 'HEAD'])
+        self.git(['checkout', '-q', '-b', 'tmp'])
+        commit = self._commit('bar')
+        self.git(['checkout', '-q', '-'])
+        self.git(['branch', '-q', '-D', 'tmp'])
+
+        mirror = git_cache.Mirror(self.origin_dir,
+                                  refs=['refs/foo/*'],
+                                  commits=[commit])
+        with mock.patch.object(mirror, 'RunGit',
+                               wraps=mirror.RunGit) as run_git:
+            mirror.populate()
+        self.assertEqual([[
+            'fetch', '--prune', '--refmap=', 'origin',
+            '+refs/heads/*:refs/git-cache/staging/refs/heads/*',
+            '+refs/foo/*:refs/git-cache/staging/refs/foo/*', commit
+        ]], self._fetches(run_git))
+        self.assertTrue(mirror.contains_revision(commit))
+
+    @mock.patch('sys.stdout', StringIO())
+    def testPopulatePublishesRefsAtOnce(self):
+        self.git(['init', '-q', '-b', 'main'])
+        old_head = self._commit('foo')
+        self.git(['update-ref', 'refs/foo/bar', 'HEAD'])
+        self.git(['update-ref', 'refs/foo/baz', 'HEAD'])
+
+        mirror = git_cache.Mirror(self.origin_dir, refs=['refs/foo/*'])
+        mirror.populate()
+        self.git(['update-ref', '-d', 'refs/foo/baz'])
+        head = self._commit('bar')
+        with mock.patch('subprocess.run', wraps=subprocess.run) as run:
+            mirror.populate()
+        self.assertEqual(
+            1,
+            len([
+                args for args, _ in run.call_args_list
+                if 'update-ref' in args[0]
+            ]))
+
+        refs = subprocess.check_output([
+            'git', '--git-dir', mirror.mirror_path, 'for-each-ref',
+            '--format=%(objectname) %(refname)', 'refs/heads', 'refs/foo'
+        ]).decode().splitlines()
+        self.assertEqual(
+            ['%s refs/foo/bar' % old_head,
+             '%s refs/heads/main' % head], refs)
+        # Clones of the mirror don't see the staging refs.
+        remote_refs = subprocess.check_output(
+            ['git', 'ls-remote', mirror.mirror_path]).decode()
+        self.assertIn('refs/foo/bar', remote_refs)
+        self.assertNotIn(git_cache.STAGING_REFS, remote_refs)
+
+    @mock.patch('sys.stdout', StringIO())
+    def testReadersWaitForReplacement(self):
+        self.git(['init', '-q'])
+        commit = self._commit('foo')
+        mirror = git_cache.Mirror(self.origin_dir)
+        mirror.populate()
+        with mock.patch('git_cache.READERS_LOCK_TIMEOUT', 0):
+            with mirror.read_lock(), mirror.read_lock():
+                self.assertTrue(mirror.contains_revision(commit))
+                with self.assertRaises(lockfile.LockError):
+                    with mirror._replace_lock():
+                        pass
+            with mirror._replace_lock():
+                with self.assertRaises(lockfile.LockError):
+                    mirror.contains_revision(commit)
+
+    @mock.patch('time.sleep')
+    @mock.patch('sys.stdout', StringIO())
+    def testPopulateIsolatesFailedSpecs(self, _):
+        self.git(['init', '-q'])
+        self._commit('foo')
+
+        mirror = git_cache.Mirror(self.origin_dir, refs=['missing'])
+        with mock.patch.object(mirror, 'RunGit',
+                               wraps=mirror.RunGit) as run_git:
+            mirror.populate()
+        self.assertEqual(3, len(self._fetches(run_git)))
+        self.assertNotIn(git_cache.GIT_CACHE_CORRUPT_MESSAGE,
+                         sys.stdout.getvalue())
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(mirror.mirror_path, 'refs', 'heads', 'main'))
+            or os.path.exists(
+                os.path.join(mirror.mirror_path, 'refs', 'heads', 'master')))
+
+    @mock.patch('sys.stdout', StringIO())
+    def testPopulatePartial(self):
+        self.git(['init', '-q'])
+        self.git(['config', 'uploadpack.allowFilter', 'true'])
+        self._commit('foo')
+
+        mirror = git_cache.Mirror(self.origin_dir, filter_spec='blob:none')
+        mirror.populate()
+        missing = subprocess.check_output([
+            'git', '--git-dir', mirror.mirror_path, 'rev-list', '--objects',
+            '--missing=print', '--all'
+        ]).decode()
+        self.assertEqual(1, missing.count('?'))
+
+        # The mirror stays partial.
+        mirror = git_cache.Mirror(self.origin_dir)
+        mirror.populate()
+        self.assertEqual('blob:none', mirror.filter_spec)
+        with self.assertRaises(RuntimeError):
+            mirror.update_bootstrap()
+
+
+class MaintenanceTest(unittest.TestCase):
+    git = GitCacheTest.git
+    _commit = GitCacheTest._commit
+
+    def setUp(self):
+        GitCacheTest.setUp(self)
+        mock.patch('sys.stdout', StringIO()).start()
+        self.git(['init', '-q'])
+        self._commit('foo')
+        self.mirror = git_cache.Mirror(self.origin_dir)
+        self.mirror.populate()
+        # Keep each fetch in its own pack.
+        self.mirror.RunGit(['config', 'fetch.unpackLimit', '1'])
+        for name in ['bar', 'baz', 'qux']:
+            self._commit(name)
+            self.mirror.populate()
+
+    def _PackFiles(self):
+        return os.listdir(self.mirror._pack_dir)
+
+    def testMaintain(self):
+        packs = [name for name in self._PackFiles() if name.endswith('.pack')]
+        self.assertEqual(3, len(packs))
+        largest = max(packs,
+                      key=lambda name: os.path.getsize(
+                          os.path.join(self.mirror._pack_dir, name)))
+        keep_size = os.path.getsize(os.path.join(self.mirror._pack_dir,
+                                                 largest))
+
+        self.mirror.maintain(keep_size)
+        files = self._PackFiles()
+        self.assertIn(largest, files)
+        self.assertIn(largest[:-len('.pack')] + '.keep', files)
+        self.assertIn('multi-pack-index', files)
+        self.assertEqual(2, len([f for f in files if f.endswith('.pack')]))
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(self.mirror.mirror_path, 'objects', 'info',
+                             'commit-graphs', 'commit-graph-chain')))
+        self.mirror.RunGit(['fsck', '--connectivity-only'])
+
+    def testSkipsLockedMirrors(self):
+        with lockfile.lock(self.mirror.mirror_path):
+            with self.assertRaises(lockfile.LockError):
+                self.mirror.maintain()
+            self.assertEqual(
+                0, git_cache.main(['maintenance', '--all', '--timeout', '0']))
+        self.assertNotIn('multi-pack-index', self._PackFiles())
+        self.assertEqual(0, git_cache.main(['maintenance', '--all']))
+        self.assertIn('multi-pack-index', self._PackFiles())
+
+
+class FakeGsutil(object):
+    """Serves gs://bucket/... from a local directory."""
+    def __init__(self, root):
+        self.root = root
+        self.copied = []
+
+    def _path(self, url):
+        assert url.startswith('gs://bucket/'), url
+        return os.path.join(self.root, *url[len('gs://bucket/'):].split('/'))
+
+    def check_call(self, command, url):
+        path = self._path(url)
+        if command == 'ls' and os.path.isdir(path):
+            return 0, ''.join(
+                '%s/%s%s\n' %
+                (url, name,
+                 '/' if os.path.isdir(os.path.join(path, name)) else '')
+                for name in os.listdir(path)), ''
+        if command == 'cat' and os.path.isfile(path):
+            with open(path) as f:
+                return 0, f.read(), ''
+        return 404, '', 'No URLs matched'
+
+    def call(self, *args):
+        assert args[:2] == ('-m', 'cp'), args
+        for url in args[2:-1]:
+            self.copied.append(url.rsplit('/', 1)[1])
+            shutil.copy(self._path(url), args[-1])
+        return 0
+
+
+class BootstrapTest(unittest.TestCase):
+    git = GitCacheTest.git
+    _commit = GitCacheTest._commit
+
+    def setUp(self):
+        GitCacheTest.setUp(self)
+        self.bucket = tempfile.mkdtemp(prefix='git_cache_bucket_')
+        self.addCleanup(shutil.rmtree, self.bucket, ignore_errors=True)
+        self.gsutil = FakeGsutil(self.bucket)
+        mock.patch('git_cache.Gsutil', return_value=self.gsutil).start()
+        mock.patch.dict('os.environ', {
+            'OVERRIDE_BOOTSTRAP_BUCKET': 'bucket'
+        }).start()
+        mock.patch('sys.stdout', StringIO()).start()
+        self.git(['init', '-q'])
+        self.git(['config', 'uploadpack.allowAnySHA1InWant', 'true'])
+        self._commit('foo')
+        self.mirror = git_cache.Mirror(self.origin_dir)
+        self.mirror.populate()
+
+    def _Upload(self, gen_number):
+        """Uploads self.mirror like update_bootstrap."""
+        self.mirror._repack_for_bootstrap()
+        dest = os.path.join(self.bucket, 'v2', self.mirror.basedir)
+        shutil.copytree(self.mirror.mirror_path,
+                        os.path.join(dest, str(gen_number)))
+        open(os.path.join(dest, '%d.ready' % gen_number), 'w').close()
+        return self.mirror._read_bootstrap_manifest()
+
+    def _Packs(self, mirror):
+        return sorted(name for name in os.listdir(mirror._pack_dir)
+                      if name.endswith('.pack'))
+
+    def _Client(self):
+        """Returns a mirror bootstrapped from the latest bootstrap."""
+        cache_dir = tempfile.mkdtemp(prefix='git_cache_client_')
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        git_cache.Mirror.SetCachePath(cache_dir)
+        self.addCleanup(git_cache.Mirror.SetCachePath, self.cache_dir)
+        client = git_cache.Mirror(self.origin_dir)
+        shutil.copytree(
+            self.gsutil._path(
+                client._GetMostRecentCacheDirectory(
+                    set(
+                        self.gsutil.check_call('ls',
+                                               client._gs_path)[1].split()))),
+            client.mirror_path)
+        return client
+
+    def testUploadsIncrementalPacks(self):
+        first = self._Upload(1)
+        self.assertEqual(1, len(self._Packs(self.mirror)))
+        self._commit('bar')
+        self.mirror.populate()
+        second = self._Upload(2)
+        self.assertEqual(2, len(self._Packs(self.mirror)))
+        for name, entry in first['files'].items():
+            self.assertEqual(entry, second['files'][name])
+        for name, entry in second['files'].items():
+            self.assertEqual(
+                entry['sha256'],
+                git_cache._FileSha256(os.path.join(self.mirror._pack_dir,
+                                                   name)))
+
+        # Everything is repacked once there would be too many packs.
+        self._commit('baz')
+        self.mirror.populate()
+        with mock.patch('git_cache.MAX_BOOTSTRAP_PACKS', 2):
+            self._Upload(3)
+        self.assertEqual(1, len(self._Packs(self.mirror)))
+
+    def testBootstrapIncrementally(self):
+        first = self._Upload(1)
+        client = self._Client()
+        self._commit('bar')
+        self.mirror.populate()
+        second = self._Upload(2)
+        head = self._commit('baz')
+        client.populate()
+        self.assertTrue(client.bootstrap_incrementally())
+
+        self.assertEqual(sorted(set(second['files']) - set(first['files'])),
+                         sorted(self.gsutil.copied))
+        self.assertEqual(second, client._read_bootstrap_manifest())
+        packs = self._Packs(client)
+        self.assertEqual(3, len(packs))
+        for name in second['files']:
+            if name.endswith('.pack'):
+                self.assertIn(name, packs)
+        client.RunGit(['fsck', '--connectivity-only'])
+        self.assertTrue(client.contains_revision(head))
+
+    def testBootstrapIncrementallyChecksPacks(self):
+        self._Upload(1)
+        client = self._Client()
+        self._commit('bar')
+        self.mirror.populate()
+        second = self._Upload(2)
+        new_pack = [
+            name for name in second['files'] if name.endswith('.pack')
+            and name not in os.listdir(client._pack_dir)
+        ][0]
+        with open(
+                os.path.join(self.bucket, 'v2', self.mirror.basedir, '2',
+                             'objects', 'pack', new_pack), 'ab') as f:
+            f.write(b'corrupt')
+        packs = self._Packs(client)
+        self.assertFalse(client.bootstrap_incrementally())
+        self.assertEqual(packs, self._Packs(client))
+
+    def testNothingInCommon(self):
+        self._Upload(1)
+        client = self._Client()
+        self._commit('bar')
+        self.mirror.populate()
+        with mock.patch('git_cache.MAX_BOOTSTRAP_PACKS', 1):
+            self._Upload(2)
+        self.assertFalse(client.bootstrap_incrementally())
+        self.assertEqual([], self.gsutil.copied)
+
 
 class GitCacheDirTest(unittest.TestCase):
     def setUp(self):
@@ -3598,6 +3598,8 @@ class ChangelistTest(unittest.TestCase):
         mock.patch('git_cl.PRESUBMIT_SUPPORT', 'PRESUBMIT_SUPPORT').start()
         mock.patch('git_cl.Settings.GetRoot', return_value='root').start()
         mock.patch('git_cl.Settings.GetIsGerrit', return_value=True).start()
+        mock.patch('git_cl.Settings.GetUsePresubmitCache',
+                   return_value=False).start()
         mock.patch('git_cl.time_time').start()
         mock.patch('metrics.collector').start()
         mock.patch('subprocess2.Popen').start()
@@ -3729,6 +3731,38 @@ class ChangelistTest(unittest.TestCase):
             'exit_code': 0,
         })
 
+    def _RunHookArgs(self, committing):
+        gclient_utils.FileRead.return_value = json.dumps({
+            'more_cc': [],
+            'errors': [],
+            'notifications': [],
+            'warnings': [],
+        })
+        git_cl.time_time.side_effect = [100, 200, 300, 400]
+        subprocess2.Popen.return_value.wait.return_value = 0
+
+        git_cl.Changelist().RunHook(committing=committing,
+                                    may_prompt=False,
+                                    verbose=0,
+                                    parallel=False,
+                                    upstream='upstream',
+                                    description='description',
+                                    all_files=False,
+                                    resultdb=False)
+        return subprocess2.Popen.call_args[0][0]
+
+    def testRunHook_UseCache(self):
+        git_cl.Settings.GetUsePresubmitCache.return_value = True
+        args = self._RunHookArgs(committing=False)
+        self.assertIn('--use_cache', args)
+        self.assertIn('--upload', args)
+
+    def testRunHook_UseCacheCommitting(self):
+        git_cl.Settings.GetUsePresubmitCache.return_value = True
+        args = self._RunHookArgs(committing=True)
+        self.assertNotIn('--use_cache', args)
+        self.assertIn('--commit', args)
+
     def testRunHook_FewerOptionsResultDB(self):
         expected_results = {
             'more_cc': ['cc@example.com', 'more@example.com'],
@@ -233,6 +233,46 @@ class GitReadOnlyFunctionsTest(git_test_utils.GitRepoReadOnlyTestBase,
         self.assertTrue(self.repo['D'].startswith(
             self.repo.run(self.gc.hash_one, 'branch_D', short=True)))
 
+    def testCatFileBatch(self):
+        batch = self.gc.CatFileBatch.for_repo(self.repo.repo_path)
+        self.assertIs(batch, self.gc.CatFileBatch.for_repo(self.repo.repo_path))
+        self.assertEqual((self.repo['D'], 'commit'), batch.info('branch_D')[:2])
+        data = self.COMMIT_D['some/files/file2']['data']
+        self.assertEqual((git_test_utils.git_hash_data(data), 'blob', data),
+                         batch.contents('main:some/files/file2'))
+        self.assertIsNone(batch.info('main:wat'))
+        self.assertIsNone(batch.contents('not_a_branch'))
+
+        # The co-process is restarted after being closed.
+        batch.close()
+        self.assertEqual(self.repo['D'], batch.info('main')[0])
+
+        self.assertRaises(self.gc.subprocess2.CalledProcessError, self.repo.run,
+                          self.gc.hash_one, 'not_a_branch')
+
+    def testCatFileBatchEvictsLeastRecentlyUsed(self):
+        self.gc.CatFileBatch.close_all()
+        self.addCleanup(self.gc.CatFileBatch.close_all)
+        batch = self.gc.CatFileBatch.for_repo(self.repo.repo_path)
+        self.assertEqual(self.repo['D'], batch.info('main')[0])
+        other = os.path.join(self.repo.repo_path, 'a')
+        with mock.patch.object(self.gc.CatFileBatch, 'MAX_INSTANCES', 2):
+            self.gc.CatFileBatch.for_repo(other)
+            # Using the instance makes |other| the least recently used.
+            self.assertIs(batch,
+                          self.gc.CatFileBatch.for_repo(self.repo.repo_path))
+            self.gc.CatFileBatch.for_repo(os.path.join(other, 'b'))
+            self.assertEqual(2, len(self.gc.CatFileBatch._INSTANCES))
+            self.assertEqual(self.repo['D'], batch.info('main')[0])
+
+            self.gc.CatFileBatch.for_repo(os.path.join(other, 'c'))
+        # The evicted instance stopped its co-processes and can't be used
+        # anymore.
+        self.assertEqual({}, batch._procs)
+        self.assertIsNone(batch.info('main'))
+        self.assertIsNot(batch,
+                         self.gc.CatFileBatch.for_repo(self.repo.repo_path))
+
     def testStream(self):
         items = set(self.repo.commit_map.values())
 
@@ -40,6 +40,18 @@ class LockTest(unittest.TestCase):
         with lockfile.lock(self.cache_dir):
             pass
 
+    def testSharedLock(self):
+        with lockfile.lock(self.cache_dir, shared=True):
+            with lockfile.lock(self.cache_dir, shared=True):
+                with self.assertRaises(lockfile.LockError):
+                    with lockfile.lock(self.cache_dir):
+                        pass
+
+        with lockfile.lock(self.cache_dir):
+            with self.assertRaises(lockfile.LockError):
+                with lockfile.lock(self.cache_dir, shared=True):
+                    pass
+
     @mock.patch('time.sleep')
     def testLockConcurrent(self, sleep_mock):
         '''testLockConcurrent simulates what happens when two separate processes try
@@ -3,6 +3,7 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import io
 import os.path
 import sys
 import unittest
@@ -266,6 +267,87 @@ diff --git a/ffoo b/foo
         with self.assertRaises(presubmit_support.PresubmitFailure):
             presubmit_support._parse_unified_diff(diff)
 
+    def test_spooled_diff_matches_parse_unified_diff(self):
+        diff = """
+diff --git foo foo
+index 0000000..9daeafb 100644
+--- foo
++++ foo
+@@ -1 +1 @@
+-old
++new
+diff --git dir/bar baz dir/bar baz
+new file mode 100644
+index 0000000..9daeafb
+--- dir/bar baz
++++ dir/bar baz
+@@ -0,0 +1 @@
++add
+"""
+        spooled = presubmit_support._SpooledDiff(
+            io.BytesIO(diff.encode('utf-8')).readlines())
+        self.addCleanup(spooled.close)
+        expected = presubmit_support._parse_unified_diff(diff)
+        self.assertEqual(['dir/bar baz', 'foo'], sorted(expected))
+        for path, file_diff in expected.items():
+            self.assertEqual(file_diff, spooled.get(path))
+        self.assertEqual('', spooled.get('missing'))
+
+    @mock.patch('presubmit_support._SpooledDiff.MAX_IN_MEMORY_SIZE', 64)
+    def test_spooled_diff_spills_to_disk(self):
+        lines = [b'diff --git foo foo\n'] + [b'+%d\n' % i for i in range(100)]
+        spooled = presubmit_support._SpooledDiff(iter(lines))
+        self.addCleanup(spooled.close)
+        self.assertTrue(spooled._file._rolled)
+        self.assertEqual(b''.join(lines).decode('utf-8'), spooled.get('foo'))
+
+    def test_spooled_diff_with_invalid_diff(self):
+        with self.assertRaises(presubmit_support.PresubmitFailure):
+            presubmit_support._SpooledDiff([b'diff --git a/ffoo b/foo\n'])
+
+    @mock.patch('scm.GIT.GenerateDiffStream')
+    def test_git_diff_cache_close(self, stream):
+        stream.return_value.__enter__.return_value = iter(
+            [b'diff --git foo foo\n', b'+new\n'])
+        cache = presubmit_support._GitDiffCache('upstream')
+        self.assertEqual('diff --git foo foo\n+new\n',
+                         cache.GetDiff('foo', 'root'))
+        spooled = cache._diffs_by_file
+        cache.Close()
+        self.assertTrue(spooled._file.closed)
+        self.assertIsNone(cache._diffs_by_file)
+        cache.Close()
+
+
+class PresubmitResultCacheTest(unittest.TestCase):
+    def test_results_are_saved(self):
+        with gclient_utils.temporary_directory() as tmp:
+            path = os.path.join(tmp, 'cache.json')
+            cache = presubmit_support.PresubmitResultCache(path)
+            self.assertIsNone(cache.Get('key'))
+            cache.Set('key', [
+                presubmit_support.OutputApi.PresubmitPromptWarning(
+                    'warning', ['item']),
+                presubmit_support.OutputApi.PresubmitNotifyResult('notify'),
+            ], ['cc@example.com'])
+            cache.Set('error',
+                      [presubmit_support.OutputApi.PresubmitError('error')], [])
+            cache.Save()
+
+            cache = presubmit_support.PresubmitResultCache(path)
+            self.assertIsNone(cache.Get('error'))
+            results, more_cc = cache.Get('key')
+            self.assertEqual(['cc@example.com'], more_cc)
+            self.assertEqual([(True, 'warning', ['item']),
+                              (False, 'notify', [])],
+                             [(r.should_prompt, r._message, r._items)
+                              for r in results])
+
+    def test_key(self):
+        key = presubmit_support.PresubmitResultCache.Key
+        self.assertEqual(key('a', 'b'), key('a', 'b'))
+        self.assertNotEqual(key('a', 'b'), key('ab', ''))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -6,6 +6,7 @@
 
 # pylint: disable=no-member,E1103
 
+import contextlib
 import functools
 import io
 import itertools
@@ -194,6 +195,8 @@ index fe3de7b..54ae6e1 100755
         mock.patch('presubmit_support.warn').start()
         mock.patch('random.randint').start()
         mock.patch('scm.GIT.GenerateDiff').start()
+        mock.patch('scm.GIT.GenerateDiffStream',
+                   side_effect=self._GenerateDiffStream).start()
         mock.patch('scm.determine_scm').start()
         mock.patch('subprocess2.Popen').start()
         mock.patch('sys.stderr', StringIO()).start()
@@ -203,6 +206,12 @@ index fe3de7b..54ae6e1 100755
         mock.patch('urllib.request.urlopen').start()
         self.addCleanup(mock.patch.stopall)
 
+    @staticmethod
+    def _GenerateDiffStream(*args, **kwargs):
+        diff = scm.GIT.GenerateDiff(*args, **kwargs)
+        return contextlib.nullcontext(
+            io.BytesIO(diff.encode('utf-8')).readlines())
+
     def checkstdout(self, value):
         self.assertEqual(sys.stdout.getvalue(), value)
 
@@ -527,6 +536,97 @@ class PresubmitUnittest(PresubmitTestsBase):
         sink.report.assert_called_with('CheckChangeOnCommit',
                                        rdb_wrapper.STATUS_FAIL, 0, "error\n")
 
+    @mock.patch('presubmit_support._FileHash')
+    def testExecPresubmitScriptWithResultCache(self, mockFileHash):
+        contents = {os.path.join(self.fake_root_dir, 'foo', 'blat.cc'): 'a'}
+        mockFileHash.side_effect = lambda path: contents.get(path, 'tool')
+        change = presubmit.Change('mychange', 'description', self.fake_root_dir,
+                                  [['M', 'foo/blat.cc']], 0, 0, None)
+        fake_presubmit = os.path.join(self.fake_root_dir, 'PRESUBMIT.py')
+        script = ('import fake_check\n'
+                  'def CheckChangeOnUpload(input_api, output_api):\n'
+                  '  output_api.AppendCC("cc@example.com")\n'
+                  '  return fake_check(output_api)\n')
+        fake_check = mock.Mock()
+
+        result_cache = presubmit.PresubmitResultCache('nonexistent')
+        with mock.patch.dict(sys.modules, {'fake_check': fake_check}):
+
+            def run(script=script):
+                executer = presubmit.PresubmitExecuter(
+                    change,
+                    False,
+                    None,
+                    presubmit.GerritAccessor(),
+                    result_cache=result_cache)
+                results = executer.ExecPresubmitScript(script, fake_presubmit)
+                return [r.json_format() for r in results], executer.more_cc
+
+            # Errors aren't cached.
+            fake_check.side_effect = lambda output_api: [
+                output_api.PresubmitError('error')
+            ]
+            run()
+            fake_check.side_effect = lambda output_api: [
+                output_api.PresubmitPromptWarning('warning', ['item'])
+            ]
+            expected = run()
+            self.assertEqual(2, fake_check.call_count)
+            self.assertEqual(['cc@example.com'], expected[1])
+
+            # Nothing changed, results and CCs come from the cache.
+            self.assertEqual(expected, run())
+            self.assertEqual(2, fake_check.call_count)
+
+            # The check runs again when the script or the change changes.
+            run(script + '\n')
+            self.assertEqual(3, fake_check.call_count)
+            contents[os.path.join(self.fake_root_dir, 'foo', 'blat.cc')] = 'b'
+            run()
+            self.assertEqual(4, fake_check.call_count)
+
+    @mock.patch('presubmit_support._FileHash')
+    def testExecPresubmitScriptWithResultCacheOtherDirectory(
+            self, mockFileHash):
+        foo = os.path.join(self.fake_root_dir, 'foo', 'blat.cc')
+        bar = os.path.join(self.fake_root_dir, 'bar', 'blat.cc')
+        contents = {foo: 'a', bar: 'a'}
+        mockFileHash.side_effect = lambda path: contents.get(path, 'tool')
+        fake_presubmit = os.path.join(self.fake_root_dir, 'foo', 'PRESUBMIT.py')
+        script = ('import fake_check\n'
+                  'def CheckChangeOnUpload(input_api, output_api):\n'
+                  '  return fake_check(output_api)\n')
+        fake_check = mock.Mock(return_value=[])
+
+        result_cache = presubmit.PresubmitResultCache('nonexistent')
+        with mock.patch.dict(sys.modules, {'fake_check': fake_check}):
+
+            def run(description='description', issue=0, patchset=0):
+                change = presubmit.Change(
+                    'mychange', description, self.fake_root_dir,
+                    [['M', 'foo/blat.cc'], ['M', 'bar/blat.cc']], issue,
+                    patchset, None)
+                executer = presubmit.PresubmitExecuter(
+                    change,
+                    False,
+                    None,
+                    presubmit.GerritAccessor(),
+                    result_cache=result_cache)
+                executer.ExecPresubmitScript(script, fake_presubmit)
+
+            run()
+            self.assertEqual(1, fake_check.call_count)
+
+            # Neither files outside of foo/ nor the description, issue and
+            # patchset are inputs of foo/PRESUBMIT.py's checks.
+            contents[bar] = 'b'
+            run('new description', 123, 2)
+            self.assertEqual(1, fake_check.call_count)
+
+            contents[foo] = 'b'
+            run()
+            self.assertEqual(2, fake_check.call_count)
+
     def testExecPresubmitScriptTemporaryFilesRemoval(self):
         tempfile.NamedTemporaryFile.side_effect = [
             MockTemporaryFile('baz'),
@@ -3527,6 +3627,85 @@ class ThreadPoolTest(unittest.TestCase):
             messages[1])
         self.assertEqual('5\n5 (0.00s) failed\nstdout', messages[2])
 
+    def testLongestTestsFirst(self):
+        subprocess.Popen.return_value = mock.Mock(returncode=0)
+        durations = presubmit.TestDurations()
+        mock_tests = [
+            presubmit.CommandData(name=str(i),
+                                  cmd=[str(i)],
+                                  kwargs={},
+                                  message=lambda x, **kwargs: x)
+            for i in range(4)
+        ]
+        for i, test in enumerate(mock_tests[1:]):
+            durations.Record(test, i)
+        reported = []
+
+        t = presubmit.ThreadPool(
+            1,
+            durations=durations,
+            on_result=lambda test, duration, passed: reported.append(
+                (test.name, passed)))
+        t.AddTests(mock_tests)
+        self.assertEqual([], t.RunAsync())
+
+        # '0' never ran, so it is assumed to be the longest.
+        self.assertEqual([('0', True), ('3', True), ('2', True), ('1', True)],
+                         reported)
+
+    def testTestEnv(self):
+        subprocess.Popen.return_value = mock.Mock(returncode=0)
+        mock_tests = [
+            presubmit.CommandData(name='inherit',
+                                  cmd=['inherit'],
+                                  kwargs={},
+                                  message=lambda x, **kwargs: x),
+            presubmit.CommandData(name='env',
+                                  cmd=['env'],
+                                  kwargs={'env': {
+                                      'FOO': 'bar'
+                                  }},
+                                  message=lambda x, **kwargs: x),
+        ]
+
+        with mock.patch.dict('os.environ', {'BAZ': 'qux'}, clear=True):
+            t = presubmit.ThreadPool(1, test_env={'PRESUBMIT_MAX_JOBS': '1'})
+            t.AddTests(mock_tests)
+            self.assertEqual([], t.RunAsync())
+            self.assertNotIn('PRESUBMIT_MAX_JOBS', os.environ)
+
+        envs = {
+            c.args[0][0]: c.kwargs['env']
+            for c in subprocess.Popen.mock_calls
+        }
+        self.assertEqual(
+            {
+                'inherit': {
+                    'BAZ': 'qux',
+                    'PRESUBMIT_MAX_JOBS': '1'
+                },
+                'env': {
+                    'FOO': 'bar',
+                    'PRESUBMIT_MAX_JOBS': '1'
+                },
+            }, envs)
+        self.assertEqual({'FOO': 'bar'}, mock_tests[1].kwargs['env'])
+
+    def testDurationsAreSaved(self):
+        with gclient_utils.temporary_directory() as tmp:
+            path = os.path.join(tmp, 'durations.json')
+            test = presubmit.CommandData(name='foo',
+                                         cmd=['foo'],
+                                         kwargs={'cwd': tmp},
+                                         message=lambda x, **kwargs: x)
+            durations = presubmit.TestDurations(path)
+            self.assertIsNone(durations.Get(test))
+            durations.Record(test, 4)
+            durations.Record(test, 2)
+            durations.Save()
+
+            self.assertEqual(3, presubmit.TestDurations(path).Get(test))
+
 
 if __name__ == '__main__':
     import unittest
@@ -164,6 +164,37 @@ class RealGitTest(fake_repos.FakeReposTestBase):
         self.assertEqual(self.githash('repo_1', 2),
                          scm.GIT.ResolveCommit(self.cwd, 'HEAD'))
 
+    def testResolveCommit_RefMoved(self):
+        first_rev = self.githash('repo_1', 1)
+        head = scm.GIT.ResolveCommit(self.cwd, 'HEAD')
+        self.assertEqual(head, scm.GIT.ResolveCommit(self.cwd, 'HEAD'))
+        subprocess.run(['git', 'branch', '-f', 'moving', first_rev],
+                       cwd=self.cwd)
+        self.assertEqual(first_rev, scm.GIT.ResolveCommit(self.cwd, 'moving'))
+        # Moved by another process.
+        subprocess.run(['git', 'branch', '-f', 'moving', head], cwd=self.cwd)
+        self.assertEqual(head, scm.GIT.ResolveCommit(self.cwd, 'moving'))
+        subprocess.run(['git', 'branch', '-D', 'moving'], cwd=self.cwd)
+
+    def testGenerateDiffStream(self):
+        first_rev = self.githash('repo_1', 1)
+        expected = scm.GIT.GenerateDiff(self.cwd,
+                                        branch=first_rev,
+                                        full_move=True)
+        with scm.GIT.GenerateDiffStream(self.cwd,
+                                        branch=first_rev,
+                                        full_move=True) as lines:
+            self.assertEqual(expected, b''.join(lines).decode('utf-8'))
+        self.assertIn('--- origin', expected)
+        self.assertNotIn('/dev/null', expected)
+
+    def testGenerateDiffStream_Error(self):
+        with self.assertRaises(subprocess2.CalledProcessError) as e:
+            with scm.GIT.GenerateDiffStream(self.cwd,
+                                            branch='not-a-branch') as lines:
+                list(lines)
+        self.assertIn(b'not-a-branch', e.exception.stderr)
+
     def testIsValidRevision(self):
         # Sha1's are [0-9a-z]{32}, so starting with a 'z' or 'r' should always
         # fail.
@@ -218,6 +249,14 @@ class RealGitTest(fake_repos.FakeReposTestBase):
         self.assertEqual('default-value',
                          scm.GIT.GetConfig(self.cwd, key, 'default-value'))
 
+    def testGetConfig_ChangedByAnotherProcess(self):
+        key = 'scm.test-key'
+        self.assertIsNone(scm.GIT.GetConfig(self.cwd, key))
+        subprocess.run(['git', 'config', key, 'external'], cwd=self.cwd)
+        self.assertEqual('external', scm.GIT.GetConfig(self.cwd, key))
+        subprocess.run(['git', 'config', '--unset', key], cwd=self.cwd)
+        self.assertIsNone(scm.GIT.GetConfig(self.cwd, key))
+
     def testGetSetConfigBool(self):
         key = 'scm.test-key'
         self.assertFalse(scm.GIT.GetConfigBool(self.cwd, key))
@@ -0,0 +1,119 @@
+#!/usr/bin/env vpython3
+# Copyright (c) 2024 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Unit tests for stamp_index.py."""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gclient_utils
+import stamp_index
+
+
+class StampIndexTest(unittest.TestCase):
+    def setUp(self):
+        super(StampIndexTest, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(gclient_utils.rmtree, self.tmp)
+        self.index_path = os.path.join(self.tmp, 'index.json')
+        self.file = os.path.join(self.tmp, 'file')
+        gclient_utils.FileWrite(self.file, 'contents')
+        self.compute = mock.Mock(return_value='digest')
+
+    def _Index(self, paranoid=False):
+        return stamp_index.StampIndex(self.index_path, paranoid)
+
+    def testSkipsUnchangedFiles(self):
+        index = self._Index()
+        self.assertEqual('digest', index.digest(self.file, 'sha1',
+                                                self.compute))
+        self.assertEqual('digest', index.digest(self.file, 'sha1',
+                                                self.compute))
+        self.compute.assert_called_once_with(self.file)
+        # Other algorithms are computed separately.
+        self.assertIsNone(index.lookup(self.file, 'sha256'))
+
+        index.save()
+        index = self._Index()
+        self.assertEqual('digest', index.lookup(self.file, 'sha1'))
+        self.assertIsNone(self._Index(paranoid=True).lookup(self.file, 'sha1'))
+
+    def testHashesChangedFiles(self):
+        index = self._Index()
+        index.record(self.file, 'sha1', 'old')
+        st = os.stat(self.file)
+        gclient_utils.FileWrite(self.file, 'contents')
+        os.utime(self.file, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        self.assertIsNone(index.lookup(self.file, 'sha1'))
+        self.assertEqual('digest', index.digest(self.file, 'sha1',
+                                                self.compute))
+
+        os.remove(self.file)
+        self.assertIsNone(index.lookup(self.file, 'sha1'))
+
+    def testSaveMergesAndPrunes(self):
+        other_file = os.path.join(self.tmp, 'other')
+        removed_file = os.path.join(self.tmp, 'removed')
+        gclient_utils.FileWrite(other_file, '')
+        gclient_utils.FileWrite(removed_file, '')
+        index = self._Index()
+        other = self._Index()
+        index.record(self.file, 'sha1', 'a')
+        index.record(removed_file, 'sha1', 'b')
+        other.record(other_file, 'sha1', 'c')
+        index.save()
+        os.remove(removed_file)
+        other.save()
+
+        index = self._Index()
+        self.assertEqual('a', index.lookup(self.file, 'sha1'))
+        self.assertEqual('c', index.lookup(other_file, 'sha1'))
+        self.assertEqual([os.path.abspath(self.file), other_file],
+                         sorted(index._Entries()))
+
+    def testSaveWithoutUpdatesDoesNothing(self):
+        self._Index().save()
+        self.assertFalse(os.path.exists(self.index_path))
+
+    def testInvalidIndex(self):
+        gclient_utils.FileWrite(self.index_path, '{"files": [')
+        index = self._Index()
+        self.assertIsNone(index.lookup(self.file, 'sha1'))
+        index.record(self.file, 'sha1', 'a')
+        index.save()
+        self.assertEqual('a', self._Index().lookup(self.file, 'sha1'))
+
+    def testGetStampIndex(self):
+        with mock.patch.dict('os.environ', {stamp_index.INDEX_ENV_VAR: '0'}):
+            self.assertIsNone(stamp_index.GetStampIndex())
+        with mock.patch.dict(
+                'os.environ', {
+                    stamp_index.INDEX_ENV_VAR: self.index_path,
+                    stamp_index.PARANOID_ENV_VAR: '1'
+                }):
+            index = stamp_index.GetStampIndex()
+            self.assertIs(index, stamp_index.GetStampIndex())
+        self.assertEqual(self.index_path, index.path)
+        self.assertTrue(index.paranoid)
+
+    def testDefaultIndexIsInUserCache(self):
+        with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': self.tmp}), \
+                mock.patch('sys.platform', 'linux'):
+            os.environ.pop(stamp_index.INDEX_ENV_VAR, None)
+            index = stamp_index.GetStampIndex()
+        self.assertEqual(
+            os.path.join(self.tmp, 'depot_tools', 'stamp_index.json'),
+            index.path)
+        index.record(self.file, 'sha1', 'a')
+        index.save()
+        self.assertTrue(os.path.isfile(index.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
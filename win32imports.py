@@ -7,7 +7,10 @@ import ctypes
 import ctypes.wintypes
 
 GENERIC_WRITE = 0x40000000
+FILE_SHARE_READ = 0x00000001
+FILE_SHARE_WRITE = 0x00000002
 CREATE_ALWAYS = 0x00000002
+OPEN_ALWAYS = 0x00000004
 FILE_ATTRIBUTE_NORMAL = 0x00000080
 LOCKFILE_EXCLUSIVE_LOCK = 0x00000002
 LOCKFILE_FAIL_IMMEDIATELY = 0x00000001